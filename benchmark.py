@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+签名、XML编解码与请求构造等热点路径的基准测试，网络请求由 StubTransport 直接返回固定响应
+
+    python benchmark.py                    # 运行全部用例
+    python benchmark.py -k sign            # 只运行名称包含sign的用例
+    python benchmark.py --save             # 将结果保存为基线
+    python benchmark.py --threshold 0.2    # 与基线相比 ops/sec 下降超过20%时以非0状态退出，基线不存在时同样失败
+
+Python 3 下会同时用 tracemalloc 统计单次操作的内存峰值(peak KiB，为峰值占用而不是分配次数)；
+import[模块] 用例在新的解释器进程中计时首次导入，ops/sec 为每秒可完成的冷启动导入次数
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from wx_pay import WxPay
+
+BODY = u"腾讯充值中心-QQ会员充值" * 5
+DETAIL = json.dumps({"goods_detail": [
+    {"goods_id": u"商品编码{0}".format(i), "goods_name": u"微信支付测试商品{0}".format(i),
+     "quantity": 1, "price": 528800} for i in range(60)
+]}, ensure_ascii=False)
+
+RESPONSE = (u"<xml><return_code><![CDATA[SUCCESS]]></return_code><return_msg><![CDATA[OK]]></return_msg>"
+            u"<appid><![CDATA[wx2421b1c4370ec43b]]></appid><mch_id><![CDATA[10000100]]></mch_id>"
+            u"<nonce_str><![CDATA[IITRi8Iabbblz1Jc]]></nonce_str>"
+            u"<sign><![CDATA[7921E432F65EB8ED0CE9755F0E86D72F]]></sign>"
+            u"<result_code><![CDATA[SUCCESS]]></result_code>"
+            u"<prepay_id><![CDATA[wx201411101639507cbf6ffd8b0779950874]]></prepay_id>"
+            u"<trade_type><![CDATA[JSAPI]]></trade_type>"
+            u"<transaction_id><![CDATA[1008450740201411110005820873]]></transaction_id>"
+            u"<out_trade_no><![CDATA[1415757673]]></out_trade_no><total_fee>1</total_fee><cash_fee>1</cash_fee>"
+            u"<time_end><![CDATA[20141111170043]]></time_end><attach><![CDATA[{0}]]></attach></xml>"
+            ).format(BODY).encode("utf-8")
+
+BILL_HEADER = u"交易时间,公众账号ID,商户号,子商户号,设备号,微信订单号,商户订单号,用户标识,交易类型,交易状态,付款银行,货币种类," \
+              u"总金额,代金券或立减优惠金额,微信退款单号,商户退款单号,退款金额,代金券或立减优惠退款金额,退款类型,退款状态," \
+              u"商品名称,商户数据包,手续费,费率\r\n"
+BILL_ROW = u"`2014-11-10 16:33:45,`wx2421b1c4370ec43b,`10000100,`0,`1000,`1001690740201411100005734289," \
+           u"`{0:010d},`oUpF8uN95-Ptaags6E_roPHg7AG0,`JSAPI,`SUCCESS,`CCB_DEBIT,`CNY,`0.01,`0.0,`0,`0,`0,`0,`,`," \
+           u"`被扫支付测试,`订单额外描述,`0.00000,`0.60%\r\n"
+BILL_FOOTER = u"总交易单数,总交易额,总退款金额,总代金券或立减优惠退款金额,手续费总金额\r\n`{0},`{1:.2f},`0.00,`0.00,`0.00000\r\n"
+
+
+def make_bill(rows):
+    parts = [BILL_HEADER] + [BILL_ROW.format(i) for i in range(rows)] + [BILL_FOOTER.format(rows, rows * 0.01)]
+    return u"".join(parts).encode("utf-8")
+
+
+class StubTransport(object):
+    """
+    不发起网络请求，直接返回固定响应
+    """
+
+    def __init__(self, response=RESPONSE, bill=b""):
+        self.response = response
+        self.bill = bill
+
+    def post(self, url, data, cert=None, timeout=None):
+        return self.response
+
+    def stream(self, url, data, cert=None, timeout=None, chunk_size=65536):
+        bill = io.BytesIO(self.bill)
+        chunk = bill.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = bill.read(chunk_size)
+
+
+def build_cases(bill_rows):
+    wx_pay = WxPay("wx2421b1c4370ec43b", "10000100", "192006250b4c09247ec02edce69f6a2d",
+                   "http://www.example.com/pay/weixin/notify", transport=StubTransport(bill=make_bill(bill_rows)))
+    order = dict(appid="wx2421b1c4370ec43b", mch_id="10000100", nonce_str=wx_pay.nonce_str(),
+                 body=BODY, detail=DETAIL, out_trade_no="20150806125346", total_fee=528800,
+                 spbill_create_ip="123.12.12.123", notify_url="http://www.example.com/pay/weixin/notify",
+                 trade_type="JSAPI", openid="oUpF8uMuAJO_M2pxb1Q9zNjWeS6o")
+    signed = dict(order, sign=wx_pay.sign(order))
+    order_xml = wx_pay.to_xml(signed)
+
+    def unified_order():
+        wx_pay.unified_order(out_trade_no="20150806125346", body=BODY, detail=DETAIL, total_fee=528800,
+                             trade_type="JSAPI", openid="oUpF8uMuAJO_M2pxb1Q9zNjWeS6o",
+                             spbill_create_ip="123.12.12.123")
+
+    def js_pay_api():
+        wx_pay.js_pay_api(openid="oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", body=BODY, total_fee=528800,
+                          spbill_create_ip="123.12.12.123")
+
+    def refund():
+        wx_pay.refund("apiclient_cert.pem", "apiclient_key.pem", out_trade_no="20150806125346",
+                      total_fee=528800, refund_fee=528800)
+
+    def send_red_pack():
+        # 指定 mch_billno，避免自动生成单号时每秒1000个的序号上限影响测试结果
+        wx_pay.send_red_pack("apiclient_cert.pem", "apiclient_key.pem", mch_billno="10000100201411100000000001",
+                             send_name=u"天虹百货", re_openid="oUpF8uMuAJO_M2pxb1Q9zNjWeS6o", total_amount=100,
+                             wishing=u"感谢您参加猜灯谜活动，祝您元宵节快乐！", client_ip="192.168.0.1",
+                             act_name=u"猜灯谜抢红包活动", remark=u"猜越多得越多，快来抢！")
+
+    def download_bill():
+        for _ in wx_pay.iter_bill("20141110", "ALL"):
+            pass
+
+    return [
+        ("sign", lambda: wx_pay.sign(order)),
+        ("check", lambda: wx_pay.check(signed)),
+        ("to_xml", lambda: wx_pay.to_xml(signed)),
+        ("to_dict", lambda: wx_pay.to_dict(order_xml)),
+        ("nonce_str", lambda: wx_pay.nonce_str()),
+        ("unified_order", unified_order),
+        ("js_pay_api", js_pay_api),
+        ("refund", refund),
+        ("send_red_pack", send_red_pack),
+        ("download_bill[{0}]".format(bill_rows), download_bill),
+    ]
+
+
+IMPORT_MODULES = ("wx_pay",)
+
+_IMPORT_TIMER = "import time; start = time.time(); import {0}; print(repr(time.time() - start))"
+
+
+def measure_import(module, repeat=7):
+    """
+    在新的解释器进程中导入模块，不计解释器自身的启动时间
+
+    :return: 最好一次的每秒导入次数
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", _IMPORT_TIMER.format(module)], cwd=folder)
+        elapsed = float(output.decode("ascii").strip())
+        best = elapsed if best is None else min(best, elapsed)
+    return 1.0 / best
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """
+    :return: 最好一轮的 ops/sec
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed * 2 >= min_time else 10
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in range(number):
+            func()
+        best = min(best, time.time() - start)
+    return number / best
+
+
+def peak_memory(func):
+    """
+    :return: 单次操作期间的内存峰值(字节)，不支持 tracemalloc 时返回None
+    """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="keyword", help="只运行名称包含该字符串的用例")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="基线文件路径")
+    parser.add_argument("--save", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="允许的 ops/sec 下降比例，指定时基线文件不存在或缺少用例均视为失败")
+    parser.add_argument("--bill-rows", type=int, default=20000, help="对账单用例的记录数")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except IOError:
+        if args.threshold is not None:
+            print("baseline {0} not found, run with --save on the reference version first".format(args.baseline))
+            return 2
+        baseline = {}
+
+    cases = [(name, func, False) for name, func in build_cases(args.bill_rows)]
+    cases += [("import[{0}]".format(module), module, True) for module in IMPORT_MODULES]
+    results, regressions, missing = {}, [], []
+    print("{0:<24}{1:>14}{2:>14}{3:>10}".format("case", "ops/sec", "peak KiB", "vs base"))
+    for name, func, is_import in cases:
+        if args.keyword and args.keyword not in name:
+            continue
+        if is_import:
+            ops, peak = measure_import(func), None
+        else:
+            ops = measure(func)
+            peak = peak_memory(func)
+        results[name] = {"ops": ops, "peak": peak}
+        change = ""
+        if name in baseline:
+            ratio = ops / baseline[name]["ops"] - 1
+            change = "{0:+.1%}".format(ratio)
+            if args.threshold is not None and ratio < -args.threshold:
+                regressions.append(name)
+        elif args.threshold is not None:
+            missing.append(name)
+        print("{0:<24}{1:>14,.1f}{2:>14}{3:>10}".format(
+            name, ops, "-" if peak is None else "{0:,.1f}".format(peak / 1024.0), change))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline saved to {0}".format(args.baseline))
+    if missing:
+        print("no baseline for: {0}".format(", ".join(missing)))
+    if regressions:
+        print("regressed more than {0:.0%}: {1}".format(args.threshold, ", ".join(regressions)))
+    return 1 if regressions or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from __future__ import print_function
 
 from hashlib import sha1
 from time import time
@@ -25,7 +26,7 @@ def wx_js_config():
            for k in sorted(config_args.keys())]
     s = "&".join("=".join(kv) for kv in raw if kv[1])
     return {
-        'signature': sha1(s).hexdigest(),
+        'signature': sha1(s.encode('utf-8')).hexdigest(),
         'timestamp': config_args['timestamp'],
         'nonce_str': config_args['noncestr']
     }
@@ -51,11 +52,11 @@ def create_pay_example():
             total_fee=100  # total_fee 单位是 分， 100 = 1元
             # spbill_create_ip='210.50.0.10'    # 若不使用flask框架，则需要传入调用微信支付的用户ip地址
         )
-        print pay_data
+        print(pay_data)
         # 订单生成后将请将返回的json数据 传入前端页面微信支付js的参数部分
         return jsonify(pay_data)
-    except WxPayError, e:
-        return e.message, 400
+    except WxPayError as e:
+        return e.args[0], 400
 
 
 def order_query_example():
@@ -142,10 +143,10 @@ def download_bill_example():
         wx_mch_key='WX_MCH_KEY',
         wx_notify_url='http://www.example.com/pay/weixin/notify'
     )
-    print wx_pay.download_bill(
+    print(wx_pay.download_bill(
         bill_date='20161228',  # 对账单日期
         bill_type='ALL'  # 账单类型(ALL-当日所有订单信息，[默认]SUCCESS-当日成功支付的订单, REFUND-当日退款订单)
-    )
+    ))
 
 
 def send_red_pack_to_user_example():
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+from wx_pay_notify import NotifyQueue, QueueFull
+
+
+def ops(path):
+    with open(str(path)) as f:
+        return [json.loads(line)["op"] for line in f if line.strip()]
+
+
+def test_reopen_restores_pending_entries_in_order(tmp_path):
+    path = str(tmp_path / "notify.queue")
+    q = NotifyQueue(path)
+    for i in range(3):
+        assert q.put("k%d" % i, {"i": i})
+    assert not q.put("k1", {"i": 1})
+    entry_id, key, data, attempts = q.get(0)
+    q.retry(entry_id, 0, "boom")
+    q.close()
+
+    q = NotifyQueue(path)
+    assert len(q) == 3
+    items = [q.get(0) for _ in range(3)]
+    restored = [(key, data["i"], attempts) for _, key, data, attempts in items]
+    assert restored == [("k0", 0, 1), ("k1", 1, 0), ("k2", 2, 0)]
+    # 去重键在重新打开后仍然有效
+    assert not q.put("k2", {"i": 2})
+    q.close()
+
+
+def test_acked_entries_are_not_replayed(tmp_path):
+    path = str(tmp_path / "notify.queue")
+    q = NotifyQueue(path)
+    q.put("k0", {"i": 0})
+    q.put("k1", {"i": 1})
+    q.ack(q.get(0)[0])
+    q.close()
+    q = NotifyQueue(path)
+    assert len(q) == 1
+    assert q.get(0)[1] == "k1"
+    q.close()
+
+
+def test_torn_last_line_does_not_swallow_next_record(tmp_path):
+    path = str(tmp_path / "notify.queue")
+    q = NotifyQueue(path)
+    q.put("k0", {"i": 0})
+    q.close()
+    with open(path, "a") as f:
+        f.write('{"op": "put", "id": 2, "key": "k1", "da')
+    q = NotifyQueue(path)
+    q.put("k2", {"i": 2})
+    q.close()
+    q = NotifyQueue(path)
+    assert sorted(q.get(0)[1] for _ in range(2)) == ["k0", "k2"]
+    q.close()
+
+
+def test_requeue_survives_reopen(tmp_path):
+    path = str(tmp_path / "notify.queue")
+    q = NotifyQueue(path)
+    q.put("k0", {"i": 0})
+    entry_id = q.get(0)[0]
+    q.fail(entry_id, "boom")
+    q.close()
+
+    q = NotifyQueue(path)
+    assert [(key, error) for _, key, _, error in q.dead_letters()] == [("k0", "boom")]
+    assert len(q) == 0
+    q.requeue(entry_id)
+    assert q.dead_letters() == []
+    q.close()
+
+    q = NotifyQueue(path)
+    assert q.dead_letters() == []
+    new_id, key, data, attempts = q.get(0)
+    assert (key, data, attempts) == ("k0", {"i": 0}, 0)
+    assert new_id != entry_id
+    q.close()
+
+
+def test_compaction_keeps_live_and_dead_entries(tmp_path):
+    path = str(tmp_path / "notify.queue")
+    q = NotifyQueue(path, compact_every=5)
+    for i in range(8):
+        q.put("k%d" % i, {"i": i})
+    for _ in range(5):
+        q.ack(q.get(0)[0])
+    # 完成5条后重写日志，只剩未完成的3条
+    assert ops(path) == ["put"] * 3
+    entry_id = q.get(0)[0]
+    q.fail(entry_id, "boom")
+    q.compact()
+    assert ops(path) == ["put", "put", "put", "dead"]
+    q.close()
+
+    inode = os.stat(path).st_ino
+    q = NotifyQueue(path)
+    assert len(q) == 2
+    assert [key for _, key, _, _ in q.dead_letters()] == ["k5"]
+    q.close()
+    # 已合并的日志重新打开时不会再次重写
+    assert os.stat(path).st_ino == inode
+
+
+def test_put_raises_when_full(tmp_path):
+    q = NotifyQueue(str(tmp_path / "notify.queue"), maxsize=1)
+    q.put("k0", {})
+    with pytest.raises(QueueFull):
+        q.put("k1", {})
+    q.close()
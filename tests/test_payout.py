@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+import pytest
+
+from wx_pay import WxPay, WxPayError
+from wx_pay_payout import FAILED, SUCCESS, PayoutJournal, PayoutPipeline
+
+OK = b"<xml><return_code>SUCCESS</return_code><result_code>SUCCESS</result_code></xml>"
+
+
+def record(i):
+    return dict(send_name=u"商户", re_openid="o%d" % i, total_amount=100, wishing=u"祝福", client_ip="1.1.1.1",
+                act_name=u"活动", remark=u"备注")
+
+
+class Transport(object):
+    def __init__(self, reply=OK):
+        self.reply = reply
+        self.bills = []
+
+    def post(self, url, data, cert=None, timeout=None):
+        self.bills.append(re.search(b"<mch_billno><!\\[CDATA\\[(\\d+)", data).group(1).decode())
+        if isinstance(self.reply, Exception):
+            raise self.reply
+        return self.reply
+
+
+def pipeline(path, transport, **kwargs):
+    wx_pay = WxPay("app", "1900000109", "key", "n", transport=transport, api_cert_path="c", api_key_path="k")
+    kwargs.setdefault("backoff", 0.001)
+    return PayoutPipeline(wx_pay, str(path), batch_no=1, workers=2, qps=100000, **kwargs)
+
+
+def test_replay_after_crash_resends_planned_ids(tmp_path):
+    path = tmp_path / "payout.journal"
+    down = Transport(IOError("reset"))
+    p = pipeline(path, down, retries=0)
+    results = list(p.run([record(i) for i in range(5)]))
+    assert all(isinstance(item.error, IOError) for item in results)
+    p.close()
+    # 模拟崩溃时写了一半的最后一行
+    with open(str(path), "a") as f:
+        f.write('{"op": "result", "id": "trunc')
+
+    up = Transport()
+    p = pipeline(path, up)
+    assert p.summary() == {"planned": 5, SUCCESS: 0, FAILED: 0, "pending": 5}
+    results = list(p.run([record(i) for i in range(5)]))
+    assert sorted(up.bills) == sorted(set(down.bills))
+    assert all(item.error is None for item in results)
+    assert p.summary()["pending"] == 0
+    p.close()
+
+    # 所有记录已有结果，再次执行不会发送
+    again = Transport()
+    p = pipeline(path, again)
+    assert list(p.run([record(i) for i in range(5)])) == []
+    assert again.bills == []
+    p.close()
+
+
+def test_replay_plans_only_new_records(tmp_path):
+    path = tmp_path / "payout.journal"
+    p = pipeline(path, Transport())
+    list(p.run([record(i) for i in range(3)]))
+    p.close()
+    transport = Transport()
+    p = pipeline(path, transport)
+    list(p.run([record(i) for i in range(5)]))
+    p.close()
+    assert len(transport.bills) == 2
+    planned = PayoutJournal(str(path)).planned
+    assert [seq for seq, _, _ in planned] == [0, 1, 2, 3, 4]
+    assert len(set(bill_id for _, bill_id, _ in planned)) == 5
+
+
+def test_fail_without_err_code_stays_pending(tmp_path):
+    transport = Transport(b"<xml><return_code>SUCCESS</return_code><result_code>FAIL</result_code></xml>")
+    p = pipeline(tmp_path / "payout.journal", transport, retries=2)
+    results = list(p.run([record(0)]))
+    assert isinstance(results[0].error, WxPayError)
+    assert len(transport.bills) == 3
+    assert p.summary()["pending"] == 1
+    p.close()
+
+
+def test_final_err_code_is_journaled_as_failed(tmp_path):
+    transport = Transport(b"<xml><return_code>SUCCESS</return_code><result_code>FAIL</result_code>"
+                          b"<err_code>NOTENOUGH</err_code><err_code_des>no money</err_code_des></xml>")
+    path = tmp_path / "payout.journal"
+    p = pipeline(path, transport)
+    list(p.run([record(0)]))
+    p.close()
+    assert len(transport.bills) == 1
+    finished = list(PayoutJournal(str(path)).finished.values())
+    assert [(entry["status"], entry["err_code"]) for entry in finished] == [(FAILED, "NOTENOUGH")]
+
+
+def test_invalid_record_rejected_before_planning(tmp_path):
+    path = tmp_path / "payout.journal"
+    p = pipeline(path, Transport())
+    bad = record(1)
+    del bad["wishing"]
+    with pytest.raises(WxPayError):
+        list(p.run([record(0), bad]))
+    p.close()
+    with open(str(path)) as f:
+        assert [json.loads(line)["op"] for line in f] == ["batch"]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import sys
+
+import pytest
+
+from wx_pay import WxPay
+from wx_pay_ratelimit import RateLimiter, RateLimitError, SharedMemoryBuckets
+from wx_pay_resilience import Resilience
+
+OK = b"<xml><return_code>SUCCESS</return_code><result_code>SUCCESS</result_code></xml>"
+
+
+class Transport(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def post(self, url, body, cert=None, timeout=None):
+        self.timeouts.append(timeout)
+        return OK
+
+
+def test_reserve_borrows_tokens_and_rejects_past_max_wait():
+    limiter = RateLimiter({"transfers": (10, 2)}, max_wait=0.25)
+    waits = [limiter.reserve("m1", "transfers") for _ in range(4)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(0.1, abs=0.02)
+    assert waits[3] == pytest.approx(0.2, abs=0.02)
+    with pytest.raises(RateLimitError) as info:
+        limiter.reserve("m1", "transfers")
+    assert info.value.endpoint == "transfers"
+    # 被拒绝的请求不预支令牌
+    with pytest.raises(RateLimitError) as again:
+        limiter.reserve("m1", "transfers")
+    assert again.value.wait == pytest.approx(info.value.wait, abs=0.02)
+
+
+def test_limits_are_per_merchant_and_endpoint():
+    limiter = RateLimiter({"transfers": (1, 1)}, max_wait=0)
+    limiter.reserve("m1", "transfers")
+    with pytest.raises(RateLimitError):
+        limiter.reserve("m1", "transfers")
+    assert limiter.reserve("m2", "transfers") == 0
+    assert limiter.reserve("m1", "orderquery") == 0
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="fcntl")
+def test_shared_memory_buckets_share_tokens(tmp_path):
+    path = str(tmp_path / "buckets")
+    first = RateLimiter({"sendredpack": (1, 2)}, backend=SharedMemoryBuckets(path), max_wait=0)
+    second = RateLimiter({"sendredpack": (1, 2)}, backend=SharedMemoryBuckets(path), max_wait=0)
+    first.reserve("m1", "sendredpack")
+    second.reserve("m1", "sendredpack")
+    with pytest.raises(RateLimitError):
+        first.reserve("m1", "sendredpack")
+
+
+def wx_pay(limiter, deadline):
+    transport = Transport()
+    client = WxPay("wx", "1", "k" * 32, "http://n", transport=transport, rate_limiter=limiter,
+                   resilience=Resilience(deadline=deadline, retries=0))
+    return client, transport
+
+
+def test_limiter_wait_counts_against_attempt_timeout():
+    client, transport = wx_pay(RateLimiter({"orderquery": (2, 1)}), deadline=1.0)
+    client.order_query(out_trade_no="o1")
+    client.order_query(out_trade_no="o2")
+    first, second = transport.timeouts
+    assert first == pytest.approx(1.0, abs=0.05)
+    # 第二次请求等待约0.5秒取得令牌，传给传输层的超时相应减少
+    assert second == pytest.approx(0.5, abs=0.1)
+
+
+def test_wait_longer_than_budget_is_rejected_without_sending():
+    client, transport = wx_pay(RateLimiter({"orderquery": (1, 1)}), deadline=0.5)
+    client.order_query(out_trade_no="o1")
+    with pytest.raises(RateLimitError):
+        client.order_query(out_trade_no="o2")
+    assert len(transport.timeouts) == 1
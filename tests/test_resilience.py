@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from wx_pay_resilience import CircuitBreaker, CircuitOpenError, DeadlineExceededError, Resilience
+
+
+def failing(error, calls):
+    def send(timeout):
+        calls.append(timeout)
+        raise error
+    return send
+
+
+def test_breaker_opens_when_failure_rate_reaches_threshold():
+    breaker = CircuitBreaker(failure_threshold=0.5, min_calls=4, window=10, reset_timeout=60)
+    for ok in (True, False, True):
+        breaker.before()
+        breaker.record(ok)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_breaker_half_open_probe_success_closes():
+    breaker = CircuitBreaker(failure_threshold=0.5, min_calls=2, window=10, reset_timeout=0.05)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.06)
+    breaker.before()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # 试探请求未返回前其余请求仍然失败
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    # 恢复后重新统计，之前的失败不再计入
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_probe_failure_reopens():
+    breaker = CircuitBreaker(failure_threshold=0.5, min_calls=2, window=10, reset_timeout=0.05)
+    breaker.record(False)
+    breaker.record(False)
+    time.sleep(0.06)
+    breaker.before()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_idempotent_call_is_retried():
+    calls = []
+    resilience = Resilience(deadline=5, retries=2, backoff=0.001)
+    with pytest.raises(IOError):
+        resilience.call("orderquery", {}, failing(IOError("reset"), calls))
+    assert len(calls) == 3
+    # 每次尝试的超时为剩余预算
+    assert calls[0] <= 5 and calls[-1] <= calls[0]
+
+
+def test_non_idempotent_call_retried_only_with_merchant_id():
+    calls = []
+    resilience = Resilience(deadline=5, retries=2, backoff=0.001)
+    with pytest.raises(IOError):
+        resilience.call("refund", {}, failing(IOError("reset"), calls))
+    assert len(calls) == 1
+    with pytest.raises(IOError):
+        resilience.call("refund", {"out_refund_no": "R1"}, failing(IOError("reset"), calls))
+    assert len(calls) == 4
+
+
+def test_open_breaker_fails_fast():
+    calls = []
+    resilience = Resilience(retries=0, failure_threshold=0.5, min_calls=2, reset_timeout=60)
+    for _ in range(2):
+        with pytest.raises(IOError):
+            resilience.call("orderquery", {}, failing(IOError("reset"), calls))
+    with pytest.raises(CircuitOpenError):
+        resilience.call("orderquery", {}, failing(IOError("reset"), calls))
+    assert len(calls) == 2
+
+
+def test_deadline_exceeded_before_sending():
+    resilience = Resilience(deadline=0)
+    with pytest.raises(DeadlineExceededError):
+        resilience.call("orderquery", {}, lambda timeout: b"")
+
+
+def test_client_error_not_retried_nor_counted():
+    requests = pytest.importorskip("requests")
+
+    def http_error(status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(response=response)
+
+    resilience = Resilience(retries=2, backoff=0.001, min_calls=1)
+    calls = []
+    with pytest.raises(requests.HTTPError):
+        resilience.call("orderquery", {}, failing(http_error(400), calls))
+    assert len(calls) == 1
+    assert resilience.breaker("orderquery").state == CircuitBreaker.CLOSED
+    with pytest.raises(requests.HTTPError):
+        resilience.call("orderquery", {}, failing(http_error(503), calls))
+    assert len(calls) == 4
+    assert resilience.breaker("orderquery").state == CircuitBreaker.OPEN
+
+
+def test_hedged_request_returns_first_success():
+    started = []
+
+    def send(timeout):
+        started.append(timeout)
+        if len(started) == 1:
+            time.sleep(0.5)
+            return b"slow"
+        return b"fast"
+
+    resilience = Resilience(deadline=5, hedge_after=0.05)
+    assert resilience.call("orderquery", {}, send) == b"fast"
+    assert len(started) == 2
@@ -1,108 +1,661 @@
 # -*- coding: utf-8 -*-
-import hashlib
-import random
-import string
+import collections
+import sys
+import threading
 import time
-import urllib2
 
-import requests
+import wx_pay_xml
+from wx_pay_bill import BillReader
+from wx_pay_crypto import ReqInfoCipher
+from wx_pay_ids import default_generator
+from wx_pay_metrics import RESULT_FIELDS, Span, clock
+from wx_pay_resilience import endpoint_of
+from wx_pay_response import RESPONSE_TYPES, RefundNotify
+from wx_pay_sign import SIGN_TYPE_MD5, Signer
+from wx_pay_spec import API_BASE_URL, SPECS, RequestTemplate, SignedRequest
+from wx_pay_ssl import SSLContextCache
+from wx_pay_xml import ETree, text_type
 
 try:
-    from flask import request
+    import queue
 except ImportError:
-    request = None
+    import Queue as queue
 
-try:
-    from xml.etree import cElementTree as ETree
-except ImportError:
-    from xml.etree import ElementTree as ETree
+# 批量接口的单条结果，error 为该条请求抛出的异常，成功时为 None
+BulkResult = collections.namedtuple("BulkResult", ["key", "result", "error"])
 
 
 class WxPayError(Exception):
-    def __init__(self, msg):
+    def __init__(self, msg, raw=None):
+        """
+        :param raw: 接口返回的结果字典(若有)，可从中读取 err_code 等字段
+        """
         super(WxPayError, self).__init__(msg)
+        self.raw = raw
+
+    @property
+    def message(self):
+        # Python 3 的异常没有 message 属性，保留给按 Python 2 写法读取错误信息的调用方
+        return self.args[0] if self.args else u""
+
+    @property
+    def err_code(self):
+        return self.raw.get("err_code") if self.raw else None
+
+
+# 首次建立连接时才定义的类，导入 wx_pay 时不导入 requests
+_lazy_classes = {}
+
+
+def _adapter(ssl_context=None, **kwargs):
+    """
+    创建连接池适配器，传入 ssl_context 时使用已加载商户证书的 SSLContext 建立连接
+    """
+    from requests.adapters import HTTPAdapter
+    if ssl_context is None:
+        return HTTPAdapter(**kwargs)
+    cls = _lazy_classes.get("adapter")
+    if cls is None:
+        class SSLContextAdapter(HTTPAdapter):
+            def __init__(self, ssl_context, **kwargs):
+                self.ssl_context = ssl_context
+                super(SSLContextAdapter, self).__init__(**kwargs)
+
+            def init_poolmanager(self, *args, **kwargs):
+                kwargs["ssl_context"] = self.ssl_context
+                return super(SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+        cls = _lazy_classes["adapter"] = SSLContextAdapter
+    return cls(ssl_context, **kwargs)
+
+
+class HttpTransport(object):
+    """
+    带连接池的HTTPS传输层
+    普通接口共用一个keep-alive连接池，需要双向证书的接口按(cert, key)各使用一个连接池，
+    商户证书只在首次使用时加载为 SSLContext 并缓存，避免每次请求重新建立TCP连接、TLS握手以及重新加载商户证书
+
+    自定义传输层只需实现 post(url, data, cert=None, timeout=None) 并返回响应体，
+    requests 在首次发送请求时才导入
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True, timeout=20,
+                 ssl_contexts=None, verify=True):
+        """
+        :param pool_connections: 每个连接池缓存的主机数
+        :param pool_maxsize: 每个主机保持的最大连接数
+        :param pool_block: 连接数达到上限时是否阻塞等待空闲连接
+        :param keep_alive: 是否复用连接
+        :param timeout: 默认超时时间(秒)，也可传入(connect, read)元组
+        :param ssl_contexts: 商户证书缓存(wx_pay_ssl.SSLContextCache)，证书文件变化时自动重新加载
+        :param verify: 校验服务端证书使用的CA文件，默认为 requests 自带的CA，需要商户证书的请求同时使用 ssl_contexts 的 cafile
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.ssl_contexts = ssl_contexts if ssl_contexts is not None else SSLContextCache()
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._session = None
+        # {cert: (SSLContext, Session)}
+        self._ssl_sessions = {}
+
+    def _new_session(self, ssl_context=None):
+        import requests
+        session = requests.Session()
+        adapter = _adapter(ssl_context, pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                           pool_block=self.pool_block)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def session(self, cert=None):
+        if not cert:
+            session = self._session
+            if session is None:
+                with self._lock:
+                    if self._session is None:
+                        self._session = self._new_session()
+                    session = self._session
+            return session
+        context = self.ssl_contexts.get(cert)
+        entry = self._ssl_sessions.get(cert)
+        if entry is None or entry[0] is not context:
+            with self._lock:
+                stale = entry = self._ssl_sessions.get(cert)
+                if entry is None or entry[0] is not context:
+                    entry = self._ssl_sessions[cert] = (context, self._new_session(context))
+                else:
+                    stale = None
+            if stale is not None:
+                # 证书已重新加载，旧连接池不再使用
+                stale[1].close()
+        return entry[1]
+
+    def post(self, url, data, cert=None, timeout=None):
+        # 每次请求传入 verify，session.verify 会被 REQUESTS_CA_BUNDLE 环境变量覆盖
+        resp = self.session(cert).post(url, data=data, timeout=self._timeout(timeout), verify=self.verify)
+        resp.raise_for_status()
+        return resp.content
+
+    def _timeout(self, timeout):
+        """
+        调用方给出的超时(剩余超时预算)与默认超时取较小者
+        """
+        if timeout is None:
+            return self.timeout
+        if isinstance(self.timeout, tuple):
+            return tuple(min(t, timeout) for t in self.timeout)
+        return min(self.timeout, timeout)
+
+    def stream(self, url, data, cert=None, timeout=None, chunk_size=65536):
+        """
+        流式读取响应体，逐块产出
+        """
+        resp = self.session(cert).post(url, data=data, timeout=self._timeout(timeout), verify=self.verify,
+                                       stream=True)
+        resp.raise_for_status()
+        try:
+            for chunk in resp.iter_content(chunk_size):
+                yield chunk
+        finally:
+            resp.close()
+
+    def stats(self):
+        """
+        连接池统计，requests 为请求数，connections 为新建连接数，两者之差 reused 为复用连接的次数
+        """
+        with self._lock:
+            sessions = [self._session] + [entry[1] for entry in self._ssl_sessions.values()]
+        connections = requests_count = 0
+        sessions = [session for session in sessions if session is not None]
+        for session in sessions:
+            adapters = dict((id(adapter), adapter) for adapter in session.adapters.values())
+            for adapter in adapters.values():
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+                        requests_count += pool.num_requests
+        return {"requests": requests_count, "connections": connections, "reused": requests_count - connections}
+
+    def close(self):
+        with self._lock:
+            sessions = [self._session] + [entry[1] for entry in self._ssl_sessions.values()]
+            self._session = None
+            self._ssl_sessions = {}
+        for session in sessions:
+            if session is not None:
+                session.close()
 
 
 class WxPay(object):
-    def __init__(self, wx_app_id, wx_mch_id, wx_mch_key, wx_notify_url):
-        self.opener = urllib2.build_opener(urllib2.HTTPSHandler())
+    # 开启 metrics 时按阶段计时的接口方法
+    INSTRUMENTED = ("unified_order", "js_pay_api", "order_query", "close_order", "refund", "refund_query",
+                    "download_bill", "send_red_pack", "enterprise_payment", "swiping_card_payment", "reverse")
+
+    def __init__(self, wx_app_id, wx_mch_id, wx_mch_key, wx_notify_url, transport=None, timeout=20,
+                 sign_type=SIGN_TYPE_MD5, id_generator=None, metrics=None, resilience=None,
+                 api_cert_path=None, api_key_path=None, query_cache=None, response_types=False, base_url=None,
+                 single_flight=None, rate_limiter=None, prepay_cache=None):
+        """
+        :param transport: 传输层，默认为带连接池的 HttpTransport，多个WxPay实例可共用同一个
+        :param timeout: 默认传输层的超时时间(秒)
+        :param sign_type: 签名类型，MD5 或 HMAC-SHA256，也可在单次调用的参数中传入sign_type
+        :param id_generator: 自动生成商户单号使用的 IdGenerator，多进程部署时为每个进程指定不同的node_id，
+            未指定node_id时单号中以随机数字代替节点号与序号
+        :param metrics: 统计收集器(如 wx_pay_metrics.HistogramCollector)，传入后记录各接口每个阶段的耗时与返回码
+        :param resilience: 超时预算、重试、对冲与熔断策略(wx_pay_resilience.Resilience)
+        :param api_cert_path: 商户证书路径，指定后退款、红包、企业付款、撤销订单接口可不再传入证书路径
+        :param api_key_path: 商户证书私钥路径
+        :param query_cache: 订单查询、退款查询结果缓存(wx_pay_cache.QueryCache)
+        :param response_types: 为True时查询、下单、退款等接口返回 wx_pay_response 中的响应对象，
+            字段按需转换为数值、时间，仍支持字典式访问
+        :param base_url: 接口地址前缀，默认为 https://api.mch.weixin.qq.com，压测时可指向本地的模拟服务
+        :param single_flight: 合并相同的并发订单查询、退款查询(wx_pay_cache.SingleFlight)，
+            AsyncWxPay 使用 wx_pay_async.AsyncSingleFlight
+        :param rate_limiter: 按 (商户号, 接口) 限速(wx_pay_ratelimit.RateLimiter)，多个进程使用共享后端时共用额度，
+            令牌不足时等待，超过其 max_wait 时抛出 wx_pay_ratelimit.RateLimitError
+        :param prepay_cache: 统一下单结果缓存(wx_pay_cache.PrepayCache)，同一订单参数不变时复用未过期的 prepay_id
+        """
+        self.transport = transport or HttpTransport(timeout=timeout)
         self.WX_APP_ID = wx_app_id
         self.WX_MCH_ID = wx_mch_id
         self.WX_MCH_KEY = wx_mch_key
         self.WX_NOTIFY_URL = wx_notify_url
+        self.signer = Signer(wx_mch_key, sign_type)
+        self.refund_cipher = ReqInfoCipher(wx_mch_key)
+        self.base_url = (base_url or API_BASE_URL).rstrip("/")
+        self._templates = dict((name, RequestTemplate.compile(spec, self)) for name, spec in SPECS.items())
+        self.cert = (api_cert_path, api_key_path) if api_cert_path else None
+        self.id_generator = id_generator or default_generator
+        self.resilience = resilience
+        self.query_cache = query_cache
+        self.single_flight = single_flight
+        self.rate_limiter = rate_limiter
+        self.prepay_cache = prepay_cache
+        self.response_types = response_types
+        self.metrics = metrics
+        if metrics is not None:
+            self._spans = threading.local()
+            for name in self.INSTRUMENTED:
+                setattr(self, name, self._traced(name, getattr(self, name)))
 
     @staticmethod
     def user_ip_address():
+        # 应用使用flask时flask必然已导入，这里不为此导入flask
+        flask = sys.modules.get("flask")
+        request = getattr(flask, "request", None)
         return request.remote_addr if request else None
 
     @staticmethod
     def nonce_str(length=32):
-        char = string.ascii_letters + string.digits
-        return "".join(random.choice(char) for _ in range(length))
+        return default_generator.nonce_str(length)
 
     @staticmethod
     def to_utf8(raw):
-        return raw.encode("utf-8") if isinstance(raw, unicode) else raw
+        return raw.encode("utf-8") if isinstance(raw, text_type) else raw
 
     @staticmethod
-    def to_dict(content):
-        raw = {}
-        root = ETree.fromstring(content)
-        for child in root:
-            raw[child.tag] = child.text
-        return raw
+    def to_dict(content, keys=None):
+        return wx_pay_xml.to_dict(content, keys)
 
     @staticmethod
     def random_num(length):
-        digit_list = list(string.digits)
-        random.shuffle(digit_list)
-        return ''.join(digit_list[:length])
+        return default_generator.random_digits(length)
 
-    def sign(self, raw):
+    def sign(self, raw, sign_type=None):
         """
         生成签名
         参考微信签名生成算法
         https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=4_3
+
+        :param sign_type: 签名类型(MD5, HMAC-SHA256)，默认取参数中的sign_type，否则为实例的sign_type
+        """
+        return self.signer.sign(raw, sign_type)
+
+    def check(self, raw, sign_type=None):
+        """
+        验证签名是否正确，不会修改传入的字典
+        """
+        return self.signer.check(raw, sign_type)
+
+    def sign_many(self, payloads, sign_type=None):
+        """
+        批量生成签名
         """
-        raw = [(k, str(raw[k]) if isinstance(raw[k], (int, float)) else raw[k]) for k in sorted(raw.keys())]
-        s = "&".join("=".join(kv) for kv in raw if kv[1])
-        s += "&key={0}".format(self.WX_MCH_KEY)
-        return hashlib.md5(self.to_utf8(s)).hexdigest().upper()
+        return self.signer.sign_many(payloads, sign_type)
 
-    def check(self, raw):
+    def check_many(self, payloads, sign_type=None):
         """
-        验证签名是否正确
+        批量验证签名
         """
-        sign = raw.pop("sign")
-        return sign == self.sign(raw)
+        return self.signer.check_many(payloads, sign_type)
+
+    def _prepare(self, template, data):
+        """
+        按接口模板一次校验参数、补全默认参数并签名，各接口的定义见 wx_pay_spec.SPECS
+
+        :param data: 本次调用的参数，会写入自动生成的参数与签名
+        :return: SignedRequest
+        """
+        spec = template.spec
+        error = template.validate(data)
+        if error is not None:
+            raise WxPayError(error)
+        if spec.client_ip and "spbill_create_ip" not in data:
+            user_ip = self.user_ip_address()
+            if not user_ip:
+                raise WxPayError(u"当前未使用flask框架，" + spec.missing.format("spbill_create_ip"))
+            data["spbill_create_ip"] = user_ip
+        for field, kind in spec.generated:
+            if field not in data:
+                data[field] = self.id_generator.bill_no(self.WX_MCH_ID) if kind == "bill_no" \
+                    else self.id_generator.trade_no()
+        if "nonce_str" not in data:
+            data["nonce_str"] = self.nonce_str()
+
+        span = self._current_span()
+        if span is not None:
+            span.lap("validate")
+        sign_type = self.signer.sign_type_of(data, spec.sign_type)
+        if sign_type != SIGN_TYPE_MD5:
+            data.setdefault("sign_type", sign_type)
+        request = template.sign(data, self.signer, sign_type)
+        if span is not None:
+            span.lap("sign")
+        return request
+
+    def _call(self, name, data, api_cert_path=None, api_key_path=None):
+        """
+        构造请求并发送，按接口定义选择返回结果的检查方式与是否使用商户证书
+        """
+        template = self._templates[name]
+        request = self._prepare(template, data)
+        spec = template.spec
+        cert = self._cert(api_cert_path, api_key_path) if spec.ssl else None
+        if spec.check == "result":
+            handler = self._check_result
+        else:
+            handler = self._check_return if spec.check == "return" else None
+        return self._request(template.url, request, handler, cert=cert)
 
     def to_xml(self, raw):
-        s = ""
-        for k, v in raw.iteritems():
-            s += "<{0}>{1}</{0}>".format(k, self.to_utf8(v), k)
-        return "<xml>{0}</xml>".format(s)
+        if isinstance(raw, SignedRequest):
+            return raw.body
+        return wx_pay_xml.to_xml(raw)
 
     def fetch(self, url, data):
-        req = urllib2.Request(url, data=self.to_xml(data))
-        try:
-            resp = self.opener.open(req, timeout=20)
-        except urllib2.HTTPError, e:
-            resp = e
-        re_info = resp.read()
+        re_info = self._post(url, data, self.to_xml(data))
+        return self._decode(re_info, None, url)
+
+    def fetch_with_ssl(self, url, data, api_client_cert_path, api_client_key_path):
+        cert = (api_client_cert_path, api_client_key_path)
+        re_info = self._post(url, data, self.to_xml(data), cert)
+        return self._decode(re_info, cert, url)
+
+    def _post(self, url, data, body, cert=None):
+        if self.resilience is None:
+            self._throttle(url)
+            return self.transport.post(url, body, cert=cert)
+
+        def send(timeout):
+            # 限速等待计入本次请求的超时预算
+            timeout -= self._throttle(url, timeout)
+            return self.transport.post(url, body, cert=cert, timeout=timeout)
+        return self.resilience.call(endpoint_of(url), data, send)
+
+    def _reserve(self, url, budget=None):
+        """
+        取得限速令牌
+
+        :param budget: 本次请求剩余的超时预算(秒)，需要等待的时间超过预算时抛出 RateLimitError
+        :return: 发出请求前需要等待的秒数
+        """
+        if self.rate_limiter is None:
+            return 0
+        max_wait = self.rate_limiter.max_wait
+        if budget is not None:
+            max_wait = budget if max_wait is None else min(max_wait, budget)
+        wait = self.rate_limiter.reserve(self.WX_MCH_ID, endpoint_of(url), max_wait=max_wait)
+        if wait > 0 and self.metrics is not None:
+            self.metrics.count(endpoint_of(url), "ratelimit", "wait")
+        return wait
+
+    def _throttle(self, url, budget=None):
+        """
+        :return: 等待的秒数
+        """
+        wait = self._reserve(url, budget)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def _request(self, url, data, handler=None, cert=None):
+        """
+        发送请求并交给handler处理返回结果
+        各接口方法只负责参数校验与签名，网络请求统一经过这里
+
+        :param cert: 需要双向证书的接口传入 (api_cert_path, api_key_path)
+        """
+        span = self._current_span()
+        if span is not None:
+            return self._traced_request(span, url, data, handler, cert)
+        return self._send(url, data, handler, cert)
+
+    def _send(self, url, data, handler, cert):
+        """
+        AsyncWxPay 覆盖此方法返回可等待对象
+        """
+        if cert:
+            raw = self.fetch_with_ssl(url, data, *cert)
+        else:
+            raw = self.fetch(url, data)
+        return handler(raw) if handler else raw
+
+    def _decode(self, re_info, cert, url=None):
+        if cert:
+            return self.parse(re_info, url)
         try:
-            return self.to_dict(re_info)
+            return self.parse(re_info, url)
         except ETree.ParseError:
             return re_info
 
-    def fetch_with_ssl(self, url, data, api_client_cert_path, api_client_key_path):
-        req = requests.post(url, data=self.to_xml(data),
-                            cert=(api_client_cert_path, api_client_key_path))
-        return self.to_dict(req.content)
+    def parse(self, content, url=None):
+        """
+        解码接口返回的XML，开启 response_types 且该接口定义了响应类型时返回响应对象，否则返回字典
+        """
+        if self.response_types and url is not None:
+            response_type = RESPONSE_TYPES.get(endpoint_of(url))
+            if response_type is not None:
+                return response_type.from_xml(content)
+        return self.to_dict(content)
+
+    def _traced_request(self, span, url, data, handler, cert):
+        body = self.to_xml(data)
+        span.lap("encode")
+        re_info = self._post(url, data, body, cert)
+        span.lap("network")
+        raw = self._decode(re_info, cert, url)
+        span.lap("decode")
+        self._count_results(span.endpoint, raw)
+        try:
+            return handler(raw) if handler else raw
+        finally:
+            span.lap("handle")
+
+    def _current_span(self):
+        if self.metrics is None:
+            return None
+        stack = getattr(self._spans, "stack", None)
+        return stack[-1] if stack else None
+
+    def _traced(self, name, method):
+        def traced(*args, **kwargs):
+            stack = self._spans.__dict__.setdefault("stack", [])
+            span = Span(name)
+            stack.append(span)
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                self._finish_span(span, e)
+                raise
+            finally:
+                stack.pop()
+            return self._traced_result(span, result)
+        traced.__name__ = name
+        traced.__doc__ = method.__doc__
+        return traced
+
+    def _traced_result(self, span, result):
+        self._finish_span(span)
+        return result
+
+    def _finish_span(self, span, error=None):
+        span.phases["total"] = clock() - span.start
+        for phase, seconds in span.phases.items():
+            self.metrics.observe(span.endpoint, phase, seconds)
+        if error is not None:
+            self.metrics.count(span.endpoint, "exception", type(error).__name__)
+
+    def _count_results(self, endpoint, raw):
+        if isinstance(raw, dict):
+            for field in RESULT_FIELDS:
+                value = raw.get(field)
+                if value:
+                    self.metrics.count(endpoint, field, value)
+
+    def _resolved(self, value):
+        """
+        不经网络请求直接返回结果(如缓存命中)，AsyncWxPay 中返回可等待对象
+        """
+        return value
+
+    def _cached(self, name, endpoint, raw):
+        if raw is None:
+            return None
+        if self.metrics is not None:
+            self.metrics.count(name, "cache", "hit")
+        if self.response_types:
+            return RESPONSE_TYPES[endpoint].from_dict(raw)
+        return raw
+
+    def _then(self, result, callback):
+        return callback(result)
+
+    def _query(self, name, data):
+        """
+        发出查询请求，开启 single_flight 时相同商户、相同参数的并发查询共用一次请求
+        """
+        flights = self.single_flight
+        if flights is None:
+            return self._call(name, data)
+        key = (self.WX_MCH_ID, name, tuple(sorted((k, text_type(v)) for k, v in data.items())))
+        on_shared = None
+        if self.metrics is not None:
+            def on_shared():
+                self.metrics.count(name, "coalesce", "shared")
+        return flights.do(key, lambda: self._call(name, dict(data)), on_shared)
+
+    @staticmethod
+    def _bulk_kwargs(key, key_name):
+        return dict(key) if isinstance(key, dict) else {key_name: key}
+
+    def _run_many(self, func, keys, key_name, workers):
+        """
+        用有界线程池批量调用func，结果按完成顺序逐个产出
+        单条请求的异常记录在 BulkResult.error 中，不会中断整批请求
+        """
+        tasks = queue.Queue(workers * 2)
+        results = queue.Queue()
+        stop = threading.Event()
+        sentinel = object()
+        feed_error = []
+
+        def feed():
+            try:
+                for key in keys:
+                    if stop.is_set():
+                        break
+                    tasks.put(key)
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                for _ in range(workers):
+                    tasks.put(sentinel)
+
+        def work():
+            while True:
+                key = tasks.get()
+                if key is sentinel:
+                    results.put(sentinel)
+                    return
+                if stop.is_set():
+                    continue
+                try:
+                    results.put(BulkResult(key, func(**self._bulk_kwargs(key, key_name)), None))
+                except Exception as e:
+                    results.put(BulkResult(key, None, e))
+
+        threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for _ in range(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            done = 0
+            while done < workers:
+                item = results.get()
+                if item is sentinel:
+                    done += 1
+                else:
+                    yield item
+        finally:
+            stop.set()
+        if feed_error:
+            raise feed_error[0]
+
+    def _cert(self, api_cert_path, api_key_path):
+        if api_cert_path:
+            return api_cert_path, api_key_path
+        if self.cert is None:
+            raise WxPayError(u"缺少商户证书，请传入api_cert_path、api_key_path或在构造时指定")
+        return self.cert
+
+    @staticmethod
+    def _check_return(raw):
+        if raw["return_code"] == "FAIL":
+            raise WxPayError(raw["return_msg"], raw)
+        return raw
+
+    @classmethod
+    def _check_result(cls, raw):
+        cls._check_return(raw)
+        err_msg = raw.get("err_code_des")
+        if err_msg:
+            raise WxPayError(err_msg, raw)
+        return raw
 
     def reply(self, msg, ok=True):
         code = "SUCCESS" if ok else "FAIL"
         return self.to_xml(dict(return_code=code, return_msg=msg))
 
+    def parse_refund_notify(self, body):
+        """
+        解析退款结果通知，解密 req_info 后与外层字段合并
+        详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_16&index=10
+
+        退款结果通知不带签名，能用商户密钥解密出有效的XML即说明通知来自微信支付
+
+        :param body: 通知请求体(XML)
+        :return: 通知内容字典，开启 response_types 时为 wx_pay_response.RefundNotify
+        """
+        item = self.parse_refund_notify_many([body])[0]
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def parse_refund_notify_many(self, bodies):
+        """
+        批量解析退款结果通知，所有通知的 req_info 一次解密，用于处理先写入队列的大量通知
+
+        :return: [BulkResult(序号, 通知内容, 异常)]，与 bodies 一一对应
+        """
+        parsed = []
+        for body in bodies:
+            try:
+                pairs = wx_pay_xml.to_pairs(body)
+            except ETree.ParseError:
+                parsed.append((None, WxPayError(u"XML解析失败")))
+                continue
+            raw = dict(pairs)
+            if raw.get("return_code") != "SUCCESS":
+                parsed.append((None, WxPayError(raw.get("return_msg") or u"退款结果通知失败", raw)))
+            elif not raw.get("req_info"):
+                parsed.append((None, WxPayError(u"退款结果通知缺少req_info", raw)))
+            else:
+                parsed.append(([pair for pair in pairs if pair[0] != "req_info"], raw["req_info"]))
+        contents = iter(self.refund_cipher.decrypt_many([value for pairs, value in parsed if pairs is not None]))
+        results = []
+        for n, (pairs, value) in enumerate(parsed):
+            if pairs is None:
+                results.append(BulkResult(n, None, value))
+                continue
+            content = next(contents)
+            try:
+                info = wx_pay_xml.to_pairs(content) if content is not None else None
+            except ETree.ParseError:
+                info = None
+            if info is None:
+                results.append(BulkResult(n, None, WxPayError(u"req_info解密失败")))
+                continue
+            pairs += info
+            results.append(BulkResult(n, RefundNotify(pairs, bodies[n]) if self.response_types else dict(pairs), None))
+        return results
+
     def unified_order(self, **data):
         """
         统一下单
@@ -114,43 +667,17 @@ class WxPay(object):
             total_fee: 标价金额, 整数, 单位 分
             trade_type: 交易类型
             user_ip 在flask框架下可以自动填写, 非flask框架需传入spbill_create_ip
-        :return: 统一下单生成结果
+        :return: 统一下单生成结果，开启 prepay_cache 时同一订单参数不变的重复下单直接返回首次的结果
         """
-        url = "https://api.mch.weixin.qq.com/pay/unifiedorder"
-
-        # 必填参数
-        if "out_trade_no" not in data:
-            raise WxPayError(u"缺少统一支付接口必填参数out_trade_no")
-        if "body" not in data:
-            raise WxPayError(u"缺少统一支付接口必填参数body")
-        if "total_fee" not in data:
-            raise WxPayError(u"缺少统一支付接口必填参数total_fee")
-        if "trade_type" not in data:
-            raise WxPayError(u"缺少统一支付接口必填参数trade_type")
-
-        # 关联参数
-        if data["trade_type"] == "JSAPI" and "openid" not in data:
-            raise WxPayError(u"trade_type为JSAPI时，openid为必填参数")
-        if data["trade_type"] == "NATIVE" and "product_id" not in data:
-            raise WxPayError(u"trade_type为NATIVE时，product_id为必填参数")
-        user_ip = self.user_ip_address()
-        if not user_ip and "spbill_create_ip" not in data:
-            raise WxPayError(u"当前未使用flask框架，缺少统一支付接口必填参数spbill_create_ip")
-
-        data.setdefault("appid", self.WX_APP_ID)
-        data.setdefault("mch_id", self.WX_MCH_ID)
-        data.setdefault("notify_url", self.WX_NOTIFY_URL)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("spbill_create_ip", user_ip)
-        data.setdefault("sign", self.sign(data))
-
-        raw = self.fetch(url, data)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        err_msg = raw.get("err_code_des")
-        if err_msg:
-            raise WxPayError(err_msg)
-        return raw
+        cache = self.prepay_cache
+        if cache is None or not data.get("out_trade_no"):
+            return self._call("unified_order", data)
+        raw = self._cached("unified_order", "unifiedorder", cache.get(self.WX_MCH_ID, self.WX_APP_ID, data))
+        if raw is not None:
+            return self._resolved(raw)
+        params = dict(data)
+        return self._then(self._call("unified_order", data),
+                          lambda raw: cache.put(self.WX_MCH_ID, self.WX_APP_ID, params, raw))
 
     def js_pay_api(self, **kwargs):
         """
@@ -166,16 +693,22 @@ class WxPay(object):
         """
         kwargs.setdefault("trade_type", "JSAPI")
         if "out_trade_no" not in kwargs:
-            kwargs.setdefault("out_trade_no", self.nonce_str())
-        raw = self.unified_order(**kwargs)
+            kwargs.setdefault("out_trade_no", self.id_generator.trade_no())
+        return self._then(self.unified_order(**kwargs), self._js_pay_params)
+
+    def _js_pay_params(self, raw):
         package = "prepay_id={0}".format(raw["prepay_id"])
         timestamp = int(time.time())
         nonce_str = self.nonce_str()
+        sign_type = self.signer.sign_type
         raw = dict(appId=self.WX_APP_ID, timeStamp=timestamp,
-                   nonceStr=nonce_str, package=package, signType="MD5")
+                   nonceStr=nonce_str, package=package, signType=sign_type)
         sign = self.sign(raw)
-        return dict(package=package, appId=self.WX_APP_ID,
-                    timeStamp=timestamp, nonceStr=nonce_str, sign=sign)
+        params = dict(package=package, appId=self.WX_APP_ID,
+                      timeStamp=timestamp, nonceStr=nonce_str, sign=sign)
+        if sign_type != SIGN_TYPE_MD5:
+            params["signType"] = sign_type
+        return params
 
     def order_query(self, **data):
         """
@@ -187,19 +720,27 @@ class WxPay(object):
             transaction_id: 微信订单号
         :return: 订单查询结果
         """
-        url = "https://api.mch.weixin.qq.com/pay/orderquery"
-
-        if "out_trade_no" not in data and "transaction_id" not in data:
-            raise WxPayError(u"订单查询接口中，out_trade_no、transaction_id至少填一个")
-        data.setdefault("appid", self.WX_APP_ID)
-        data.setdefault("mch_id", self.WX_MCH_ID)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("sign", self.sign(data))
+        cache = self.query_cache
+        if cache is not None:
+            raw = self._cached("order_query", "orderquery", cache.get_order(self.WX_MCH_ID, data))
+            if raw is not None:
+                return self._resolved(raw)
+
+        result = self._query("order_query", data)
+        if cache is not None:
+            return self._then(result, lambda raw: cache.put_order(self.WX_MCH_ID, raw))
+        return result
+
+    def order_query_many(self, keys, key_name="out_trade_no", workers=8):
+        """
+        批量订单查询，以有界并发执行，结果按完成顺序逐个返回，单个订单出错不会中断整批查询
 
-        raw = self.fetch(url, data)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        return raw
+        :param keys: 可迭代的订单号，或 order_query 的参数字典(例如 dict(transaction_id=...))
+        :param key_name: keys 为订单号字符串时对应的参数名，out_trade_no 或 transaction_id
+        :param workers: 并发请求数
+        :return: BulkResult(key, result, error) 的生成器
+        """
+        return self._run_many(self.order_query, keys, key_name, workers)
 
     def close_order(self, out_trade_no):
         """
@@ -209,25 +750,33 @@ class WxPay(object):
         :param out_trade_no: 商户订单号
         :return: 申请关闭订单结果
         """
-        url = "https://api.mch.weixin.qq.com/pay/closeorder"
-        data = {
-            'out_trade_no': out_trade_no,
-            'appid': self.WX_APP_ID,
-            'mch_id': self.WX_MCH_ID,
-            'nonce_str': self.nonce_str(),
-        }
-        data["sign"] = self.sign(data)
-        raw = self.fetch(url, data)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        return raw
+        data = {'out_trade_no': out_trade_no}
+        if self.prepay_cache is not None:
+            self.prepay_cache.invalidate(self.WX_MCH_ID, self.WX_APP_ID, out_trade_no)
+        result = self._call("close_order", data)
+        if self.query_cache is not None:
+            return self._then(result, self._invalidate_order(data))
+        return result
+
+    def _invalidate_order(self, data):
+        """
+        关闭订单、申请退款前后清除该订单的查询缓存，返回请求成功后调用的回调
+        """
+        cache = self.query_cache
+        cache.invalidate_order(self.WX_MCH_ID, data)
 
-    def refund(self, api_cert_path, api_key_path, **data):
+        def invalidate(raw):
+            cache.invalidate_order(self.WX_MCH_ID, data)
+            return raw
+        return invalidate
+
+    def refund(self, api_cert_path=None, api_key_path=None, **data):
         """
         申请退款
         详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_4
 
-        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器
+        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器，
+            构造时已指定时可省略
         :param api_key_path: 微信支付商户证书路径，此证书(apiclient_key.pem)需要先到微信支付商户平台获取，下载后保存至服务器
         :param data: out_trade_no、transaction_id至少填一个, out_refund_no, total_fee, refund_fee
             out_trade_no: 商户订单号
@@ -237,26 +786,10 @@ class WxPay(object):
             refund_fee: 退款金额
         :return: 退款申请返回结果
         """
-        url = "https://api.mch.weixin.qq.com/secapi/pay/refund"
-        if "out_trade_no" not in data and "transaction_id" not in data:
-            raise WxPayError(u"订单查询接口中，out_trade_no、transaction_id至少填一个")
-        if "total_fee" not in data:
-            raise WxPayError(u"退款申请接口中，缺少必填参数total_fee")
-        if "refund_fee" not in data:
-            raise WxPayError(u"退款申请接口中，缺少必填参数refund_fee")
-        if "out_refund_no" not in data:
-            data.setdefault("out_refund_no", self.nonce_str())
-
-        data.setdefault("appid", self.WX_APP_ID)
-        data.setdefault("mch_id", self.WX_MCH_ID)
-        data.setdefault("op_user_id", self.WX_MCH_ID)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("sign", self.sign(data))
-
-        raw = self.fetch_with_ssl(url, data, api_cert_path, api_key_path)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        return raw
+        result = self._call("refund", data, api_cert_path, api_key_path)
+        if self.query_cache is not None:
+            return self._then(result, self._invalidate_order(data))
+        return result
 
     def refund_query(self, **data):
         """
@@ -273,20 +806,28 @@ class WxPay(object):
 
         :return: 退款查询结果
         """
-        url = "https://api.mch.weixin.qq.com/pay/refundquery"
-        if "out_refund_no" not in data and "out_trade_no" not in data \
-                and "transaction_id" not in data and "refund_id" not in data:
-            raise WxPayError(u"退款查询接口中，out_refund_no、out_trade_no、transaction_id、refund_id四个参数必填一个")
-
-        data.setdefault("appid", self.WX_APP_ID)
-        data.setdefault("mch_id", self.WX_MCH_ID)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("sign", self.sign(data))
+        cache = self.query_cache
+        if cache is not None:
+            raw = self._cached("refund_query", "refundquery", cache.get_refund(self.WX_MCH_ID, data))
+            if raw is not None:
+                return self._resolved(raw)
+
+        result = self._query("refund_query", data)
+        if cache is not None:
+            query = dict(data)
+            return self._then(result, lambda raw: cache.put_refund(self.WX_MCH_ID, query, raw))
+        return result
+
+    def refund_query_many(self, keys, key_name="out_trade_no", workers=8):
+        """
+        批量退款查询，以有界并发执行，结果按完成顺序逐个返回，单笔出错不会中断整批查询
 
-        raw = self.fetch(url, data)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        return raw
+        :param keys: 可迭代的单号，或 refund_query 的参数字典
+        :param key_name: keys 为单号字符串时对应的参数名，out_refund_no、out_trade_no、transaction_id、refund_id 之一
+        :param workers: 并发请求数
+        :return: BulkResult(key, result, error) 的生成器
+        """
+        return self._run_many(self.refund_query, keys, key_name, workers)
 
     def download_bill(self, bill_date, bill_type=None):
         """
@@ -298,24 +839,57 @@ class WxPay(object):
 
         :return: 数据流形式账单
         """
-        url = "https://api.mch.weixin.qq.com/pay/downloadbill"
+        return self._call("download_bill", self._bill_data(bill_date, bill_type))
+
+    @staticmethod
+    def _bill_data(bill_date, bill_type=None, tar_type=None):
         data = {
             'bill_date': bill_date,
             'bill_type': bill_type if bill_type else 'SUCCESS',
-            'appid': self.WX_APP_ID,
-            'mch_id': self.WX_MCH_ID,
-            'nonce_str': self.nonce_str()
         }
-        data['sign'] = self.sign(data)
-        raw = self.fetch(url, data)
-        return raw
+        if tar_type:
+            data['tar_type'] = tar_type
+        return data
+
+    def iter_bill(self, bill_date, bill_type=None, tar_type=None, chunk_size=65536):
+        """
+        流式下载并逐行解析对账单，内存占用与账单大小无关
+        详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_6
 
-    def send_red_pack(self, api_cert_path, api_key_path, **data):
+        :param bill_date: 对账单日期
+        :param bill_type: 账单类型(ALL-当日所有订单信息，[默认]SUCCESS-当日成功支付的订单, REFUND-当日退款订单)
+        :param tar_type: 压缩账单，传入GZIP时返回.gzip格式的压缩账单
+        :param chunk_size: 每次读取的字节数
+        :return: BillReader，迭代得到去除 ` 前缀的账单记录元组，字段名见 header，迭代结束后汇总数据见 summary
+        """
+        template = self._templates["download_bill"]
+        data = self._prepare(template, self._bill_data(bill_date, bill_type, tar_type))
+        return BillReader(self._bill_chunks(template.url, data, chunk_size), gzip=tar_type == "GZIP")
+
+    def _bill_chunks(self, url, data, chunk_size):
+        self._throttle(url)
+        stream = getattr(self.transport, "stream", None)
+        if stream is not None:
+            chunks = stream(url, self.to_xml(data), chunk_size=chunk_size)
+        else:
+            chunks = [self.transport.post(url, self.to_xml(data))]
+        chunks = iter(chunks)
+        first = next(chunks, b"")
+        if first.startswith(b"<xml>"):
+            # 下载失败时返回的是XML格式的错误信息
+            raw = self.to_dict(first + b"".join(chunks))
+            raise WxPayError(raw.get("return_msg") or raw.get("err_code_des"))
+        yield first
+        for chunk in chunks:
+            yield chunk
+
+    def send_red_pack(self, api_cert_path=None, api_key_path=None, **data):
         """
         发给用户微信红包
         详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/tools/cash_coupon.php?chapter=13_4&index=3
 
-        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器
+        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器，
+            构造时已指定时可省略
         :param api_key_path: 微信支付商户证书路径，此证书(apiclient_key.pem)需要先到微信支付商户平台获取，下载后保存至服务器
         :param data: send_name, re_openid, total_amount, wishing, client_ip, act_name, remark
             send_name: 商户名称 例如: 天虹百货
@@ -327,43 +901,15 @@ class WxPay(object):
             remark: 备注 例如: 猜越多得越多，快来抢！
         :return: 红包发放结果
         """
-        url = "https://api.mch.weixin.qq.com/mmpaymkttransfers/sendredpack"
-        if "send_name" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数send_name")
-        if "re_openid" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数re_openid")
-        if "total_amount" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数total_amount")
-        if "wishing" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数wishing")
-        if "client_ip" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数client_ip")
-        if "act_name" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数act_name")
-        if "remark" not in data:
-            raise WxPayError(u"向用户发送红包接口中，缺少必填参数remark")
-
-        data.setdefault("wxappid", self.WX_APP_ID)
-        data.setdefault("mch_id", self.WX_MCH_ID)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("mch_billno", u'{0}{1}{2}'.format(
-            self.WX_MCH_ID, time.strftime('%Y%m%d', time.localtime(time.time())), self.random_num(10)
-        ))
-        data.setdefault("total_num", 1)
-        data.setdefault("scene_id", 'PRODUCT_4')
-        data.setdefault("sign", self.sign(data))
-
-        raw = self.fetch_with_ssl(url, data, api_cert_path, api_key_path)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        return raw
+        return self._call("send_red_pack", data, api_cert_path, api_key_path)
 
-    def enterprise_payment(self, api_cert_path, api_key_path, **data):
+    def enterprise_payment(self, api_cert_path=None, api_key_path=None, **data):
         """
         使用企业对个人付款功能
         详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/tools/mch_pay.php?chapter=14_2
 
-        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器
+        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器，
+            构造时已指定时可省略
         :param api_key_path: 微信支付商户证书路径，此证书(apiclient_key.pem)需要先到微信支付商户平台获取，下载后保存至服务器
         :param data: openid, check_name, re_user_name, amount, desc, spbill_create_ip
             openid: 用户openid
@@ -374,33 +920,10 @@ class WxPay(object):
             spbill_create_ip: 调用接口的机器Ip地址, 注：此地址为服务器地址
         :return: 企业转账结果
         """
-        url = "https://api.mch.weixin.qq.com/mmpaymkttransfers/promotion/transfers"
-        if "openid" not in data:
-            raise WxPayError(u"企业付款申请接口中，缺少必填参数openid")
-        if "check_name" not in data:
-            raise WxPayError(u"企业付款申请接口中，缺少必填参数check_name")
-        if data['check_name'] and "re_user_name" not in data:
-            raise WxPayError(u"企业付款申请接口中，缺少必填参数re_user_name")
-        if "amount" not in data:
-            raise WxPayError(u"企业付款申请接口中，缺少必填参数amount")
-        if "desc" not in data:
-            raise WxPayError(u"企业付款申请接口中，缺少必填参数desc")
-        if "spbill_create_ip" not in data:
-            raise WxPayError(u"企业付款申请接口中，缺少必填参数spbill_create_ip")
-
-        data.setdefault("mch_appid", self.WX_APP_ID)
-        data.setdefault("mchid", self.WX_MCH_ID)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("partner_trade_no", u'{0}{1}{2}'.format(
-            self.WX_MCH_ID, time.strftime('%Y%m%d', time.localtime(time.time())), self.random_num(10)
-        ))
-        data['check_name'] = 'FORCE_CHECK' if data['check_name'] else 'NO_CHECK'
-        data.setdefault("sign", self.sign(data))
-
-        raw = self.fetch_with_ssl(url, data, api_cert_path, api_key_path)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        return raw
+        check_name = data.get("check_name")
+        if check_name is not None and check_name not in ("FORCE_CHECK", "NO_CHECK"):
+            data["check_name"] = "FORCE_CHECK" if check_name else "NO_CHECK"
+        return self._call("enterprise_payment", data, api_cert_path, api_key_path)
 
     def swiping_card_payment(self, **data):
         """
@@ -416,30 +939,20 @@ class WxPay(object):
             user_ip 在flask框架下可以自动填写, 非flask框架需传入spbill_create_ip
         :return: 统一下单生成结果
         """
-        url = "https://api.mch.weixin.qq.com/pay/micropay"
-
-        # 必填参数
-        if "body" not in data:
-            raise WxPayError(u"缺少刷卡支付接口必填参数body")
-        if "total_fee" not in data:
-            raise WxPayError(u"缺少刷卡支付接口必填参数total_fee")
-        if "out_trade_no" not in data:
-            data.setdefault("out_trade_no", self.nonce_str())
+        return self._call("swiping_card_payment", data)
 
-        user_ip = self.user_ip_address()
-        if not user_ip and "spbill_create_ip" not in data:
-            raise WxPayError(u"当前未使用flask框架，缺少刷卡支付接口必填参数spbill_create_ip")
-
-        data.setdefault("appid", self.WX_APP_ID)
-        data.setdefault("mch_id", self.WX_MCH_ID)
-        data.setdefault("nonce_str", self.nonce_str())
-        data.setdefault("spbill_create_ip", user_ip)
-        data.setdefault("sign", self.sign(data))
+    def reverse(self, api_cert_path=None, api_key_path=None, **data):
+        """
+        撤销订单
+        刷卡支付交易返回失败或支付系统超时，调用该接口撤销交易，返回 recall=Y 时需要再次调用
+        详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/micropay.php?chapter=9_11&index=3
 
-        raw = self.fetch(url, data)
-        if raw["return_code"] == "FAIL":
-            raise WxPayError(raw["return_msg"])
-        err_msg = raw.get("err_code_des")
-        if err_msg:
-            raise WxPayError(err_msg)
-        return raw
+        :param api_cert_path: 微信支付商户证书路径，此证书(apiclient_cert.pem)需要先到微信支付商户平台获取，下载后保存至服务器，
+            构造时已指定时可省略
+        :param api_key_path: 微信支付商户证书路径，此证书(apiclient_key.pem)需要先到微信支付商户平台获取，下载后保存至服务器
+        :param data: out_trade_no、transaction_id至少填一个
+            out_trade_no: 商户订单号
+            transaction_id: 微信订单号
+        :return: 撤销订单结果
+        """
+        return self._call("reverse", data, api_cert_path, api_key_path)
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+基于 asyncio 的微信支付客户端，需要 Python 3.5+ 以及 aiohttp
+
+AsyncWxPay 复用 WxPay 的参数校验、签名与XML处理，所有接口方法返回可等待对象:
+
+    async with AsyncWxPay(...) as wx_pay:
+        data = await wx_pay.order_query(out_trade_no=u'***商户订单号***')
+"""
+import asyncio
+
+import aiohttp
+
+from wx_pay import BulkResult, WxPay, WxPayError
+from wx_pay_bill import BillParser
+from wx_pay_poller import PAY, QUERY, MicropayPoller
+from wx_pay_resilience import IDEMPOTENT, DeadlineExceededError, Resilience, client_error, clock, endpoint_of
+from wx_pay_ssl import SSLContextCache
+
+
+class AsyncHttpTransport(object):
+    """
+    基于 aiohttp 的非阻塞传输层
+    所有请求共用一个连接池，双向证书接口按(cert, key)缓存SSL上下文，连接按SSL上下文分别复用
+    """
+
+    def __init__(self, limit=100, limit_per_host=0, keepalive_timeout=15, timeout=20, ssl_contexts=None,
+                 verify=True):
+        """
+        :param limit: 连接池最大连接数
+        :param limit_per_host: 每个主机的最大连接数，0为不限制
+        :param keepalive_timeout: 空闲连接保持时间(秒)
+        :param timeout: 默认超时时间(秒)，也可传入(connect, read)元组
+        :param ssl_contexts: 商户证书缓存(wx_pay_ssl.SSLContextCache)，证书文件变化时自动重新加载
+        :param verify: 不需要商户证书的请求校验服务端证书使用的CA文件，默认为系统CA
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.ssl_contexts = ssl_contexts if ssl_contexts is not None else SSLContextCache()
+        self.verify = verify
+        self._verify_context = None
+        self._session = None
+        self._requests = self._connections = 0
+
+    @staticmethod
+    def _client_timeout(timeout):
+        if isinstance(timeout, tuple):
+            return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        return aiohttp.ClientTimeout(total=timeout)
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_request_start)
+            trace.on_connection_create_end.append(self._on_connection_create_end)
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        return self._session
+
+    async def _on_request_start(self, session, context, params):
+        self._requests += 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        self._connections += 1
+
+    def stats(self):
+        """
+        连接池统计，格式同 HttpTransport.stats: requests 为请求数，connections 为新建连接数，
+        两者之差 reused 为复用连接的次数
+        """
+        return {"requests": self._requests, "connections": self._connections,
+                "reused": self._requests - self._connections}
+
+    def ssl_context(self, cert):
+        return self.ssl_contexts.get(cert)
+
+    def _request_kwargs(self, cert, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        elif isinstance(self.timeout, tuple):
+            timeout = tuple(min(t, timeout) for t in self.timeout)
+        else:
+            timeout = min(self.timeout, timeout)
+        kwargs = {"timeout": self._client_timeout(timeout)}
+        if cert:
+            kwargs["ssl"] = self.ssl_context(cert)
+        elif self.verify is not True:
+            if self._verify_context is None:
+                import ssl
+                self._verify_context = ssl.create_default_context(cafile=self.verify)
+            kwargs["ssl"] = self._verify_context
+        return kwargs
+
+    async def post(self, url, data, cert=None, timeout=None):
+        async with self.session().post(url, data=data, **self._request_kwargs(cert, timeout)) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def stream(self, url, data, cert=None, timeout=None, chunk_size=65536):
+        async with self.session().post(url, data=data, **self._request_kwargs(cert, timeout)) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncResilience(Resilience):
+    """
+    Resilience 的 asyncio 版本，对冲请求使用并发的 Task 而不是线程
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("retry_on", (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+        super(AsyncResilience, self).__init__(*args, **kwargs)
+
+    async def call(self, endpoint, data, send):
+        breaker = self.breaker(endpoint)
+        breaker.before()
+        retry = self.retryable(endpoint, data)
+        hedge = self.hedge_after if endpoint in IDEMPOTENT else None
+        expires = clock() + self.deadline
+        attempt = 0
+        while True:
+            remaining = expires - clock()
+            if remaining <= 0:
+                raise DeadlineExceededError(u"请求超出超时预算")
+            try:
+                if hedge is not None and hedge < remaining:
+                    result = await self._hedged(send, remaining, hedge)
+                else:
+                    result = await send(remaining)
+            except self.retry_on as e:
+                if client_error(e):
+                    breaker.record(True)
+                    raise
+                breaker.record(False)
+                if not retry or attempt >= self.retries:
+                    raise
+                wait = self.delay(attempt)
+                if clock() + wait >= expires:
+                    raise
+                await asyncio.sleep(wait)
+                attempt += 1
+                continue
+            except Exception:
+                breaker.record(True)
+                raise
+            breaker.record(True)
+            return result
+
+    async def _hedged(self, send, timeout, hedge_after):
+        pending = {asyncio.ensure_future(send(timeout))}
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if not done:
+            pending.add(asyncio.ensure_future(send(timeout - hedge_after)))
+        error = None
+        try:
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class AsyncBillReader(object):
+    """
+    对账单记录异步迭代器，用法: async for row in wx_pay.iter_bill(...)
+    """
+
+    def __init__(self, chunks, gzip=False):
+        self._chunks = chunks
+        self._parser = BillParser(gzip=gzip)
+
+    @property
+    def header(self):
+        return self._parser.header
+
+    @property
+    def summary(self):
+        return self._parser.summary
+
+    async def _rows(self):
+        async for chunk in self._chunks:
+            for row in self._parser.feed(chunk):
+                yield row
+        for row in self._parser.close():
+            yield row
+
+    def __aiter__(self):
+        return self._rows()
+
+
+class AsyncSingleFlight(object):
+    """
+    SingleFlight 的 asyncio 版本，相同键的并发调用共用一个 Task；
+    取消其中一个调用方不会取消共用的请求
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, func, on_shared=None):
+        """
+        :param func: 返回可等待对象的无参数调用
+        :return: 可等待对象
+        """
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._flights.pop(key, None) if self._flights.get(key) is done
+                                   else None)
+            return self._wait(task, False)
+        if on_shared is not None:
+            on_shared()
+        return self._wait(task, True)
+
+    @staticmethod
+    async def _wait(task, shared):
+        result = await asyncio.shield(task)
+        return dict(result) if shared and isinstance(result, dict) else result
+
+
+class AsyncWxPay(WxPay):
+    def __init__(self, wx_app_id, wx_mch_id, wx_mch_key, wx_notify_url, transport=None, timeout=20, **kwargs):
+        """
+        :param transport: 传输层，默认为 AsyncHttpTransport，多个AsyncWxPay实例可共用同一个
+        :param timeout: 默认传输层的超时时间(秒)
+        :param kwargs: 其余参数同 WxPay
+        """
+        super(AsyncWxPay, self).__init__(wx_app_id, wx_mch_id, wx_mch_key, wx_notify_url,
+                                         transport=transport or AsyncHttpTransport(timeout=timeout), **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        await self.transport.close()
+
+    async def fetch(self, url, data):
+        re_info = await self._post(url, data, self.to_xml(data))
+        return self._decode(re_info, None, url)
+
+    async def fetch_with_ssl(self, url, data, api_client_cert_path, api_client_key_path):
+        cert = (api_client_cert_path, api_client_key_path)
+        re_info = await self._post(url, data, self.to_xml(data), cert)
+        return self._decode(re_info, cert, url)
+
+    async def _post(self, url, data, body, cert=None):
+        """
+        resilience 需为 AsyncResilience
+        """
+        if self.resilience is None:
+            await self._throttle(url)
+            return await self.transport.post(url, body, cert=cert)
+
+        async def send(timeout):
+            timeout -= await self._throttle(url, timeout)
+            return await self.transport.post(url, body, cert=cert, timeout=timeout)
+        return await self.resilience.call(endpoint_of(url), data, send)
+
+    async def _throttle(self, url, budget=None):
+        if self.rate_limiter is None:
+            return 0
+        # 共享内存、Redis 后端取令牌时会阻塞，在线程池中执行以免阻塞事件循环
+        loop = asyncio.get_event_loop()
+        wait = await loop.run_in_executor(None, self._reserve, url, budget)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    async def _send(self, url, data, handler, cert):
+        if cert:
+            raw = await self.fetch_with_ssl(url, data, *cert)
+        else:
+            raw = await self.fetch(url, data)
+        return handler(raw) if handler else raw
+
+    async def _traced_request(self, span, url, data, handler, cert):
+        body = self.to_xml(data)
+        span.lap("encode")
+        re_info = await self._post(url, data, body, cert)
+        span.lap("network")
+        raw = self._decode(re_info, cert, url)
+        span.lap("decode")
+        self._count_results(span.endpoint, raw)
+        try:
+            return handler(raw) if handler else raw
+        finally:
+            span.lap("handle")
+
+    def _traced_result(self, span, result):
+        if not hasattr(result, "__await__"):
+            return super(AsyncWxPay, self)._traced_result(span, result)
+        return self._await_span(span, result)
+
+    async def _await_span(self, span, result):
+        try:
+            result = await result
+        except Exception as e:
+            self._finish_span(span, e)
+            raise
+        self._finish_span(span)
+        return result
+
+    async def _resolved(self, value):
+        return value
+
+    async def _then(self, result, callback):
+        return callback(await result)
+
+    def iter_bill(self, bill_date, bill_type=None, tar_type=None, chunk_size=65536):
+        template = self._templates["download_bill"]
+        data = self._prepare(template, self._bill_data(bill_date, bill_type, tar_type))
+        return AsyncBillReader(self._bill_chunks(template.url, data, chunk_size), gzip=tar_type == "GZIP")
+
+    async def _bill_chunks(self, url, data, chunk_size):
+        await self._throttle(url)
+        error, first = None, True
+        async for chunk in self.transport.stream(url, self.to_xml(data), chunk_size=chunk_size):
+            if error is not None:
+                error += chunk
+            elif first and chunk.startswith(b"<xml>"):
+                # 下载失败时返回的是XML格式的错误信息
+                error = chunk
+            else:
+                yield chunk
+            first = False
+        if error is not None:
+            raw = self.to_dict(error)
+            raise WxPayError(raw.get("return_msg") or raw.get("err_code_des"))
+
+    async def _run_one(self, func, key, key_name):
+        try:
+            return BulkResult(key, await func(**self._bulk_kwargs(key, key_name)), None)
+        except Exception as e:
+            return BulkResult(key, None, e)
+
+    async def _run_many(self, func, keys, key_name, workers):
+        """
+        最多同时保持workers个请求，结果按完成顺序逐个产出，用法: async for item in wx_pay.order_query_many(...)
+        """
+        pending = set()
+        try:
+            for key in keys:
+                if len(pending) >= workers:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.ensure_future(self._run_one(func, key, key_name)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class AsyncMicropayPoller(MicropayPoller):
+    """
+    asyncio 版本的刷卡支付轮询，每个订单一个协程，pay/submit 返回 asyncio.Task，结果为 PollResult
+
+        poller = AsyncMicropayPoller(async_wx_pay, "apiclient_cert.pem", "apiclient_key.pem")
+        result = await poller.pay(body=u"刷卡支付测试", total_fee=1, auth_code=u"***", spbill_create_ip="127.0.0.1")
+    """
+
+    def __init__(self, wx_pay, api_cert_path=None, api_key_path=None, workers=100, **kwargs):
+        """
+        :param workers: 同时进行的请求数上限，其余参数同 MicropayPoller
+        """
+        super(AsyncMicropayPoller, self).__init__(wx_pay, api_cert_path, api_key_path, workers=workers, **kwargs)
+        self._semaphore = None
+        self._tasks = set()
+
+    def pay(self, timeout=None, **data):
+        data.setdefault("out_trade_no", self.wx_pay.id_generator.trade_no())
+        return self._submit(data["out_trade_no"], data, PAY, timeout, 0)
+
+    def submit(self, out_trade_no, timeout=None, callback=None):
+        task = self._submit(out_trade_no, None, QUERY, timeout, self.interval)
+        if callback is not None:
+            task.add_done_callback(callback)
+        return task
+
+    def pending(self):
+        return len(self._tasks)
+
+    async def close(self, wait=True):
+        """
+        取消所有未完成的订单
+        """
+        self._closed = True
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if wait and tasks:
+            await asyncio.wait(tasks)
+
+    def _submit(self, out_trade_no, data, action, timeout, delay):
+        if self._closed:
+            raise RuntimeError(u"轮询已停止")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        order = self._new_order(out_trade_no, data, action, timeout)
+        task = asyncio.ensure_future(self._run(order, delay))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, order, delay):
+        while delay is not None:
+            await asyncio.sleep(delay)
+            try:
+                async with self._semaphore:
+                    raw, error = await self._call(order), None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                raw, error = None, e
+            delay = self._advance(order, raw, error)
+        if order.error is not None:
+            raise order.error
+        return order.result
+
+
+def notify_asgi_app(inbox):
+    """
+    将 wx_pay_notify.NotifyInbox 包装为ASGI应用，验签与写入队列(可能等待落盘)在线程池中执行，不阻塞事件循环;
+    收到 lifespan 事件时随应用启动、停止后台处理线程
+
+        application = notify_asgi_app(NotifyInbox(wx_pay, on_paid, "/data/notify.queue"))
+    """
+    async def app(scope, receive, send):
+        loop = asyncio.get_event_loop()
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    inbox.start()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await loop.run_in_executor(None, inbox.stop)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        chunks, more = [], True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            more = message.get("more_body", False)
+        reply = await loop.run_in_executor(None, inbox.handle, b"".join(chunks))
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/xml"),
+                                (b"content-length", str(len(reply)).encode("ascii"))]})
+        await send({"type": "http.response.body", "body": reply})
+    return app
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+对账单流式解析
+详细格式参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_6
+
+对账单为逗号分隔的文本，第一行为表头，每条记录的字段前带有 ` 字符，最后两行为汇总表头与汇总数据
+"""
+import zlib
+
+
+class BillParser(object):
+    """
+    增量解析器，按块喂入原始响应体，返回已完整解析的账单记录
+
+    账单记录为去除 ` 前缀后的字段元组，字段名见 header，汇总数据解析完成后见 summary
+    """
+
+    def __init__(self, gzip=False):
+        """
+        :param gzip: 响应体是否为 tar_type=GZIP 的压缩格式
+        """
+        self.header = None
+        self.summary_header = None
+        self.summary = None
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzip else None
+        self._buffer = b""
+
+    @staticmethod
+    def split(line):
+        return tuple(field[1:] if field.startswith(u"`") else field for field in line.split(u","))
+
+    def _parse_line(self, line):
+        line = line.rstrip(b"\r").decode("utf-8")
+        if not line:
+            return None
+        if self.header is None:
+            self.header = self.split(line.lstrip(u"\ufeff"))
+        elif line.startswith(u"`"):
+            if self.summary_header is not None:
+                self.summary = dict(zip(self.summary_header, self.split(line)))
+            else:
+                return self.split(line)
+        else:
+            self.summary_header = self.split(line)
+        return None
+
+    def feed(self, chunk):
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop()
+        rows = []
+        for line in lines:
+            row = self._parse_line(line)
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    def close(self):
+        if self._decompressor is not None:
+            self._buffer += self._decompressor.flush()
+        rows = []
+        for line in self._buffer.split(b"\n"):
+            row = self._parse_line(line)
+            if row is not None:
+                rows.append(row)
+        self._buffer = b""
+        return rows
+
+
+class BillReader(object):
+    """
+    对账单记录迭代器，内存占用只与单个数据块大小有关，与账单大小无关
+
+        bill = BillReader(chunks)
+        for row in bill:
+            ...
+        bill.summary
+    """
+
+    def __init__(self, chunks, gzip=False):
+        self._chunks = chunks
+        self._parser = BillParser(gzip=gzip)
+
+    @property
+    def header(self):
+        return self._parser.header
+
+    @property
+    def summary(self):
+        return self._parser.summary
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for row in self._parser.feed(chunk):
+                yield row
+        for row in self._parser.close():
+            yield row
+
+    def records(self):
+        """
+        以 {表头字段: 值} 字典形式逐条产出账单记录
+        """
+        for row in self:
+            yield dict(zip(self.header, row))
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+本地对账单存储
+
+每个商户每天每种账单类型下载一次，转换为按列保存的二进制文件，之后按需映射到内存读取，不再解析账单文本:
+
+    store = BillStore("/data/bills", wx_pay)
+    for bill_date, bill in store.scan("20240101", "20240131", bill_type="ALL"):
+        sum(bill.columns["total_fee"])
+    table = store.table("20240101", "20240131")     # wx_pay_reconcile.BillTable，用于对账
+
+文件路径为 root/商户号/账单类型/日期.wxb，文件格式(小端序):
+    8字节标识 WXBILL01 | 4字节目录长度 | 4字节填充 | JSON目录 | 按8字节对齐的各列数据
+目录中记录行数以及每列的类型与各段数据的 [偏移, 长度]，偏移从列数据开始处计算:
+    金额、时间列: values(int64)
+    编号列: values(uint16)，取值表 offsets(uint32, n+1) 与 blob(UTF-8)
+    文本列: offsets(uint32, 行数+1) 与 blob(UTF-8)
+"""
+import array
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from wx_pay_reconcile import CODE, COLUMNS, TEXT, BillTable, StringTable, bill_dates, fetch_bill
+
+MAGIC = b"WXBILL01"
+_HEADER = struct.Struct("<8sII")
+_LITTLE = sys.byteorder == "little"
+_INT64 = BillTable().columns["total_fee"].typecode
+
+
+def _padding(size):
+    return b"\0" * (-size % 8)
+
+
+def _to_bytes(values, typecode):
+    data = values if isinstance(values, array.array) else array.array(typecode, values)
+    if not _LITTLE:
+        data = array.array(typecode, data)
+        data.byteswap()
+    return data.tostring() if not hasattr(data, "tobytes") else data.tobytes()
+
+
+def _strings(values):
+    """
+    :return: (offsets uint32 字节串, blob 字节串)
+    """
+    offsets, blob, size = [0], [], 0
+    for value in values:
+        value = value.encode("utf-8")
+        blob.append(value)
+        size += len(value)
+        offsets.append(size)
+    return _to_bytes(offsets, "I"), b"".join(blob)
+
+
+def write_bill(path, table):
+    """
+    将 BillTable 写为列式文件，先写临时文件再改名，读取方不会看到写了一半的文件
+    """
+    sections, directory = [], {"rows": len(table), "columns": []}
+    offset = [0]
+
+    def add(data):
+        sections.append(data + _padding(len(data)))
+        start = offset[0]
+        offset[0] += len(sections[-1])
+        return [start, len(data)]
+
+    for name, kind, _ in COLUMNS:
+        column = table.columns[name]
+        if kind == TEXT:
+            offsets, blob = _strings(column)
+            entry = {"offsets": add(offsets), "blob": add(blob)}
+        elif kind == CODE:
+            offsets, blob = _strings(table.codes[name].values)
+            entry = {"values": add(_to_bytes(column, "H")), "offsets": add(offsets), "blob": add(blob)}
+        else:
+            entry = {"values": add(_to_bytes(column, _INT64))}
+        directory["columns"].append(dict(entry, name=name, kind=kind))
+
+    meta = json.dumps(directory, sort_keys=True).encode("utf-8")
+    meta += b" " * (-(_HEADER.size + len(meta)) % 8)
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=folder or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, len(meta), 0))
+            f.write(meta)
+            for data in sections:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class TextColumn(object):
+    """
+    映射到内存的文本列，按行解码
+    """
+    __slots__ = ("_offsets", "_data", "_base")
+
+    def __init__(self, offsets, data, base):
+        self._offsets = offsets
+        self._data = data
+        self._base = base
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        base, offsets = self._base, self._offsets
+        return self._data[base + offsets[row]:base + offsets[row + 1]].decode("utf-8")
+
+    def __iter__(self):
+        data, base, offsets = self._data, self._base, self._offsets
+        start = offsets[0] if len(offsets) else 0
+        for row in range(1, len(offsets)):
+            end = offsets[row]
+            yield data[base + start:base + end].decode("utf-8")
+            start = end
+
+
+class StoredBill(object):
+    """
+    映射到内存的一天账单，columns 与 codes 的用法与 BillTable 相同:
+    金额、时间、编号列为 memoryview(Python 2 下为数组)，文本列为按行解码的 TextColumn
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, _ = _HEADER.unpack(self._mmap[:_HEADER.size])
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError("not a bill file: {0}".format(path))
+        directory = json.loads(self._mmap[_HEADER.size:_HEADER.size + size].decode("utf-8"))
+        self._base = base = _HEADER.size + size
+        self.rows = directory["rows"]
+        self._memory = memoryview(self._mmap) if _LITTLE and hasattr(memoryview, "cast") else None
+        self._views = []
+        self.columns = {}
+        self.codes = {}
+        for column in directory["columns"]:
+            name, kind = column["name"], column["kind"]
+            if kind == TEXT:
+                self.columns[name] = TextColumn(self._array(column["offsets"], "I"), self._mmap,
+                                                base + column["blob"][0])
+                continue
+            if kind == CODE:
+                values = TextColumn(self._array(column["offsets"], "I"), self._mmap, base + column["blob"][0])
+                self.codes[name] = StringTable(values)
+                self.columns[name] = self._array(column["values"], "H")
+            else:
+                self.columns[name] = self._array(column["values"], _INT64)
+
+    def _array(self, section, typecode):
+        offset, length = section
+        offset += self._base
+        if self._memory is not None:
+            view = self._memory[offset:offset + length].cast(typecode)
+            self._views.append(view)
+            return view
+        data = array.array(typecode)
+        data.fromstring(self._mmap[offset:offset + length])
+        if not _LITTLE:
+            data.byteswap()
+        return data
+
+    def __len__(self):
+        return self.rows
+
+    def value(self, name, row):
+        value = self.columns[name][row]
+        return self.codes[name][value] if name in self.codes else value
+
+    def row(self, row):
+        return dict((name, self.value(name, row)) for name, _, _ in COLUMNS)
+
+    def table(self):
+        """
+        :return: 复制到内存中的 BillTable
+        """
+        table = BillTable()
+        table.extend(self)
+        return table
+
+    def close(self):
+        self.columns = {}
+        self.codes = {}
+        for view in self._views:
+            view.release()
+        self._views = []
+        if self._memory is not None:
+            self._memory.release()
+            self._memory = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # 调用方仍持有列的切片，映射在其释放后回收
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BillStore(object):
+    """
+    按 (商户号, 账单日期, 账单类型) 保存的本地账单，查询时只下载本地没有的日期
+    """
+    # 这几天内没有账单的日期不记录，账单可能尚未生成
+    RECENT_DAYS = 2
+
+    def __init__(self, root, wx_pay=None, workers=4, gzip=True):
+        """
+        :param root: 存储目录
+        :param wx_pay: 下载缺少的账单使用的WxPay实例，为None时只读取本地账单
+        :param workers: 同时下载的天数
+        :param gzip: 是否下载压缩账单
+        """
+        self.root = root
+        self.wx_pay = wx_pay
+        self.workers = workers
+        self.gzip = gzip
+
+    def _mch_id(self, mch_id):
+        if mch_id is None:
+            if self.wx_pay is None:
+                raise ValueError("mch_id is required when BillStore has no wx_pay")
+            mch_id = self.wx_pay.WX_MCH_ID
+        return mch_id
+
+    def path(self, bill_date, bill_type="ALL", mch_id=None):
+        return os.path.join(self.root, str(self._mch_id(mch_id)), bill_type, "{0}.wxb".format(bill_date))
+
+    def __contains__(self, key):
+        """
+        :param key: (bill_date, bill_type) 或 (bill_date, bill_type, mch_id)
+        """
+        return os.path.exists(self.path(*key))
+
+    def open(self, bill_date, bill_type="ALL", mch_id=None):
+        """
+        :return: 本地的 StoredBill，没有时返回None
+        """
+        path = self.path(bill_date, bill_type, mch_id)
+        return StoredBill(path) if os.path.exists(path) else None
+
+    def put(self, bill_date, table, bill_type="ALL", mch_id=None):
+        """
+        保存一天的账单，table 为 BillTable，没有账单的日期传入空的 BillTable
+        """
+        write_bill(self.path(bill_date, bill_type, mch_id), table)
+
+    def _download(self, bill_type):
+        today = datetime.date.today()
+
+        def download(bill_date):
+            table = fetch_bill(self.wx_pay, bill_date, bill_type, self.gzip)
+            if table is None:
+                day = datetime.datetime.strptime(bill_date, "%Y%m%d").date()
+                if (today - day).days <= self.RECENT_DAYS:
+                    return None
+                table = BillTable()
+            self.put(bill_date, table, bill_type)
+            return bill_date
+        return download
+
+    def sync(self, start, end, bill_type="ALL"):
+        """
+        下载日期区间内本地没有的账单
+
+        :return: 新下载的日期列表
+        """
+        missing = [d for d in bill_dates(start, end) if not os.path.exists(self.path(d, bill_type))]
+        if not missing:
+            return []
+        if self.wx_pay is None:
+            raise ValueError("BillStore has no wx_pay to download missing bills")
+        fetched = []
+        for item in self.wx_pay._run_many(self._download(bill_type), missing, "bill_date", self.workers):
+            if item.error is not None:
+                raise item.error
+            if item.result is not None:
+                fetched.append(item.result)
+        return sorted(fetched)
+
+    def scan(self, start, end, bill_type="ALL", mch_id=None):
+        """
+        按日期顺序产出 (账单日期, StoredBill)，有 wx_pay 时先下载本地没有的日期，仍然没有账单的日期跳过
+        """
+        if self.wx_pay is not None and (mch_id is None or str(mch_id) == str(self.wx_pay.WX_MCH_ID)):
+            self.sync(start, end, bill_type)
+        for bill_date in bill_dates(start, end):
+            bill = self.open(bill_date, bill_type, mch_id)
+            if bill is not None:
+                with bill:
+                    yield bill_date, bill
+
+    def table(self, start, end, bill_type="ALL", mch_id=None):
+        """
+        :return: 日期区间内全部账单合并的 BillTable
+        """
+        table = BillTable()
+        for _, bill in self.scan(start, end, bill_type, mch_id):
+            table.extend(bill)
+        return table
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+缓存后端
+
+后端需实现 get(key, default=None)、set(key, value, ttl=None)、add(key, value, ttl=None)、delete(key)，
+其中 add 仅在键不存在(或已过期)时写入并返回True，多进程共享时要求是原子操作
+
+QueryCache 缓存订单、退款查询结果，PrepayCache 缓存统一下单结果，SingleFlight 合并进程内相同的并发查询，只发出一次请求
+"""
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from wx_pay_sign import Signer
+
+
+class LRUCache(object):
+    """
+    进程内线程安全的有界LRU缓存，条目可设置过期时间
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        """
+        :param maxsize: 最大条目数，超出时淘汰最久未使用的条目
+        :param ttl: 默认过期时间(秒)，None为不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expire_at(self, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return time.time() + ttl if ttl is not None else None
+
+    def _get(self, key, now):
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+        if item[0] is not None and item[0] <= now:
+            return None
+        self._data[key] = item
+        return item
+
+    def _set(self, key, value, ttl):
+        self._data.pop(key, None)
+        self._data[key] = (self._expire_at(ttl), value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._get(key, time.time())
+        return default if item is None else item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._get(key, time.time()) is not None:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    """
+    基于Redis的共享缓存，多个进程/主机共用，值以JSON保存
+
+        RedisCache(redis.StrictRedis(host='localhost'), prefix='wx_pay:')
+    """
+
+    def __init__(self, client, prefix="wx_pay:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class QueryCache(object):
+    """
+    订单查询、退款查询结果缓存
+
+    订单进入终态(SUCCESS、CLOSED、REFUND、REVOKED、PAYERROR)后查询结果不再变化，缓存 terminal_ttl 秒；
+    未到终态的结果只缓存 pending_ttl 秒。支付结果通知、关闭订单、申请退款会更新或清除对应条目:
+
+        wx_pay = WxPay(..., query_cache=QueryCache())                       # 进程内LRU
+        wx_pay = WxPay(..., query_cache=QueryCache(RedisCache(client)))     # 多进程共享
+    """
+    ORDER_TERMINAL = frozenset(["SUCCESS", "CLOSED", "REFUND", "REVOKED", "PAYERROR"])
+    REFUND_TERMINAL = frozenset(["SUCCESS", "REFUNDCLOSE", "CHANGE"])
+    # 按这些字段查询时结果只对应一笔退款，终态后不再变化；按订单号查询时之后可能出现新的退款
+    REFUND_KEYS = ("out_refund_no", "refund_id", "out_trade_no", "transaction_id")
+
+    def __init__(self, backend=None, terminal_ttl=86400, pending_ttl=5, maxsize=100000):
+        """
+        :param backend: 缓存后端，默认为进程内 LRUCache(maxsize)
+        :param terminal_ttl: 终态结果的缓存时间(秒)
+        :param pending_ttl: 非终态结果的缓存时间(秒)，0为不缓存
+        """
+        self.backend = backend if backend is not None else LRUCache(maxsize=maxsize)
+        self.terminal_ttl = terminal_ttl
+        self.pending_ttl = pending_ttl
+
+    @staticmethod
+    def _key(kind, mch_id, field, value):
+        return u"{0}:{1}:{2}:{3}".format(kind, mch_id, field, value)
+
+    def _order_keys(self, mch_id, raw):
+        return [self._key("order", mch_id, field, raw[field])
+                for field in ("out_trade_no", "transaction_id") if raw.get(field)]
+
+    def _store(self, keys, raw, ttl):
+        if ttl:
+            for key in keys:
+                self.backend.set(key, raw, ttl)
+
+    def get_order(self, mch_id, data):
+        """
+        :param data: order_query 的参数
+        :return: 缓存的查询结果，未命中时返回None
+        """
+        keys = self._order_keys(mch_id, data)
+        raw = self.backend.get(keys[0]) if keys else None
+        return dict(raw) if raw is not None else None
+
+    def put_order(self, mch_id, raw):
+        """
+        缓存一次订单查询结果，查询失败(如订单不存在)的结果不缓存
+
+        :return: raw
+        """
+        if raw.get("return_code") == "SUCCESS" and raw.get("result_code") == "SUCCESS":
+            terminal = raw.get("trade_state") in self.ORDER_TERMINAL
+            self._store(self._order_keys(mch_id, raw), dict(raw), self.terminal_ttl if terminal else self.pending_ttl)
+        return raw
+
+    def prime_order(self, mch_id, notify):
+        """
+        用已验签的支付结果通知填充订单查询结果，通知内容与查询结果的字段基本一致，只缺少 trade_state
+        """
+        if notify.get("result_code") != "SUCCESS":
+            self.invalidate_order(mch_id, notify)
+            return
+        raw = dict((k, v) for k, v in notify.items() if k not in ("sign", "sign_type", "nonce_str"))
+        raw.setdefault("trade_state", "SUCCESS")
+        raw.setdefault("trade_state_desc", u"支付成功")
+        self._store(self._order_keys(mch_id, raw), raw, self.terminal_ttl)
+
+    def invalidate_order(self, mch_id, data):
+        """
+        :param data: 含 out_trade_no 或 transaction_id 的字典，同时清除该订单的按订单号退款查询结果
+        """
+        for field in ("out_trade_no", "transaction_id"):
+            if data.get(field):
+                self.backend.delete(self._key("order", mch_id, field, data[field]))
+                self.backend.delete(self._key("refund", mch_id, field, data[field]))
+
+    def _refund_key(self, mch_id, data):
+        for field in self.REFUND_KEYS:
+            if data.get(field):
+                return field, self._key("refund", mch_id, field, data[field])
+        return None, None
+
+    def get_refund(self, mch_id, data):
+        field, key = self._refund_key(mch_id, data)
+        raw = self.backend.get(key) if key is not None else None
+        return dict(raw) if raw is not None else None
+
+    def put_refund(self, mch_id, data, raw):
+        """
+        :param data: refund_query 的参数
+        :return: raw
+        """
+        field, key = self._refund_key(mch_id, data)
+        if key is not None and raw.get("return_code") == "SUCCESS" and raw.get("result_code") == "SUCCESS":
+            count = int(raw.get("refund_count") or 0)
+            states = [raw.get("refund_status_{0}".format(i)) for i in range(count)]
+            terminal = field in ("out_refund_no", "refund_id") and states and \
+                all(state in self.REFUND_TERMINAL for state in states)
+            self._store([key], dict(raw), self.terminal_ttl if terminal else self.pending_ttl)
+        return raw
+
+    def invalidate_refund(self, mch_id, data):
+        for field in self.REFUND_KEYS:
+            if data.get(field):
+                self.backend.delete(self._key("refund", mch_id, field, data[field]))
+
+
+class PrepayCache(object):
+    """
+    统一下单结果缓存，用户重新打开支付页面时复用仍在有效期内的 prepay_id，js_pay_api 只重新生成前端签名:
+
+        wx_pay = WxPay(..., prepay_cache=PrepayCache())                     # 进程内LRU
+        wx_pay = WxPay(..., prepay_cache=PrepayCache(RedisCache(client)))   # 多进程共享
+
+    按 (商户号, appid, 商户订单号) 保存一条结果及下单参数的摘要，参数(金额、商品描述等)变化时重新下单；
+    关闭订单时清除。prepay_id 有效期为2小时，条目在 ttl 秒后过期，默认提前10分钟
+    """
+    # 每次下单都会变化、不影响订单内容的参数
+    VOLATILE = frozenset(["nonce_str", "sign", "sign_type", "spbill_create_ip"])
+
+    def __init__(self, backend=None, ttl=6600, maxsize=10000):
+        """
+        :param backend: 缓存后端，默认为进程内 LRUCache(maxsize)
+        :param ttl: 下单结果的缓存时间(秒)，需小于 prepay_id 的有效期7200秒
+        """
+        self.backend = backend if backend is not None else LRUCache(maxsize=maxsize)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(mch_id, app_id, out_trade_no):
+        return u"prepay:{0}:{1}:{2}".format(mch_id, app_id, out_trade_no)
+
+    @classmethod
+    def digest(cls, data):
+        """
+        :param data: unified_order 的参数
+        :return: 除 VOLATILE 外的参数按签名规则拼接后的MD5
+        """
+        parts = Signer.parts(dict((k, v) for k, v in data.items() if k not in cls.VOLATILE))
+        return hashlib.md5(u"&".join(part for _, part in parts).encode("utf-8")).hexdigest()
+
+    def get(self, mch_id, app_id, data):
+        """
+        :return: 参数相同且未过期的下单结果，未命中时返回None
+        """
+        entry = self.backend.get(self._key(mch_id, app_id, data.get("out_trade_no")))
+        if entry is None or entry.get("digest") != self.digest(data):
+            return None
+        return dict(entry["raw"])
+
+    def put(self, mch_id, app_id, data, raw):
+        """
+        缓存下单成功的结果
+
+        :param data: 本次下单的参数
+        :return: raw
+        """
+        if raw.get("return_code") == "SUCCESS" and raw.get("result_code") == "SUCCESS" and raw.get("prepay_id"):
+            value = raw.to_dict() if hasattr(raw, "to_dict") else dict(raw)
+            self.backend.set(self._key(mch_id, app_id, data["out_trade_no"]),
+                             {"digest": self.digest(data), "raw": value}, self.ttl)
+        return raw
+
+    def invalidate(self, mch_id, app_id, out_trade_no):
+        self.backend.delete(self._key(mch_id, app_id, out_trade_no))
+
+
+class _Flight(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    相同键的并发调用只执行一次，执行期间到达的调用等待并共享其结果或异常，执行结束后的调用重新执行
+
+        wx_pay = WxPay(..., single_flight=SingleFlight())    # 多个WxPay实例可共用同一个
+
+    键包含商户号与查询参数，只合并同时进行中的请求，不会返回请求开始前已得到的结果；
+    共享的字典结果按调用方各复制一份，互不影响
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, func, on_shared=None):
+        """
+        :param func: 无参数的调用
+        :param on_shared: 共享了其他调用的结果时调用，用于统计
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if on_shared is not None:
+                on_shared()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return dict(flight.result) if isinstance(flight.result, dict) else flight.result
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
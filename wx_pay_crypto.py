@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+退款结果通知 req_info 的加解密
+详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_16&index=10
+
+req_info 为 AES-256-ECB(PKCS7填充) 加密后的 Base64 文本，密钥为商户API密钥MD5的32位小写十六进制串。
+AES 实现使用 cryptography，没有安装时使用 pycryptodome，均在首次解密时才导入
+"""
+import base64
+import binascii
+import hashlib
+
+from wx_pay_xml import text_type
+
+_BLOCK = 16
+
+
+def _aes_ecb(key):
+    """
+    :return: (解密函数, 加密函数)，参数为块对齐的字节串
+    """
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        from Crypto.Cipher import AES
+        cipher = AES.new(key, AES.MODE_ECB)
+        return cipher.decrypt, cipher.encrypt
+    cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+
+    def decrypt(data):
+        context = cipher.decryptor()
+        return context.update(data) + context.finalize()
+
+    def encrypt(data):
+        context = cipher.encryptor()
+        return context.update(data) + context.finalize()
+    return decrypt, encrypt
+
+
+def _unpad(data):
+    size = ord(data[-1:]) if data else 0
+    if not 0 < size <= _BLOCK or data[-size:] != data[-1:] * size:
+        return None
+    return data[:-size]
+
+
+class ReqInfoCipher(object):
+    """
+    密钥在构造时计算一次，AES 对象在首次使用时创建，之后每条通知只做解密
+    """
+
+    def __init__(self, key):
+        """
+        :param key: 商户API密钥
+        """
+        if isinstance(key, text_type):
+            key = key.encode("utf-8")
+        self._key = hashlib.md5(key).hexdigest().encode("ascii")
+        self._functions = None
+
+    def _aes(self):
+        if self._functions is None:
+            self._functions = _aes_ecb(self._key)
+        return self._functions
+
+    def decrypt(self, req_info):
+        """
+        :param req_info: Base64 文本
+        :return: 解密后的XML字节串，密文或填充无效时返回None
+        """
+        return self.decrypt_many([req_info])[0]
+
+    def decrypt_many(self, values):
+        """
+        批量解密，ECB 模式下各块互不依赖，所有密文拼接后一次解密再按长度拆分
+
+        :return: 与 values 一一对应的XML字节串列表，无效的密文对应None
+        """
+        chunks, sizes = [], []
+        for value in values:
+            try:
+                data = base64.b64decode(value) if value else b""
+            except (TypeError, ValueError, binascii.Error):
+                data = b""
+            if not data or len(data) % _BLOCK:
+                sizes.append(None)
+                continue
+            chunks.append(data)
+            sizes.append(len(data))
+        plain = self._aes()[0](b"".join(chunks)) if chunks else b""
+        result, offset = [], 0
+        for size in sizes:
+            if size is None:
+                result.append(None)
+                continue
+            result.append(_unpad(plain[offset:offset + size]))
+            offset += size
+        return result
+
+    def encrypt(self, content):
+        """
+        加密XML，用于在测试中构造退款结果通知
+
+        :return: Base64 文本
+        """
+        if isinstance(content, text_type):
+            content = content.encode("utf-8")
+        size = _BLOCK - len(content) % _BLOCK
+        data = self._aes()[1](content + bytes(bytearray([size]) * size))
+        return base64.b64encode(data).decode("ascii")
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+随机串与商户单号生成
+
+随机数全部来自 os.urandom，按块读取后映射到字符集并放入池中按需取用，映射时丢弃会造成分布偏差的字节。
+fork 出的子进程会丢弃从父进程继承的池，避免父子进程产生相同的随机串
+"""
+import os
+import string
+import threading
+import time
+
+ALPHANUMERIC = string.ascii_letters + string.digits
+DIGITS = string.digits
+
+
+def _translation(alphabet):
+    """
+    生成将随机字节映射到字符集的转换表，以及需要丢弃的字节
+    """
+    n = len(alphabet)
+    limit = 256 - 256 % n
+    chars = bytearray(alphabet.encode("ascii"))
+    table = bytearray(chars[i % n] if i < limit else 0 for i in range(256))
+    return bytes(table), bytes(bytearray(range(limit, 256)))
+
+
+class IdGenerator(object):
+    """
+    线程安全的随机串与单号生成器
+
+    bill_no/trade_no 由时间、节点号、每秒递增的序号组成，同一节点号内保证不重复，
+    多进程部署时给每个进程分配不同的 node_id(0-99) 即可保证跨进程不重复。
+    未指定 node_id 时以随机数字代替，不保证不重复: bill_no 当天约有 9*10^9 种取值，
+    当天生成 n 个单号时出现重复的概率约为 n^2 / (1.8*10^10)，例如一万个时约为0.5%
+    """
+
+    def __init__(self, node_id=None, pool_size=4096):
+        """
+        :param node_id: 节点号(0-99)，None为以随机数字代替节点号与序号
+        :param pool_size: 每次从 os.urandom 读取的字节数
+        """
+        if node_id is not None and not 0 <= node_id < 100:
+            raise ValueError("node_id must be in [0, 100)")
+        self.node_id = node_id
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._pools = {}
+        self._serials = {}
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def random_string(self, length=32, alphabet=ALPHANUMERIC):
+        """
+        :param length: 长度
+        :param alphabet: 字符集，不超过256个ASCII字符
+        """
+        with self._lock:
+            self._check_fork()
+            pool = self._pools.get(alphabet)
+            if pool is None:
+                pool = self._pools[alphabet] = [_translation(alphabet), b"", 0]
+            (table, delete), buf, pos = pool
+            while len(buf) - pos < length:
+                buf = buf[pos:] + os.urandom(max(self.pool_size, length * 2)).translate(table, delete)
+                pos = 0
+            pool[1], pool[2] = buf, pos + length
+        result = buf[pos:pos + length]
+        return result if isinstance(result, str) else result.decode("ascii")
+
+    def nonce_str(self, length=32):
+        return self.random_string(length, ALPHANUMERIC)
+
+    def random_digits(self, length):
+        return self.random_string(length, DIGITS)
+
+    def _next_serial(self, limit):
+        """
+        :param limit: 每秒可用的序号数，不同limit的序号各自独立计数
+        :return: (秒级时间戳, 该秒内的序号)，序号用完时释放锁等待下一秒
+        """
+        while True:
+            with self._lock:
+                self._check_fork()
+                serial = self._serials.setdefault(limit, [0, 0])
+                # 时钟回拨时沿用上次的时间，序号继续递增
+                now = max(int(time.time()), serial[0])
+                if now != serial[0]:
+                    serial[0], serial[1] = now, 0
+                if serial[1] < limit:
+                    serial[1] += 1
+                    return now, serial[1] - 1
+                wait = now + 1 - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+    def bill_no(self, mch_id):
+        """
+        生成红包 mch_billno / 企业付款 partner_trade_no
+        格式为 商户号 + yyyymmdd + 10位当天唯一数字(当天秒数5位 + 节点号2位 + 序号3位)；
+        未指定 node_id 时10位数字均为随机数，首位不为9(以9开头的留给 wx_pay_payout)
+        """
+        if self.node_id is None:
+            return u"{0}{1}{2}{3}".format(mch_id, time.strftime("%Y%m%d"), self.random_string(1, DIGITS[:9]),
+                                          self.random_digits(9))
+        now, seq = self._next_serial(1000)
+        t = time.localtime(now)
+        seconds = t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+        return u"{0}{1}{2:05d}{3:02d}{4:03d}".format(mch_id, time.strftime("%Y%m%d", t), seconds, self.node_id, seq)
+
+    def trade_no(self, prefix="", random_length=6):
+        """
+        生成 out_trade_no / out_refund_no
+        格式为 前缀 + yyyymmddHHMMSS + 节点号2位 + 序号6位 + 随机数字，不含前缀时长度为 22 + random_length；
+        未指定 node_id 时节点号与序号也由随机数字代替，长度不变
+
+        :param prefix: 前缀，注意商户单号总长度不能超过32位
+        :param random_length: 末尾随机数字的长度，使单号不可预测
+        """
+        if self.node_id is None:
+            return u"{0}{1}{2}".format(prefix, time.strftime("%Y%m%d%H%M%S"), self.random_digits(8 + random_length))
+        now, seq = self._next_serial(1000000)
+        return u"{0}{1}{2:02d}{3:06d}{4}".format(prefix, time.strftime("%Y%m%d%H%M%S", time.localtime(now)),
+                                                 self.node_id, seq, self.random_digits(random_length))
+
+
+default_generator = IdGenerator()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+多商户客户端注册表
+
+所有商户的客户端在注册时构造一次，共用同一个传输层(普通接口共用一个连接池，商户证书各自加载一次并缓存)，
+之后按商户号取客户端只是一次字典查找:
+
+    registry = MerchantRegistry()
+    registry.register("1900000109", "wx2421b1c4370ec43b", "WX_MCH_KEY", "http://www.example.com/pay/weixin/notify",
+                      api_cert_path="certs/1900000109/apiclient_cert.pem",
+                      api_key_path="certs/1900000109/apiclient_key.pem")
+    registry["1900000109"].refund(out_trade_no=u"***商户订单号***", total_fee=1, refund_fee=1)
+"""
+import threading
+
+from wx_pay import WxPay, WxPayError
+
+
+class MerchantRegistry(object):
+    def __init__(self, transport=None, client_class=WxPay, **client_kwargs):
+        """
+        :param transport: 所有商户共用的传输层，默认为首个注册的客户端创建的传输层
+        :param client_class: 客户端类，如 WxPay、wx_pay_async.AsyncWxPay
+        :param client_kwargs: 所有商户共用的构造参数(timeout、sign_type、metrics、resilience等)
+        """
+        self.transport = transport
+        self.client_class = client_class
+        self.client_kwargs = client_kwargs
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def register(self, mch_id, app_id, mch_key, notify_url, api_cert_path=None, api_key_path=None, **kwargs):
+        """
+        注册或更新一个商户，指定证书时立即加载
+
+        :param kwargs: 该商户单独的构造参数，覆盖 client_kwargs
+        :return: 该商户的客户端
+        """
+        options = dict(self.client_kwargs)
+        options.update(kwargs)
+        with self._lock:
+            client = self.client_class(app_id, mch_id, mch_key, notify_url, transport=self.transport,
+                                       api_cert_path=api_cert_path, api_key_path=api_key_path, **options)
+            if self.transport is None:
+                self.transport = client.transport
+            ssl_contexts = getattr(self.transport, "ssl_contexts", None)
+            if client.cert is not None and ssl_contexts is not None:
+                ssl_contexts.get(client.cert)
+            # 写时复制，查找不需要加锁
+            clients = dict(self._clients)
+            clients[str(mch_id)] = client
+            self._clients = clients
+        return client
+
+    def unregister(self, mch_id):
+        with self._lock:
+            clients = dict(self._clients)
+            client = clients.pop(str(mch_id), None)
+            self._clients = clients
+        ssl_contexts = getattr(self.transport, "ssl_contexts", None)
+        if client is not None and client.cert is not None and ssl_contexts is not None:
+            if not any(other.cert == client.cert for other in clients.values()):
+                ssl_contexts.discard(client.cert)
+        return client
+
+    def get(self, mch_id):
+        try:
+            return self._clients[mch_id]
+        except KeyError:
+            pass
+        try:
+            return self._clients[str(mch_id)]
+        except KeyError:
+            raise WxPayError(u"未注册的商户号: {0}".format(mch_id))
+
+    __getitem__ = get
+
+    def from_payload(self, raw):
+        """
+        按通知或响应内容中的 mch_id 取客户端，用于多商户共用一个通知地址时验签
+        """
+        return self.get(raw.get("mch_id"))
+
+    def __contains__(self, mch_id):
+        return str(mch_id) in self._clients
+
+    def __iter__(self):
+        return iter(list(self._clients))
+
+    def __len__(self):
+        return len(self._clients)
+
+    def close(self):
+        """
+        关闭共用的传输层，AsyncWxPay 时返回可等待对象
+        """
+        if self.transport is not None:
+            return self.transport.close()
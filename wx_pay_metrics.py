@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+接口耗时与结果统计
+
+WxPay(..., metrics=HistogramCollector()) 开启后，每次接口调用会按阶段记录耗时:
+    validate  参数校验与默认值填充
+    sign      签名
+    encode    XML编码
+    network   网络请求
+    decode    XML解码
+    handle    返回结果检查(return_code/err_code_des)
+    total     整个调用
+并统计 return_code、result_code、err_code 的取值次数。未开启时接口方法不做任何包装
+"""
+import threading
+import time
+
+PHASES = ("validate", "sign", "encode", "network", "decode", "handle", "total")
+RESULT_FIELDS = ("return_code", "result_code", "err_code")
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+class Span(object):
+    """
+    一次接口调用的计时，lap(phase) 将上一个计时点到现在的耗时记入phase
+    """
+    __slots__ = ("endpoint", "start", "mark", "phases")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = self.mark = clock()
+        self.phases = {}
+
+    def lap(self, phase):
+        now = clock()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.mark
+        self.mark = now
+
+
+class Collector(object):
+    """
+    统计收集器接口，可实现此接口对接 statsd、prometheus_client 等
+    """
+
+    def observe(self, endpoint, phase, seconds):
+        raise NotImplementedError
+
+    def count(self, endpoint, field, value):
+        raise NotImplementedError
+
+
+class HistogramCollector(Collector):
+    """
+    进程内直方图收集器，线程安全
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, endpoint, phase, seconds):
+        key = (endpoint, phase)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # [每个桶的计数..., 超出最大桶的计数, 总耗时]
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+    def count(self, endpoint, field, value):
+        key = (endpoint, field, value)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def histograms(self):
+        """
+        :return: {(endpoint, phase): (累计桶计数列表, 总次数, 总耗时)}，累计桶与 buckets 一一对应
+        """
+        with self._lock:
+            items = [(key, list(value)) for key, value in self._histograms.items()]
+        result = {}
+        for key, value in items:
+            cumulative, total = [], 0
+            for n in value[:-1]:
+                total += n
+                cumulative.append(total)
+            result[key] = (cumulative[:-1], total, value[-1])
+        return result
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def quantile(self, endpoint, phase, q):
+        """
+        按桶估算分位数，返回 q 分位所在桶的上界，超出最大桶时返回 inf
+        """
+        histogram = self.histograms().get((endpoint, phase))
+        if histogram is None or not histogram[1]:
+            return None
+        cumulative, total, _ = histogram
+        for bound, n in zip(self.buckets, cumulative):
+            if n >= q * total:
+                return bound
+        return float("inf")
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_prometheus(collector, transport=None, prefix="wx_pay"):
+    """
+    将 HistogramCollector 导出为 Prometheus 文本格式
+
+    :param transport: 提供 stats() 的传输层，同时导出连接复用情况
+    """
+    lines = [
+        "# HELP {0}_phase_seconds WxPay call latency by endpoint and phase.".format(prefix),
+        "# TYPE {0}_phase_seconds histogram".format(prefix),
+    ]
+    for (endpoint, phase), (cumulative, total, seconds) in sorted(collector.histograms().items()):
+        labels = 'endpoint="{0}",phase="{1}"'.format(_label(endpoint), _label(phase))
+        for bound, n in zip(collector.buckets, cumulative):
+            lines.append('{0}_phase_seconds_bucket{{{1},le="{2}"}} {3}'.format(prefix, labels, bound, n))
+        lines.append('{0}_phase_seconds_bucket{{{1},le="+Inf"}} {2}'.format(prefix, labels, total))
+        lines.append('{0}_phase_seconds_sum{{{1}}} {2!r}'.format(prefix, labels, seconds))
+        lines.append('{0}_phase_seconds_count{{{1}}} {2}'.format(prefix, labels, total))
+
+    lines.append("# HELP {0}_results_total WxPay result codes by endpoint.".format(prefix))
+    lines.append("# TYPE {0}_results_total counter".format(prefix))
+    for (endpoint, field, value), n in sorted(collector.counters().items()):
+        lines.append('{0}_results_total{{endpoint="{1}",field="{2}",value="{3}"}} {4}'.format(
+            prefix, _label(endpoint), _label(field), _label(value), n))
+
+    stats = getattr(transport, "stats", None)
+    if stats is not None:
+        lines.append("# HELP {0}_transport_connections WxPay transport connection pool usage.".format(prefix))
+        lines.append("# TYPE {0}_transport_connections gauge".format(prefix))
+        for name, value in sorted(stats().items()):
+            lines.append('{0}_transport_connections{{kind="{1}"}} {2}'.format(prefix, _label(name), value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+支付结果通知与退款结果通知处理
+详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_7
+退款结果通知参考 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_16&index=10
+
+同一笔交易的通知在收到SUCCESS应答前会被重复发送，NotifyHandler 负责解析、验签(退款结果通知为解密 req_info)、
+去重与应答，只有首次收到的通知才会交给业务回调处理
+
+NotifyInbox 验签后只把通知写入本地落盘的有界队列就立即应答，业务回调由后台线程池或进程池从队列中取出执行，
+失败时按退避时间重试，进程崩溃后重新打开同一个队列文件即可继续处理尚未完成的通知
+"""
+import collections
+import heapq
+import json
+import os
+import threading
+import time
+
+from wx_pay_cache import LRUCache
+from wx_pay_response import PayNotify, RefundNotify
+from wx_pay_xml import ParseError
+
+_PROCESSING = "processing"
+_DONE = "done"
+
+
+class NotifyHandler(object):
+    """
+    在Flask中使用:
+
+        handler = NotifyHandler(wx_pay, on_paid)
+
+        @app.route('/pay/weixin/notify', methods=['POST'])
+        def weixin_notify():
+            return handler.handle(request.data)
+    """
+
+    def __init__(self, wx_pay, callback, cache=None, ttl=86400, processing_ttl=60, key_field=None,
+                 query_cache=None, refund=False):
+        """
+        :param wx_pay: WxPay实例，用于解析、验签与生成应答
+        :param callback: 业务回调，参数为通知内容字典，抛出异常时应答FAIL，微信会稍后重发
+        :param cache: 去重缓存，默认为进程内 LRUCache，多进程部署可传入 RedisCache 等共享后端
+        :param ttl: 已处理通知的去重时间(秒)
+        :param processing_ttl: 处理中标记的过期时间(秒)，防止进程崩溃后通知永远被判定为处理中
+        :param key_field: 去重使用的字段，默认支付结果通知为 transaction_id，退款结果通知为 refund_id
+        :param query_cache: 订单查询缓存(wx_pay_cache.QueryCache)，默认使用 wx_pay.query_cache，
+            收到支付结果通知时用通知内容更新，收到退款结果通知时清除该订单的查询结果
+        :param refund: 为True时处理退款结果通知，解密 req_info 后交给业务回调
+        """
+        self.wx_pay = wx_pay
+        self.callback = callback
+        self.cache = cache if cache is not None else LRUCache(maxsize=100000)
+        self.ttl = ttl
+        self.processing_ttl = processing_ttl
+        self.refund = refund
+        self.key_field = key_field or ("refund_id" if refund else "transaction_id")
+        self.query_cache = query_cache if query_cache is not None else getattr(wx_pay, "query_cache", None)
+        self._notify_type = RefundNotify if refund else PayNotify
+        self._prefix = "refund_notify" if refund else "notify"
+
+    def _cache_key(self, raw):
+        key = raw.get(self.key_field)
+        if not key:
+            return None
+        return "{0}:{1}:{2}".format(self._prefix, raw.get("mch_id", ""), key)
+
+    def handle(self, body):
+        """
+        处理一次通知请求
+
+        :param body: 通知请求体(XML)
+        :return: 返回给微信的应答XML
+        """
+        return self.handle_many([body])[0]
+
+    def handle_many(self, bodies):
+        """
+        批量处理已收到的通知请求，退款结果通知的 req_info 一次解密，之后逐条去重并交给业务回调
+
+        :return: 与 bodies 一一对应的应答XML列表
+        """
+        return [reply if raw is None else self.dispatch(raw) for raw, reply in self._parse_many(bodies)]
+
+    def _parse_many(self, bodies):
+        """
+        :return: [(已验签的通知, None) 或 (None, 失败应答)]
+        """
+        reply = self.wx_pay.reply
+        if self.refund:
+            return [(item.result, None) if item.error is None else (None, reply(item.error.message, False))
+                    for item in self.wx_pay.parse_refund_notify_many(bodies)]
+        typed = getattr(self.wx_pay, "response_types", False)
+        parsed = []
+        for body in bodies:
+            try:
+                parsed.append(PayNotify.from_xml(body) if typed else self.wx_pay.to_dict(body))
+            except ParseError:
+                parsed.append(None)
+        signed = iter(self.wx_pay.check_many([raw for raw in parsed if raw is not None]))
+        result = []
+        for raw in parsed:
+            if raw is None:
+                result.append((None, reply(u"XML解析失败", False)))
+            elif not next(signed):
+                result.append((None, reply(u"签名失败", False)))
+            else:
+                result.append((raw, None))
+        return result
+
+    def _prime(self, raw):
+        if self.query_cache is None:
+            return
+        if self.refund:
+            self.query_cache.invalidate_order(self.wx_pay.WX_MCH_ID, raw)
+            self.query_cache.invalidate_refund(self.wx_pay.WX_MCH_ID, raw)
+        else:
+            self.query_cache.prime_order(self.wx_pay.WX_MCH_ID, raw)
+
+    def dispatch(self, raw):
+        """
+        对已验签的通知去重并交给业务回调
+        """
+        self._prime(raw)
+        cache_key = self._cache_key(raw)
+        if cache_key is not None and not self.cache.add(cache_key, _PROCESSING, self.processing_ttl):
+            if self.cache.get(cache_key) == _DONE:
+                return self.wx_pay.reply("OK", True)
+            # 同一通知正在处理中，应答FAIL让微信稍后重发，避免处理失败时丢失通知
+            return self.wx_pay.reply(u"处理中", False)
+        try:
+            self.callback(raw)
+        except Exception:
+            if cache_key is not None:
+                self.cache.delete(cache_key)
+            return self.wx_pay.reply(u"处理失败", False)
+        if cache_key is not None:
+            self.cache.set(cache_key, _DONE, self.ttl)
+        return self.wx_pay.reply("OK", True)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class NotifyQueue(object):
+    """
+    追加写入JSON行日志的有界持久化队列，put 返回时通知已写入磁盘
+
+    日志中依次记录 put(入队)、retry(处理失败待重试)、ack(处理完成)、dead(超过重试次数)、requeue(移出 dead_letters) 操作，
+    打开时重放日志恢复未完成的通知；已完成的条目累计超过 compact_every 条时重写日志文件
+    """
+
+    def __init__(self, path, maxsize=100000, sync=True, compact_every=10000):
+        """
+        :param path: 日志文件路径
+        :param maxsize: 未完成通知的数量上限，超过时 put 抛出 QueueFull
+        :param sync: put 是否等待落盘，并发写入的通知合并为一次 fsync
+        :param compact_every: 已完成多少条后重写日志文件
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.sync = sync
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._sync_lock = threading.Lock()
+        # {id: {"key", "data", "attempts", "error"}}
+        self._entries = {}
+        self._keys = {}
+        self._queue = collections.deque()
+        self._delayed = []
+        self._inflight = set()
+        self._dead = {}
+        self._next_id = 1
+        self._garbage = 0
+        self._written = self._synced = 0
+        self._partial = False
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, "a")
+        if self._partial:
+            # 崩溃时未写完的最后一行单独成行，之后追加的记录不会与其拼在一起
+            self._file.write("\n")
+        if self._garbage:
+            self.compact()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                self._partial = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 崩溃时未写完的最后一行
+                    continue
+                op, entry_id = entry.get("op"), entry.get("id")
+                if op == "put":
+                    self._entries[entry_id] = {"key": entry.get("key"), "data": entry["data"],
+                                               "attempts": entry.get("attempts", 0), "error": None}
+                    self._next_id = max(self._next_id, entry_id + 1)
+                    continue
+                if op == "dead" and entry_id in self._entries:
+                    self._dead[entry_id] = self._entries.pop(entry_id)
+                    self._dead[entry_id]["error"] = entry.get("error")
+                    continue
+                # 其余记录重写日志时都会被合并掉
+                self._garbage += 1
+                if op == "requeue":
+                    self._dead.pop(entry_id, None)
+                elif entry_id not in self._entries:
+                    continue
+                elif op == "retry":
+                    self._entries[entry_id]["attempts"] = entry["attempts"]
+                elif op == "ack":
+                    del self._entries[entry_id]
+        for entry_id in sorted(self._entries):
+            key = self._entries[entry_id]["key"]
+            if key is not None:
+                self._keys[key] = entry_id
+            self._queue.append(entry_id)
+
+    def _append(self, entries, sync):
+        lines = "".join(json.dumps(entry, sort_keys=True) + "\n" for entry in entries)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            self._written += 1
+            ticket = self._written
+        if sync:
+            self._sync(ticket)
+
+    def _sync(self, ticket):
+        with self._sync_lock:
+            if self._synced >= ticket:
+                # 其他线程的 fsync 已经包含了这次写入
+                return
+            target = self._written
+            os.fsync(self._file.fileno())
+            self._synced = target
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, data):
+        """
+        :param key: 去重键，相同键的通知未完成时不重复入队，None为不去重
+        :param data: 可JSON序列化的通知内容
+        :return: 入队返回True，相同键的通知已在队列中返回False
+        """
+        return self._put(key, data, [])
+
+    def _put(self, key, data, records):
+        """
+        :param records: 与入队记录在同一次写入中、写在其之前的日志记录
+        """
+        with self._lock:
+            if key is not None and key in self._keys:
+                entry_id = None
+            elif len(self._entries) >= self.maxsize:
+                raise QueueFull(self.path)
+            else:
+                entry_id = self._next_id
+                self._next_id += 1
+                self._entries[entry_id] = {"key": key, "data": data, "attempts": 0, "error": None}
+                if key is not None:
+                    self._keys[key] = entry_id
+        if entry_id is None:
+            if records:
+                self._append(records, self.sync)
+            return False
+        try:
+            self._append(records + [{"op": "put", "id": entry_id, "key": key, "data": data}], self.sync)
+        except Exception:
+            with self._lock:
+                self._entries.pop(entry_id, None)
+                if key is not None:
+                    self._keys.pop(key, None)
+            raise
+        with self._lock:
+            self._queue.append(entry_id)
+            self._ready.notify()
+        return True
+
+    def get(self, timeout=None):
+        """
+        取出一条待处理的通知，处理完成后调用 ack，失败时调用 retry 或 fail
+
+        :return: (id, key, data, 已失败次数)，超时返回None
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._queue.append(heapq.heappop(self._delayed)[1])
+                if self._queue:
+                    entry_id = self._queue.popleft()
+                    entry = self._entries[entry_id]
+                    self._inflight.add(entry_id)
+                    return entry_id, entry["key"], entry["data"], entry["attempts"]
+                wait = None if deadline is None else deadline - now
+                if self._delayed:
+                    wait = self._delayed[0][0] - now if wait is None else min(wait, self._delayed[0][0] - now)
+                if wait is not None and wait <= 0:
+                    return None
+                self._ready.wait(wait)
+
+    def _finish(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._inflight.discard(entry_id)
+        if entry["key"] is not None and self._keys.get(entry["key"]) == entry_id:
+            del self._keys[entry["key"]]
+        self._garbage += 1
+        return entry
+
+    def ack(self, entry_id):
+        with self._lock:
+            self._finish(entry_id)
+        # 完成记录丢失时只会重复处理一次，由去重缓存过滤，不需要落盘
+        self._append([{"op": "ack", "id": entry_id}], False)
+        if self._garbage >= self.compact_every:
+            with self._sync_lock:
+                # 其他线程可能已经重写过
+                if self._garbage >= self.compact_every:
+                    self._compact()
+
+    def retry(self, entry_id, delay, error=None):
+        with self._lock:
+            entry = self._entries[entry_id]
+            entry["attempts"] += 1
+            entry["error"] = error
+            self._inflight.discard(entry_id)
+            heapq.heappush(self._delayed, (time.time() + delay, entry_id))
+            attempts = entry["attempts"]
+            self._ready.notify()
+        self._append([{"op": "retry", "id": entry_id, "attempts": attempts}], False)
+
+    def fail(self, entry_id, error=None):
+        """
+        超过重试次数，转入 dead_letters，可用 requeue 重新处理
+        """
+        with self._lock:
+            entry = self._finish(entry_id)
+            entry["error"] = error
+            self._dead[entry_id] = entry
+        self._append([{"op": "dead", "id": entry_id, "error": error}], True)
+
+    def dead_letters(self):
+        """
+        :return: [(id, key, data, error)]
+        """
+        with self._lock:
+            return [(entry_id, entry["key"], entry["data"], entry["error"])
+                    for entry_id, entry in sorted(self._dead.items())]
+
+    def requeue(self, entry_id):
+        """
+        重新处理一条超过重试次数的通知，原条目的 requeue 记录与新的入队记录一起写入，重新打开后不会再出现在 dead_letters 中
+        """
+        with self._lock:
+            entry = self._dead.pop(entry_id)
+        try:
+            self._put(entry["key"], entry["data"], [{"op": "requeue", "id": entry_id}])
+        except Exception:
+            with self._lock:
+                self._dead[entry_id] = entry
+            raise
+        with self._lock:
+            self._garbage += 1
+
+    def compact(self):
+        """
+        只保留未完成与超过重试次数的条目，写入临时文件后替换原日志
+        """
+        with self._sync_lock:
+            self._compact()
+
+    def _compact(self):
+        with self._lock:
+            entries = []
+            for entry_id in sorted(self._entries):
+                entry = self._entries[entry_id]
+                entries.append({"op": "put", "id": entry_id, "key": entry["key"], "data": entry["data"],
+                                "attempts": entry["attempts"]})
+            for entry_id in sorted(self._dead):
+                entry = self._dead[entry_id]
+                entries.append({"op": "put", "id": entry_id, "key": entry["key"], "data": entry["data"]})
+                entries.append({"op": "dead", "id": entry_id, "error": entry["error"]})
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write("".join(json.dumps(entry, sort_keys=True) + "\n" for entry in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.rename(tmp, self.path)
+            self._file = open(self.path, "a")
+            self._garbage = 0
+            self._synced = self._written
+
+    def close(self):
+        with self._sync_lock:
+            with self._lock:
+                if not self._file.closed:
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._file.close()
+
+
+def _call(callback, raw):
+    callback(raw)
+
+
+class NotifyInbox(NotifyHandler):
+    """
+    验签后写入持久化队列并立即应答，业务回调在后台执行:
+
+        inbox = NotifyInbox(wx_pay, on_paid, "/data/notify.queue", workers=8)
+        inbox.start()
+        application = inbox.wsgi_app          # WSGI，ASGI 见 wx_pay_async.notify_asgi_app
+
+    队列已满时应答FAIL，微信稍后重发；回调抛出异常时按 retry_delay * 2^(失败次数) 秒后重试，
+    失败 max_attempts 次后转入 queue.dead_letters()
+    """
+
+    def __init__(self, wx_pay, callback, path, maxsize=100000, workers=4, processes=False, max_attempts=10,
+                 retry_delay=1.0, task_timeout=60, sync=True, **kwargs):
+        """
+        :param path: 队列日志文件路径，重启后使用同一个文件继续处理
+        :param maxsize: 队列中未完成通知的数量上限
+        :param workers: 执行回调的线程数或进程数
+        :param processes: 为True时每个工作线程在各自的子进程中执行回调，callback 需为可pickle的模块级函数
+        :param max_attempts: 回调最多执行的次数
+        :param retry_delay: 首次重试前的等待时间(秒)，之后每次翻倍
+        :param task_timeout: 子进程中单次回调的超时时间(秒)，超时时结束该子进程并按失败重试
+        :param sync: 应答前是否等待通知落盘
+        :param kwargs: 传给 NotifyHandler 的 cache、ttl、key_field、query_cache、refund
+        """
+        super(NotifyInbox, self).__init__(wx_pay, callback, **kwargs)
+        self.queue = NotifyQueue(path, maxsize=maxsize, sync=sync)
+        self.workers = workers
+        self.processes = processes
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.task_timeout = task_timeout
+        self._pools = []
+        self._pools_lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def dispatch(self, raw):
+        """
+        对已验签的通知去重并写入队列
+        """
+        self._prime(raw)
+        cache_key = self._cache_key(raw)
+        if cache_key is not None and self.cache.get(cache_key) == _DONE:
+            return self.wx_pay.reply("OK", True)
+        data = raw.to_dict() if hasattr(raw, "to_dict") else dict(raw)
+        try:
+            self.queue.put(cache_key, data)
+        except QueueFull:
+            return self.wx_pay.reply(u"系统繁忙", False)
+        return self.wx_pay.reply("OK", True)
+
+    def wsgi_app(self, environ, start_response):
+        """
+        WSGI应用，可直接挂载到通知地址
+        """
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        body = environ["wsgi.input"].read(length) if length > 0 else b""
+        reply = self.handle(body)
+        start_response("200 OK", [("Content-Type", "application/xml"), ("Content-Length", str(len(reply)))])
+        return [reply]
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        等待正在执行的回调完成后停止，队列中剩余的通知在下次 start 时继续处理
+        """
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        with self._pools_lock:
+            pools = list(self._pools)
+        for pool in pools:
+            self._discard_pool(pool)
+
+    def close(self):
+        self.stop()
+        self.queue.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _worker_pool(self):
+        """
+        每个工作线程使用自己的单进程进程池，超时时只需结束该线程的子进程
+        """
+        pool = getattr(self._local, "pool", None)
+        if pool is None:
+            import multiprocessing
+            pool = self._local.pool = multiprocessing.Pool(1)
+            with self._pools_lock:
+                self._pools.append(pool)
+        return pool
+
+    def _discard_pool(self, pool):
+        with self._pools_lock:
+            if pool in self._pools:
+                self._pools.remove(pool)
+        pool.terminate()
+        pool.join()
+
+    def _run(self, data):
+        raw = self._notify_type.from_dict(data) if getattr(self.wx_pay, "response_types", False) else data
+        if not self.processes:
+            self.callback(raw)
+            return
+        import multiprocessing
+        pool = self._worker_pool()
+        try:
+            pool.apply_async(_call, (self.callback, raw)).get(self.task_timeout)
+        except multiprocessing.TimeoutError:
+            # 超时的回调仍在子进程中执行，结束该进程后再按失败重试，避免同一通知的回调并发执行
+            self._local.pool = None
+            self._discard_pool(pool)
+            raise
+
+    def _work(self):
+        if self.processes:
+            self._worker_pool()
+        while not self._stopping.is_set():
+            item = self.queue.get(timeout=0.5)
+            if item is None:
+                continue
+            entry_id, cache_key, data, attempts = item
+            if cache_key is not None and self.cache.get(cache_key) == _DONE:
+                self.queue.ack(entry_id)
+                continue
+            try:
+                self._run(data)
+            except Exception as e:
+                error = u"{0}: {1}".format(type(e).__name__, e)
+                if attempts + 1 >= self.max_attempts:
+                    self.queue.fail(entry_id, error)
+                else:
+                    self.queue.retry(entry_id, self.retry_delay * (2 ** attempts), error)
+                continue
+            if cache_key is not None:
+                self.cache.set(cache_key, _DONE, self.ttl)
+            self.queue.ack(entry_id)
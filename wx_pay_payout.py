@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+可恢复的批量红包/企业付款
+
+    pipeline = PayoutPipeline(wx_pay, "campaign-2024.journal", kind=RED_PACK, batch_no=1, workers=16, qps=20)
+    for item in pipeline.run(records):
+        if item.error:
+            ...
+
+- 每条记录按在记录流中的序号生成确定的商户单号(mch_billno/partner_trade_no)，发出请求前先写入本地追加日志并落盘
+- 请求按 workers 并发执行，所有线程共用按商户的 qps 令牌桶
+- 网络错误与 SYSTEMERROR 等结果未知的错误用同一个商户单号重试，微信支付按商户单号识别为同一笔付款，不会重复付款
+- 进程崩溃或中断后，用同一个日志文件重新构造并传入同样的记录流即可继续，已写入日志的记录沿用日志中的单号与参数，
+  已有结果的记录不会再次发送
+"""
+import json
+import os
+import threading
+import time
+
+from wx_pay import BulkResult, WxPayError
+from wx_pay_ratelimit import TokenBucket
+
+RED_PACK = "red_pack"
+TRANSFER = "transfer"
+# 类型: (WxPay方法, 商户单号字段)
+KINDS = {
+    RED_PACK: ("send_red_pack", "mch_billno"),
+    TRANSFER: ("enterprise_payment", "partner_trade_no"),
+}
+# 结果未知，需要用原单号重试的错误码
+RETRY_CODES = frozenset(["SYSTEMERROR", "PROCESSING", "FREQ_LIMIT", "FREQUENCY_LIMITED"])
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+
+class PayoutJournal(object):
+    """
+    追加写入的JSON行日志，记录批次信息、每条付款的单号与参数以及最终结果
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.planned = []
+        self.finished = {}
+        self._lock = threading.Lock()
+        self._partial = False
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, "a")
+        if self._partial:
+            # 崩溃时未写完的最后一行单独成行，之后追加的记录不会与其拼在一起
+            self._file.write("\n")
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                self._partial = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 崩溃时未写完的最后一行
+                    continue
+                op = entry.get("op")
+                if op == "batch":
+                    self.header = entry
+                elif op == "plan":
+                    self.planned.append((entry["seq"], entry["id"], entry["data"]))
+                elif op == "result":
+                    self.finished[entry["id"]] = entry
+        self.planned.sort(key=lambda item: item[0])
+
+    def _write(self, entries, sync):
+        lines = "".join(json.dumps(entry, sort_keys=True) + "\n" for entry in entries)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def start(self, header):
+        self.header = dict(header, op="batch")
+        self._write([self.header], True)
+
+    def plan(self, items):
+        """
+        :param items: [(seq, id, data)]，落盘后才返回
+        """
+        self._write([{"op": "plan", "seq": seq, "id": bill_id, "data": data} for seq, bill_id, data in items], True)
+        self.planned.extend(items)
+
+    def finish(self, bill_id, status, err_code=None):
+        entry = {"op": "result", "id": bill_id, "status": status}
+        if err_code:
+            entry["err_code"] = err_code
+        # 结果丢失时只会用原单号再发送一次，不需要每条都落盘
+        self._write([entry], False)
+        with self._lock:
+            self.finished[bill_id] = entry
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+
+
+class PayoutPipeline(object):
+    def __init__(self, wx_pay, journal_path, kind=RED_PACK, batch_no=0, workers=8, qps=10, limiter=None,
+                 retries=3, backoff=0.5, sync_every=1000):
+        """
+        :param wx_pay: WxPay实例，需在构造时指定商户证书
+        :param journal_path: 日志文件路径，同一批次重启后使用同一个文件
+        :param kind: RED_PACK(发红包) 或 TRANSFER(企业付款)
+        :param batch_no: 批次号(0-999)，同一商户同一天的不同批次需使用不同批次号
+        :param workers: 并发请求数
+        :param qps: 该商户此接口的每秒请求数上限
+        :param limiter: 共用的限速器(wx_pay_ratelimit.TokenBucket)，同一商户的多个批次同时执行时传入同一个
+        :param retries: 结果未知时用原单号重试的次数，仍未知的记录留待下次恢复时处理
+        :param backoff: 首次重试前的等待时间(秒)，之后每次翻倍
+        :param sync_every: 每写入多少条单号落盘一次，这些记录落盘后才会发出请求
+        """
+        if kind not in KINDS:
+            raise ValueError("kind must be one of {0}".format(sorted(KINDS)))
+        if not 0 <= batch_no < 1000:
+            raise ValueError("batch_no must be in [0, 1000)")
+        self.wx_pay = wx_pay
+        self.kind = kind
+        self.method, self.id_field = KINDS[kind]
+        self.workers = workers
+        self.limiter = limiter or TokenBucket(qps)
+        self.retries = retries
+        self.backoff = backoff
+        self.sync_every = sync_every
+        self.journal = PayoutJournal(journal_path)
+        header = {"kind": kind, "mch_id": wx_pay.WX_MCH_ID, "batch_no": batch_no}
+        if self.journal.header is None:
+            self.journal.start(dict(header, date=time.strftime("%Y%m%d")))
+        elif any(self.journal.header.get(k) != v for k, v in header.items()):
+            raise WxPayError(u"日志文件属于其他批次: {0}".format(journal_path))
+        self.date = self.journal.header["date"]
+
+    def bill_id(self, seq):
+        """
+        第seq条记录的商户单号: 商户号 + yyyymmdd + 9 + 批次号3位 + 序号6位
+        与 IdGenerator.bill_no 长度相同；bill_no 的10位后缀以当天秒数(最大86399)开头，不会以9开头，两者不会重复
+        """
+        if seq >= 1000000:
+            raise WxPayError(u"单个批次最多1000000条记录")
+        return u"{0}{1}9{2:03d}{3:06d}".format(self.wx_pay.WX_MCH_ID, self.date, self.journal.header["batch_no"], seq)
+
+    def _entries(self, records):
+        """
+        先产出日志中尚无结果的记录，再为记录流中未写入日志的部分分配单号，分块落盘后产出；
+        缺少必填参数的记录在写入日志前抛出 WxPayError
+        """
+        template = self.wx_pay._templates[self.method]
+        finished = self.journal.finished
+        planned = list(self.journal.planned)
+        for item in planned:
+            if item[1] not in finished:
+                yield item
+        chunk = []
+        for seq, data in enumerate(records):
+            if seq < len(planned):
+                continue
+            data = dict(data)
+            data[self.id_field] = self.bill_id(seq)
+            error = template.validate(data)
+            if error is not None:
+                raise WxPayError(u"第{0}条记录: {1}".format(seq, error))
+            chunk.append((seq, data[self.id_field], data))
+            if len(chunk) >= self.sync_every:
+                self.journal.plan(chunk)
+                for item in chunk:
+                    yield item
+                chunk = []
+        if chunk:
+            self.journal.plan(chunk)
+            for item in chunk:
+                yield item
+
+    def _pay(self, entry):
+        seq, bill_id, data = entry
+        send = getattr(self.wx_pay, self.method)
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                raw = send(**dict(data))
+                if raw.get("result_code") == "SUCCESS":
+                    err_code, error = None, None
+                else:
+                    err_code = raw.get("err_code")
+                    error = WxPayError(raw.get("err_code_des") or err_code or u"付款结果未知", raw)
+            except WxPayError as e:
+                if e.raw is None:
+                    # 证书未配置等本地错误，请求未发出，不写入结果，修正后重新执行即可
+                    raise
+                # 未带 err_code 的(如 return_code 为 FAIL)结果未知
+                raw, err_code, error = None, e.err_code, e
+            except Exception as e:
+                # 网络错误，结果未知
+                raw, err_code, error = None, None, e
+            if error is None:
+                self.journal.finish(bill_id, SUCCESS)
+                return raw
+            if err_code is not None and err_code not in RETRY_CODES:
+                self.journal.finish(bill_id, FAILED, err_code)
+                raise error
+            if attempt >= self.retries:
+                raise error
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def run(self, records=()):
+        """
+        执行批次，结果按完成顺序逐个产出 BulkResult(商户单号, 返回结果, 异常)
+
+        :param records: 付款参数字典的可迭代对象(不含商户单号)，恢复时需传入同样顺序的记录流；
+            只处理日志中的剩余记录时可不传
+        """
+        for item in self.wx_pay._run_many(self._pay, self._entries(records), "entry", self.workers):
+            yield BulkResult(item.key[1], item.result, item.error)
+
+    def summary(self):
+        """
+        :return: {"planned": 已分配单号, "SUCCESS": 成功, "FAILED": 失败, "pending": 尚无结果}
+        """
+        result = {"planned": len(self.journal.planned), SUCCESS: 0, FAILED: 0}
+        for entry in list(self.journal.finished.values()):
+            result[entry["status"]] += 1
+        result["pending"] = result["planned"] - result[SUCCESS] - result[FAILED]
+        return result
+
+    def close(self):
+        self.journal.close()
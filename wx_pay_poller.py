@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+刷卡支付结果轮询
+详细规则参考 https://pay.weixin.qq.com/wiki/doc/api/micropay.php?chapter=5_4
+
+刷卡支付返回 USERPAYING(用户输入密码中)、SYSTEMERROR、BANKERROR 或网络错误时，需要轮询订单查询接口确认结果，
+超过时限仍未支付成功则调用撤销订单接口。MicropayPoller 用一个共享的调度堆与少量工作线程处理所有待确认订单，
+每个订单的查询间隔按 backoff 递增，结果通过 PollFuture 或回调返回:
+
+    poller = MicropayPoller(wx_pay, "apiclient_cert.pem", "apiclient_key.pem")
+    future = poller.pay(body=u"刷卡支付测试", total_fee=1, auth_code=u"***", spbill_create_ip="127.0.0.1")
+    future.add_done_callback(on_finished)
+    result = future.result()  # PollResult(out_trade_no, state, raw)
+"""
+import heapq
+import itertools
+import threading
+from collections import namedtuple
+
+from wx_pay import WxPayError
+from wx_pay_resilience import clock
+
+# state 为 SUCCESS 表示支付成功，REVERSED 表示超时后已撤销，其余为订单查询返回的终态 trade_state
+PollResult = namedtuple("PollResult", ["out_trade_no", "state", "raw"])
+
+PAY, QUERY, REVERSE = "pay", "query", "reverse"
+# 刷卡支付返回这些错误码时支付结果未知，需要轮询
+PENDING_CODES = frozenset(["USERPAYING", "SYSTEMERROR", "BANKERROR"])
+FAILED_STATES = frozenset(["PAYERROR", "CLOSED", "REVOKED", "REFUND"])
+REVERSED = "REVERSED"
+
+
+class PollFuture(object):
+    """
+    轮询结果，接口与 concurrent.futures.Future 的常用部分一致
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = self._error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        等待并返回 PollResult，轮询失败时抛出对应异常
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError(u"等待轮询结果超时")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError(u"等待轮询结果超时")
+        return self._error
+
+    def add_done_callback(self, fn):
+        """
+        :param fn: fn(future)，已完成时立即调用
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self._result, self._error = result, error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+
+class _Order(object):
+    __slots__ = ("out_trade_no", "data", "action", "deadline", "interval", "attempts", "result", "error",
+                 "future")
+
+    def __init__(self, out_trade_no, data, action, deadline, interval, future):
+        self.out_trade_no = out_trade_no
+        self.data = data
+        self.action = action
+        self.deadline = deadline
+        self.interval = interval
+        self.attempts = 0
+        self.result = self.error = None
+        self.future = future
+
+
+class MicropayPoller(object):
+    def __init__(self, wx_pay, api_cert_path=None, api_key_path=None, workers=4, interval=2.0, backoff=1.5,
+                 max_interval=10.0, timeout=30.0, reverse_retries=5):
+        """
+        :param wx_pay: WxPay实例
+        :param api_cert_path: 商户证书路径，撤销订单使用，WxPay构造时已指定证书时可省略
+        :param api_key_path: 商户证书密钥路径，撤销订单使用
+        :param workers: 工作线程数，即同时进行的请求数上限
+        :param interval: 首次查询前的等待时间(秒)
+        :param backoff: 每次查询后等待时间的增长倍数
+        :param max_interval: 最大等待时间(秒)
+        :param timeout: 默认的支付时限(秒)，超过后撤销订单
+        :param reverse_retries: 撤销订单失败或返回 recall=Y 时的最大重试次数
+        """
+        self.wx_pay = wx_pay
+        self.cert = (api_cert_path, api_key_path)
+        self.workers = workers
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.reverse_retries = reverse_retries
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    def pay(self, timeout=None, **data):
+        """
+        提交刷卡支付，参数同 WxPay.swiping_card_payment，支付请求也在工作线程中发出
+
+        :param timeout: 支付时限(秒)，默认使用构造参数 timeout
+        :return: PollFuture
+        """
+        data.setdefault("out_trade_no", self.wx_pay.id_generator.trade_no())
+        return self._submit(data["out_trade_no"], data, PAY, timeout, 0)
+
+    def submit(self, out_trade_no, timeout=None, callback=None):
+        """
+        轮询一笔已提交、结果未知的刷卡支付订单
+
+        :param out_trade_no: 商户订单号
+        :param timeout: 支付时限(秒)，从提交时开始计算
+        :param callback: callback(future)，订单结束时调用
+        :return: PollFuture
+        """
+        future = self._submit(out_trade_no, None, QUERY, timeout, self.interval)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def close(self, wait=True):
+        """
+        停止工作线程，未完成的订单以 RuntimeError 结束
+        """
+        with self._cond:
+            self._closed = True
+            orders, self._heap = [entry[2] for entry in self._heap], []
+            self._cond.notify_all()
+        for order in orders:
+            order.future._finish(error=RuntimeError(u"轮询已停止"))
+        if wait:
+            for t in self._threads:
+                if t is not threading.current_thread():
+                    t.join()
+
+    def _new_order(self, out_trade_no, data, action, timeout, future=None):
+        deadline = clock() + (self.timeout if timeout is None else timeout)
+        return _Order(out_trade_no, data, action, deadline, self.interval, future)
+
+    def _submit(self, out_trade_no, data, action, timeout, delay):
+        order = self._new_order(out_trade_no, data, action, timeout, PollFuture())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(u"轮询已停止")
+            if not self._threads:
+                self._start()
+            self._push(order, clock() + delay)
+        return order.future
+
+    def _start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="micropay-poller-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _push(self, order, due):
+        heapq.heappush(self._heap, (due, next(self._seq), order))
+        self._cond.notify()
+
+    def _next(self):
+        """
+        取出下一个到期的订单，已关闭时返回None
+        """
+        with self._cond:
+            while not self._closed:
+                if self._heap:
+                    wait = self._heap[0][0] - clock()
+                    if wait <= 0:
+                        return heapq.heappop(self._heap)[2]
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+        return None
+
+    def _work(self):
+        while True:
+            order = self._next()
+            if order is None:
+                return
+            try:
+                raw, error = self._call(order), None
+            except Exception as e:
+                raw, error = None, e
+            delay = self._advance(order, raw, error)
+            if delay is None:
+                order.future._finish(order.result, order.error)
+                continue
+            with self._cond:
+                closed = self._closed
+                if not closed:
+                    self._push(order, clock() + delay)
+            if closed:
+                order.future._finish(error=RuntimeError(u"轮询已停止"))
+
+    def _call(self, order):
+        if order.action == PAY:
+            return self.wx_pay.swiping_card_payment(**dict(order.data))
+        if order.action == QUERY:
+            return self.wx_pay.order_query(out_trade_no=order.out_trade_no)
+        return self.wx_pay.reverse(self.cert[0], self.cert[1], out_trade_no=order.out_trade_no)
+
+    def _advance(self, order, raw, error):
+        """
+        根据本次调用的结果更新订单状态
+
+        :return: 距下次调用的等待时间(秒)，订单结束时返回None，结果记录在 order.result/order.error
+        """
+        if order.action == PAY:
+            if error is None and raw.get("result_code") == "SUCCESS":
+                order.result = PollResult(order.out_trade_no, "SUCCESS", raw)
+                return None
+            if error is None:
+                error = WxPayError(raw.get("err_code_des") or u"刷卡支付失败", raw)
+            if isinstance(error, WxPayError) and error.err_code not in PENDING_CODES:
+                order.error = error
+                return None
+            # 支付结果未知(用户输入密码中、系统错误或网络错误)，转为轮询
+            order.action = QUERY
+            return self._wait(order)
+
+        if order.action == QUERY:
+            state = raw.get("trade_state") if error is None and raw.get("result_code") == "SUCCESS" else None
+            if state == "SUCCESS" or state in FAILED_STATES:
+                order.result = PollResult(order.out_trade_no, state, raw)
+                return None
+            if clock() < order.deadline:
+                return self._wait(order)
+            order.action = REVERSE
+            return 0
+
+        if error is None and raw.get("result_code") == "SUCCESS" and raw.get("recall") != "Y":
+            order.result = PollResult(order.out_trade_no, REVERSED, raw)
+            return None
+        order.attempts += 1
+        if error is None and raw.get("recall") != "Y":
+            order.error = WxPayError(raw.get("err_code_des") or u"撤销订单失败", raw)
+            return None
+        if order.attempts > self.reverse_retries:
+            order.error = error or WxPayError(u"撤销订单失败，需要人工处理", raw)
+            return None
+        return self._wait(order)
+
+    def _wait(self, order):
+        interval = order.interval
+        order.interval = min(interval * self.backoff, self.max_interval)
+        if order.action == QUERY:
+            # 最后一次查询恰好在时限到达时发出
+            interval = max(0, min(interval, order.deadline - clock()))
+        return interval
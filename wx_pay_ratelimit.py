@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+请求限速
+
+微信支付对红包、企业付款等接口有按商户的频率限制，超过后返回 FREQ_LIMIT 等错误，
+TokenBucket 在发出请求前按令牌桶限速，多个线程共用同一个实例即可共享额度；
+RateLimiter 按 (商户号, 接口) 限速，令牌桶保存在可替换的后端中，多进程、多机部署时共用同一份额度
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from wx_pay_resilience import clock
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: 每秒发放的令牌数(QPS)
+        :param burst: 桶容量，即允许的突发请求数，默认为 rate
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1, block=True):
+        """
+        取得令牌，不足时阻塞等待
+
+        :param block: 为False时令牌不足立即返回False
+        :return: 是否取得令牌
+        """
+        with self._lock:
+            self._refill(clock())
+            if self._tokens < tokens and not block:
+                return False
+            # 令牌不足时预支，等待时间按欠下的令牌数计算，保证多个线程排队时总速率不超过rate
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+class RateLimitError(RuntimeError):
+    """
+    限速器的 max_wait 内取不到令牌时抛出，wait 为需要等待的秒数
+    """
+
+    def __init__(self, msg, endpoint=None, wait=None):
+        super(RateLimitError, self).__init__(msg)
+        self.endpoint = endpoint
+        self.wait = wait
+
+
+def _take(bucket, now, rate, burst, tokens):
+    """
+    :param bucket: [令牌数, 更新时间]，按经过的时间补充令牌
+    :return: (取出后剩余令牌数, 需要等待的秒数)
+    """
+    bucket[0] = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+    bucket[1] = now
+    left = bucket[0] - tokens
+    return left, -left / rate if left < 0 else 0.0
+
+
+class LocalBuckets(object):
+    """
+    进程内的令牌桶存储，RateLimiter 的默认后端
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {key: [令牌数, 更新时间]}
+        self._buckets = {}
+
+    def reserve(self, key, rate, burst, tokens=1, max_wait=None):
+        """
+        取得令牌，不足时按欠下的令牌数预支
+
+        :param max_wait: 需要等待的时间超过该值时不预支，None为不限
+        :return: (是否取得, 需要等待的秒数)
+        """
+        with self._lock:
+            now = clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [burst, now]
+            left, wait = _take(bucket, now, rate, burst, tokens)
+            if max_wait is not None and wait > max_wait:
+                return False, wait
+            bucket[0] = left
+            return True, wait
+
+
+class SharedMemoryBuckets(object):
+    """
+    同一台机器上多个进程共用的令牌桶，保存在映射到内存的文件中，gunicorn 等多进程部署时各进程传入同一个路径:
+
+        SharedMemoryBuckets("/dev/shm/wx_pay_ratelimit")
+
+    文件由 slots 个槽组成，每个槽为 键的哈希(uint64) | 令牌数(double) | 更新时间(double)，按哈希线性探测；
+    读写时以 fcntl 文件锁在进程间互斥，同一进程的线程间以线程锁互斥。
+    时间使用单调时钟，在同一台机器的进程间一致
+    """
+    _SLOT = struct.Struct("=Qdd")
+
+    def __init__(self, path, slots=1024):
+        """
+        :param path: 文件路径，建议放在 /dev/shm 等内存文件系统中
+        :param slots: 最多保存的 (商户号, 接口) 数，使用同一文件的进程需一致
+        """
+        import fcntl
+        self._fcntl = fcntl
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        size = slots * self._SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._mmap = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    @staticmethod
+    def _hash(key):
+        value = struct.unpack("=Q", hashlib.md5(key.encode("utf-8")).digest()[:8])[0]
+        return value or 1
+
+    def _find(self, key_hash):
+        """
+        :return: 该键所在或可以使用的槽的偏移
+        """
+        size, data = self._SLOT.size, self._mmap
+        start = key_hash % self.slots
+        for i in range(self.slots):
+            offset = (start + i) % self.slots * size
+            found = struct.unpack_from("=Q", data, offset)[0]
+            if found == key_hash or found == 0:
+                return offset
+        raise RuntimeError("rate limit slots are full: {0}".format(self.path))
+
+    def reserve(self, key, rate, burst, tokens=1, max_wait=None):
+        """
+        参数与返回值同 LocalBuckets.reserve
+        """
+        key_hash = self._hash(key)
+        with self._lock:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX)
+            try:
+                now = clock()
+                offset = self._find(key_hash)
+                found, stored, updated = self._SLOT.unpack_from(self._mmap, offset)
+                bucket = [stored, updated] if found else [burst, now]
+                left, wait = _take(bucket, now, rate, burst, tokens)
+                if max_wait is not None and wait > max_wait:
+                    return False, wait
+                self._SLOT.pack_into(self._mmap, offset, key_hash, left, now)
+                return True, wait
+            finally:
+                self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if not self._mmap.closed:
+                self._mmap.close()
+                os.close(self._fd)
+
+
+class RedisBuckets(object):
+    """
+    基于Redis的令牌桶，多台机器共用，时间取Redis服务器时间，每次预支为一次脚本调用:
+
+        RedisBuckets(redis.StrictRedis(host='localhost'), prefix='wx_pay:ratelimit:')
+    """
+    SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate, burst, tokens = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local stored = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+stored = math.min(burst, stored + math.max(0, now - updated) * rate)
+local left = stored - tokens
+local wait = 0
+if left < 0 then wait = -left / rate end
+if max_wait >= 0 and wait > max_wait then return {0, tostring(wait)} end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(left), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - left) / rate) + 1)
+return {1, tostring(wait)}
+"""
+
+    def __init__(self, client, prefix="wx_pay:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def reserve(self, key, rate, burst, tokens=1, max_wait=None):
+        """
+        参数与返回值同 LocalBuckets.reserve
+        """
+        granted, wait = self._script(keys=[self.prefix + key],
+                                     args=[rate, burst, tokens, -1 if max_wait is None else max_wait])
+        return bool(granted), float(wait)
+
+
+class RateLimiter(object):
+    """
+    按 (商户号, 接口) 限速，传给 WxPay(rate_limiter=...) 后每次发出请求前取得令牌(重试、对冲请求同样计数)
+
+        limiter = RateLimiter({"sendredpack": 10, "transfers": (5, 10)},
+                              backend=SharedMemoryBuckets("/dev/shm/wx_pay_ratelimit"))
+
+    接口名为请求地址的最后一段(sendredpack、transfers、downloadbill等)，rates 中没有的接口不限速
+    """
+
+    def __init__(self, rates, backend=None, max_wait=None):
+        """
+        :param rates: {接口名: 每秒请求数 或 (每秒请求数, 突发请求数)}，按微信支付对该商户的频率限制配置
+        :param backend: 令牌桶存储，默认为进程内的 LocalBuckets，多进程共用 SharedMemoryBuckets，多机共用 RedisBuckets
+        :param max_wait: 令牌不足时最多等待的秒数，超过时抛出 RateLimitError；None为一直等待，0为不等待
+        """
+        self.rates = {}
+        for endpoint, rate in rates.items():
+            rate, burst = rate if isinstance(rate, (tuple, list)) else (rate, None)
+            if rate <= 0:
+                raise ValueError("rate must be positive")
+            self.rates[endpoint] = (float(rate), float(burst if burst is not None else max(rate, 1)))
+        self.backend = backend or LocalBuckets()
+        self.max_wait = max_wait
+
+    def reserve(self, mch_id, endpoint, tokens=1, max_wait=None):
+        """
+        取得令牌但不等待，调用方等待返回的秒数后再发出请求
+
+        :param max_wait: 本次最多等待的秒数，默认使用构造时的 max_wait
+        :return: 需要等待的秒数，接口不限速时为0
+        """
+        rate = self.rates.get(endpoint)
+        if rate is None:
+            return 0.0
+        if max_wait is None:
+            max_wait = self.max_wait
+        granted, wait = self.backend.reserve(u"{0}:{1}".format(mch_id, endpoint), rate[0], rate[1], tokens, max_wait)
+        if not granted:
+            raise RateLimitError(u"接口请求过于频繁，需等待{0:.3f}秒".format(wait), endpoint, wait)
+        return wait
+
+    def acquire(self, mch_id, endpoint, tokens=1, max_wait=None):
+        """
+        取得令牌，不足时阻塞等待，参数同 reserve
+        """
+        wait = self.reserve(mch_id, endpoint, tokens, max_wait)
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+对账
+
+按日期区间并发下载对账单，存为按列保存的 BillTable(金额为整数分，状态等取值有限的字段只保存编号)，
+按商户订单号或微信订单号建立索引后与商户自己的订单流水逐笔比对，逐条产出差异:
+
+    table = load_bills(wx_pay, "20240101", "20240131", bill_type="ALL", workers=4)
+    for item in table.reconcile(ledger):
+        if item.kind == MISSING:
+            ...
+
+ledger 为订单流水的可迭代对象，每项为含 out_trade_no(或 key_field 指定的字段)、total_fee(整数分) 的字典，
+可选 trade_state、refund_fee(整数分)，给出时才参与比对
+"""
+import array
+import collections
+import datetime
+import itertools
+
+from wx_pay import WxPayError
+
+try:
+    array.array("q")
+    _INT64 = "q"
+except ValueError:
+    _INT64 = "l"
+
+TEXT = "text"
+CODE = "code"
+CENTS = "cents"
+TIME = "time"
+
+# (列名, 类型, 对账单表头中的字段名，按优先顺序)
+COLUMNS = (
+    ("time", TIME, (u"交易时间",)),
+    ("transaction_id", TEXT, (u"微信订单号",)),
+    ("out_trade_no", TEXT, (u"商户订单号",)),
+    ("trade_type", CODE, (u"交易类型",)),
+    ("trade_state", CODE, (u"交易状态",)),
+    ("total_fee", CENTS, (u"订单金额", u"总金额", u"应结订单金额")),
+    ("refund_id", TEXT, (u"微信退款单号",)),
+    ("out_refund_no", TEXT, (u"商户退款单号",)),
+    ("refund_fee", CENTS, (u"申请退款金额", u"退款金额")),
+    ("refund_status", CODE, (u"退款状态",)),
+)
+
+# 差异类型
+MISSING = "missing"     # 流水中有，对账单中没有
+EXTRA = "extra"         # 对账单中有，流水中没有
+AMOUNT = "amount"       # 订单金额或退款金额不一致
+STATE = "state"         # 交易状态不一致
+
+Mismatch = collections.namedtuple("Mismatch", ["kind", "key", "bill", "ledger"])
+# 对账单中一笔订单的汇总: 下单金额取支付记录，退款金额为各退款记录之和，状态取时间最晚的记录
+BillOrder = collections.namedtuple("BillOrder", [
+    "out_trade_no", "transaction_id", "trade_state", "total_fee", "refund_fee", "rows"])
+
+NO_BILL = "No Bill Exist"
+
+
+def to_cents(text):
+    """
+    将以元为单位的金额文本(如 "12.34"、"-0.5")精确转换为整数分
+    """
+    if not text:
+        return 0
+    text = text.strip()
+    negative = text.startswith(u"-")
+    whole, _, frac = text.lstrip(u"-+").partition(u".")
+    cents = int(whole or 0) * 100 + int((frac + u"00")[:2])
+    return -cents if negative else cents
+
+
+def to_time(text):
+    """
+    将 "2014-11-10 16:33:45" 转换为整数 20141110163345，保持先后顺序
+    """
+    digits = u"".join(c for c in text if c.isdigit())
+    return int(digits) if digits else 0
+
+
+def bill_dates(start, end):
+    """
+    :param start: 起始日期，"YYYYMMDD" 或 date
+    :param end: 结束日期(含)
+    :return: ["YYYYMMDD"]
+    """
+    def parse(value):
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.datetime.strptime(value, "%Y%m%d").date()
+    day, end = parse(start), parse(end)
+    dates = []
+    while day <= end:
+        dates.append(day.strftime("%Y%m%d"))
+        day += datetime.timedelta(days=1)
+    return dates
+
+
+class StringTable(object):
+    """
+    取值有限的字符串字段的编号表，每个取值只保存一份
+    """
+
+    def __init__(self, values=()):
+        self.values = []
+        self._ids = {}
+        for value in values:
+            self.id(value)
+
+    def id(self, value):
+        code = self._ids.get(value)
+        if code is None:
+            code = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def find(self, value):
+        """
+        :return: 取值的编号，没有出现过时返回None
+        """
+        return self._ids.get(value)
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class BillTable(object):
+    """
+    按列保存的对账单记录
+
+    金额列、时间列为64位整数数组，CODE列为编号数组(取值见 codes[列名])，订单号等TEXT列为字符串列表，
+    内存占用约为逐条保存字典的1/7
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.codes = {}
+        for name, kind, _ in COLUMNS:
+            if kind == TEXT:
+                self.columns[name] = []
+            elif kind == CODE:
+                self.columns[name] = array.array("H")
+                self.codes[name] = StringTable([u""])
+            else:
+                self.columns[name] = array.array(_INT64)
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def add(self, header, rows):
+        """
+        追加一份对账单的记录，不同版本的对账单表头不同，缺少的字段记为空值或0
+
+        :param header: 表头字段元组(BillReader.header)
+        :param rows: 去除 ` 前缀后的字段元组(BillReader 产出的记录)
+        """
+        positions = []
+        for name, kind, titles in COLUMNS:
+            position = next((header.index(title) for title in titles if title in header), None)
+            positions.append((self.columns[name], kind, position, self.codes.get(name)))
+        count = 0
+        for row in rows:
+            count += 1
+            for column, kind, position, codes in positions:
+                text = row[position] if position is not None and position < len(row) else u""
+                if kind == TEXT:
+                    column.append(text)
+                elif kind == CODE:
+                    column.append(codes.id(text))
+                elif kind == CENTS:
+                    column.append(to_cents(text))
+                else:
+                    column.append(to_time(text))
+        if count:
+            self._indexes.clear()
+        return count
+
+    def extend(self, other):
+        """
+        合并另一个 BillTable(或 wx_pay_billstore.StoredBill) 的记录
+        """
+        for name, kind, _ in COLUMNS:
+            column = other.columns[name]
+            if kind == CODE:
+                codes, values = self.codes[name], other.codes[name].values
+                column = array.array("H", [codes.id(values[code]) for code in column])
+            elif isinstance(column, memoryview):
+                # BillStore 中映射到内存的列
+                column = array.array(self.columns[name].typecode, column.tobytes())
+            self.columns[name].extend(column)
+        if len(other):
+            self._indexes.clear()
+
+    def value(self, name, row):
+        """
+        第row条记录的字段值，CODE列返回原文本
+        """
+        value = self.columns[name][row]
+        return self.codes[name][value] if name in self.codes else value
+
+    def row(self, row):
+        """
+        第row条记录的 {列名: 值}
+        """
+        return dict((name, self.value(name, row)) for name, _, _ in COLUMNS)
+
+    def index(self, field="out_trade_no"):
+        """
+        按 field 建立的索引，同一订单的多条记录(支付、退款)以链表相连
+
+        :return: ({键: 第一条记录}, 下一条记录数组，-1为结束)
+        """
+        index = self._indexes.get(field)
+        if index is None:
+            heads, chain = {}, array.array(_INT64, [-1]) * len(self)
+            column = self.columns[field]
+            for row in range(len(column) - 1, -1, -1):
+                key = column[row]
+                if key:
+                    chain[row] = heads.get(key, -1)
+                    heads[key] = row
+            index = self._indexes[field] = (heads, chain)
+        return index
+
+    def rows(self, key, field="out_trade_no"):
+        """
+        :return: 该订单的记录编号列表
+        """
+        heads, chain = self.index(field)
+        result = []
+        row = heads.get(key, -1)
+        while row != -1:
+            result.append(row)
+            row = chain[row]
+        return result
+
+    def order(self, key, field="out_trade_no"):
+        """
+        :return: 该订单的 BillOrder，对账单中没有时返回None
+        """
+        rows = self.rows(key, field)
+        if not rows:
+            return None
+        columns = self.columns
+        states = self.codes["trade_state"]
+        refund_state = states.find(u"REFUND")
+        total_fee = refund_fee = None
+        latest = rows[0]
+        for row in rows:
+            if columns["time"][row] >= columns["time"][latest]:
+                latest = row
+            if columns["trade_state"][row] == refund_state:
+                refund_fee = (refund_fee or 0) + columns["refund_fee"][row]
+            elif total_fee is None:
+                total_fee = columns["total_fee"][row]
+        if total_fee is None:
+            total_fee = columns["total_fee"][rows[0]]
+        return BillOrder(columns["out_trade_no"][rows[0]], columns["transaction_id"][rows[0]],
+                         states[columns["trade_state"][latest]], total_fee, refund_fee or 0, rows)
+
+    def reconcile(self, ledger, key_field="out_trade_no"):
+        """
+        与订单流水逐笔比对，按流水顺序产出差异，最后产出对账单中有而流水中没有的订单
+
+        :param ledger: 订单流水的可迭代对象，见模块说明
+        :param key_field: 比对使用的订单号字段，out_trade_no 或 transaction_id
+        :return: Mismatch(kind, key, BillOrder或None, 流水记录或None) 的生成器
+        """
+        heads, _ = self.index(key_field)
+        # 按订单第一条记录的编号标记已比对的订单
+        matched = bytearray(len(self))
+        for entry in ledger:
+            key = entry.get(key_field)
+            head = heads.get(key)
+            if head is None:
+                yield Mismatch(MISSING, key, None, entry)
+                continue
+            if matched[head]:
+                continue
+            matched[head] = 1
+            bill = self.order(key, key_field)
+            if bill.total_fee != entry.get("total_fee") or \
+                    entry.get("refund_fee") is not None and bill.refund_fee != entry["refund_fee"]:
+                yield Mismatch(AMOUNT, key, bill, entry)
+            if entry.get("trade_state") is not None and bill.trade_state != entry["trade_state"]:
+                yield Mismatch(STATE, key, bill, entry)
+        for key, head in heads.items():
+            if not matched[head]:
+                yield Mismatch(EXTRA, key, self.order(key, key_field), None)
+
+
+def fetch_bill(wx_pay, bill_date, bill_type="ALL", gzip=True):
+    """
+    下载一天的对账单
+
+    :return: BillTable，当天没有账单时返回None
+    """
+    table = BillTable()
+    try:
+        bill = wx_pay.iter_bill(bill_date, bill_type, tar_type="GZIP" if gzip else None)
+        rows = iter(bill)
+        # 表头在读到第一条记录时才解析出来
+        first = next(rows, None)
+        if first is not None:
+            table.add(bill.header, itertools.chain([first], rows))
+    except WxPayError as e:
+        if NO_BILL in (e.args[0] if e.args else u""):
+            return None
+        raise
+    return table
+
+
+def load_bills(wx_pay, start, end, bill_type="ALL", workers=4, gzip=True, table=None):
+    """
+    并发下载日期区间内每天的对账单并合并为 BillTable，没有账单的日期跳过
+
+    :param wx_pay: WxPay实例
+    :param start: 起始日期，"YYYYMMDD" 或 date
+    :param end: 结束日期(含)
+    :param bill_type: 账单类型，对账时一般使用ALL
+    :param workers: 同时下载的天数
+    :param gzip: 是否下载压缩账单
+    :param table: 追加到已有的 BillTable
+    :return: BillTable
+    """
+    table = table if table is not None else BillTable()
+
+    def fetch(bill_date):
+        return fetch_bill(wx_pay, bill_date, bill_type, gzip)
+
+    for item in wx_pay._run_many(fetch, bill_dates(start, end), "bill_date", workers):
+        if item.error is not None:
+            raise item.error
+        if item.result is not None:
+            table.extend(item.result)
+    return table
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+请求的超时预算、重试、对冲请求与熔断
+
+    WxPay(..., resilience=Resilience(deadline=5.0, retries=2, hedge_after=0.5))
+
+- 每次调用有总超时预算 deadline，每次尝试的超时为剩余预算
+- 查询类接口(orderquery、refundquery、closeorder、downloadbill)幂等，网络错误时带抖动退避重试，
+  可开启对冲: 第一次请求超过 hedge_after 秒未返回时并发发出第二次请求，取先成功的结果
+- 下单、退款、红包、企业付款等接口只有在请求中带有商户单号时才重试，重试发送完全相同的报文，
+  微信支付按商户单号识别为同一笔请求，不会重复扣款或付款
+- 每个接口一个熔断器，最近的调用中失败率超过阈值时直接抛出 CircuitOpenError，
+  reset_timeout 秒后放行一次试探请求，成功则恢复
+"""
+import collections
+import random
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+clock = getattr(time, "monotonic", time.time)
+
+IDEMPOTENT = frozenset(["orderquery", "refundquery", "closeorder", "downloadbill"])
+MERCHANT_ID_FIELDS = {
+    "unifiedorder": "out_trade_no",
+    "micropay": "out_trade_no",
+    "reverse": "out_trade_no",
+    "refund": "out_refund_no",
+    "sendredpack": "mch_billno",
+    "transfers": "partner_trade_no",
+}
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class DeadlineExceededError(RuntimeError):
+    pass
+
+
+def endpoint_of(url):
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def client_error(error):
+    """
+    是否为 4xx 响应(requests.HTTPError、aiohttp.ClientResponseError)，请求本身有误，重试不会成功，也不说明服务端故障
+    """
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500
+
+
+class CircuitBreaker(object):
+    """
+    按最近 window 次调用的失败率熔断
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=0.5, min_calls=10, window=30, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before(self):
+        """
+        请求前调用，熔断中抛出 CircuitOpenError
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(u"接口熔断中，请稍后重试")
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self.state, self._opened_at = self.OPEN, clock()
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_threshold * len(self._outcomes):
+                self.state, self._opened_at = self.OPEN, clock()
+
+
+class Resilience(object):
+    def __init__(self, deadline=10.0, retries=2, backoff=0.1, max_backoff=1.0, hedge_after=None,
+                 retry_on=(IOError, OSError), failure_threshold=0.5, min_calls=10, window=30, reset_timeout=30.0):
+        """
+        :param deadline: 每次调用的总超时预算(秒)，包括所有重试
+        :param retries: 最大重试次数
+        :param backoff: 首次重试前的等待时间(秒)，之后每次翻倍并加入随机抖动
+        :param max_backoff: 最大等待时间(秒)
+        :param hedge_after: 幂等接口的对冲请求延迟(秒)，None为不对冲
+        :param retry_on: 视为可重试失败的异常类型(网络错误、5xx响应等)，其中的4xx响应不重试也不计入熔断
+        :param failure_threshold: 熔断的失败率阈值
+        :param min_calls: 统计窗口内至少有这么多次调用才会熔断
+        :param window: 统计窗口大小(调用次数)
+        :param reset_timeout: 熔断后多少秒放行试探请求
+        """
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.retry_on = retry_on
+        self._breaker_args = (failure_threshold, min_calls, window, reset_timeout)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(endpoint, CircuitBreaker(*self._breaker_args))
+        return breaker
+
+    @staticmethod
+    def retryable(endpoint, data):
+        if endpoint in IDEMPOTENT:
+            return True
+        field = MERCHANT_ID_FIELDS.get(endpoint)
+        return field is not None and bool(data.get(field))
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def call(self, endpoint, data, send):
+        """
+        :param endpoint: 接口名，见 endpoint_of
+        :param data: 请求参数，用于判断能否重试
+        :param send: send(timeout) 发送一次请求并返回响应体
+        """
+        breaker = self.breaker(endpoint)
+        breaker.before()
+        retry = self.retryable(endpoint, data)
+        hedge = self.hedge_after if endpoint in IDEMPOTENT else None
+        expires = clock() + self.deadline
+        attempt = 0
+        while True:
+            remaining = expires - clock()
+            if remaining <= 0:
+                raise DeadlineExceededError(u"请求超出超时预算")
+            try:
+                if hedge is not None and hedge < remaining:
+                    result = self._hedged(send, remaining, hedge)
+                else:
+                    result = send(remaining)
+            except self.retry_on as e:
+                if client_error(e):
+                    breaker.record(True)
+                    raise
+                breaker.record(False)
+                if not retry or attempt >= self.retries:
+                    raise
+                wait = self.delay(attempt)
+                if clock() + wait >= expires:
+                    raise
+                time.sleep(wait)
+                attempt += 1
+                continue
+            except Exception:
+                # 其余异常不是服务端故障，不计入失败
+                breaker.record(True)
+                raise
+            breaker.record(True)
+            return result
+
+    def _hedged(self, send, timeout, hedge_after):
+        """
+        先发出一次请求，hedge_after 秒内未返回则再发出一次，返回先成功的结果
+        """
+        results = queue.Queue()
+
+        def attempt(seconds):
+            try:
+                results.put((True, send(seconds)))
+            except Exception as e:
+                results.put((False, e))
+
+        def start(seconds):
+            t = threading.Thread(target=attempt, args=(seconds,))
+            t.daemon = True
+            t.start()
+
+        started = clock()
+        start(timeout)
+        try:
+            ok, value = results.get(timeout=hedge_after)
+            pending = 0
+        except queue.Empty:
+            start(timeout - (clock() - started))
+            ok, value = results.get()
+            pending = 1
+        if not ok and pending:
+            ok, value = results.get()
+        if ok:
+            return value
+        raise value
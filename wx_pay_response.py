@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+按接口定义的响应对象
+
+响应对象用 __slots__ 保存各字段的原始文本，数值、时间字段在首次访问属性时才转换并缓存，
+带序号的字段(coupon_fee_$n、refund_fee_$n 等)在首次访问时组装为列表，同时保留原始XML用于验签与存档。
+也支持 resp["total_fee"]、resp.get(...)、dict(resp) 等字典式访问，返回原始文本，与 to_dict 的结果一致:
+
+    resp = OrderQueryResponse.from_xml(content)
+    resp.total_fee       # 1
+    resp.time_end        # datetime.datetime(2014, 10, 30, 13, 35, 25)
+    resp["total_fee"]    # u"1"
+    wx_pay.check(resp)
+
+未定义的字段同样可以通过字典式访问读取，未出现的字段作为属性访问时为None
+"""
+import collections
+import datetime
+import re
+
+from wx_pay_xml import text_type, to_pairs
+
+
+class Codec(object):
+    """
+    字段的文本与值之间的转换
+    """
+    __slots__ = ("decode", "encode")
+
+    def __init__(self, decode, encode=text_type):
+        self.decode = decode
+        self.encode = encode
+
+
+def _time_codec(fmt):
+    return Codec(lambda text: datetime.datetime.strptime(text, fmt), lambda value: text_type(value.strftime(fmt)))
+
+
+INT = Codec(int)
+TIME = _time_codec("%Y%m%d%H%M%S")
+DATETIME = _time_codec("%Y-%m-%d %H:%M:%S")
+
+
+class _Field(object):
+    """
+    带转换的字段，原始文本保存在 _v_字段名 槽中，首次访问时转换并写回，_decoded 中对应位标记已转换
+    """
+    __slots__ = ("member", "codec", "bit")
+
+    def __init__(self, member, codec, bit):
+        self.member = member
+        self.codec = codec
+        self.bit = bit
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            value = self.member.__get__(obj, cls)
+        except AttributeError:
+            return None
+        if value is None or obj._decoded & self.bit:
+            return value
+        value = self.codec.decode(value)
+        self.member.__set__(obj, value)
+        obj._decoded |= self.bit
+        return value
+
+
+class Response(object):
+    __slots__ = ("_decoded", "_extra", "_lists", "xml")
+    # ((字段名, Codec或None), ...)
+    FIELDS = ()
+    # {字段名: (槽, Codec, 位)}
+    _INDEX = {}
+
+    def __init__(self, pairs, xml=None):
+        """
+        :param pairs: [(字段名, 文本)]
+        :param xml: 原始XML字节串
+        """
+        self._decoded = 0
+        self._lists = None
+        self.xml = xml
+        index = self._INDEX
+        extra = []
+        for tag, text in pairs:
+            entry = index.get(tag)
+            if entry is None:
+                extra.append((tag, text))
+            else:
+                entry[0].__set__(self, text)
+        self._extra = tuple(extra)
+
+    @classmethod
+    def from_xml(cls, content, keep_xml=True):
+        return cls(to_pairs(content), content if keep_xml else None)
+
+    @classmethod
+    def from_dict(cls, raw):
+        return cls(raw.items())
+
+    def __getattr__(self, name):
+        # 只有未出现的已定义字段会走到这里
+        if name in self._INDEX:
+            return None
+        raise AttributeError(name)
+
+    def __reduce__(self):
+        return self.__class__, (self.items(), self.xml)
+
+    def _text(self, name, entry):
+        member, codec, bit = entry
+        value = member.__get__(self, type(self))
+        if codec is not None and value is not None and self._decoded & bit:
+            value = codec.encode(value)
+        return value
+
+    def __getitem__(self, key):
+        entry = self._INDEX.get(key)
+        if entry is not None:
+            try:
+                return self._text(key, entry)
+            except AttributeError:
+                raise KeyError(key)
+        for tag, text in self._extra:
+            if tag == key:
+                return text
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        cls = type(self)
+        result = []
+        for name, entry in self._INDEX.items():
+            try:
+                entry[0].__get__(self, cls)
+            except AttributeError:
+                continue
+            result.append(name)
+        result.extend(tag for tag, _ in self._extra)
+        return result
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, self.to_dict())
+
+    def _indexed(self, name, pattern, build):
+        """
+        将带序号的字段组装为列表并缓存
+
+        :param pattern: 匹配字段名的正则，第一组为字段前缀，其余组为序号
+        :param build: build({序号元组: {前缀: 文本}}) 返回列表
+        """
+        if self._lists is None:
+            self._lists = {}
+        result = self._lists.get(name)
+        if result is None:
+            groups = collections.defaultdict(dict)
+            for tag, text in self._extra:
+                match = pattern.match(tag)
+                if match:
+                    groups[tuple(int(n) for n in match.groups()[1:])][match.group(1)] = text
+            result = self._lists[name] = build(groups)
+        return result
+
+
+def response_type(name, fields, base=Response, doc=None):
+    """
+    定义响应类型
+
+    :param fields: [(字段名, Codec或None)]，Codec为None的字段是普通文本槽
+    """
+    slots, members = [], []
+    for field, codec in fields:
+        slots.append("_v_" + field if codec else field)
+    namespace = {"__slots__": tuple(slots), "FIELDS": base.FIELDS + tuple(fields)}
+    if doc:
+        namespace["__doc__"] = doc
+    cls = type(name, (base,), namespace)
+    index = dict(base._INDEX)
+    bit = 1 << sum(1 for _, codec in base.FIELDS if codec)
+    for field, codec in fields:
+        if codec is None:
+            index[field] = (cls.__dict__[field], None, 0)
+        else:
+            member = cls.__dict__["_v_" + field]
+            setattr(cls, field, _Field(member, codec, bit))
+            index[field] = (member, codec, bit)
+            bit <<= 1
+    cls._INDEX = index
+    return cls
+
+
+def _fields(text="", ints="", times="", datetimes=""):
+    return ([(f, None) for f in text.split()] + [(f, INT) for f in ints.split()] +
+            [(f, TIME) for f in times.split()] + [(f, DATETIME) for f in datetimes.split()])
+
+
+Coupon = collections.namedtuple("Coupon", ["coupon_type", "coupon_id", "coupon_fee"])
+RefundCoupon = collections.namedtuple("RefundCoupon", ["coupon_type", "coupon_refund_id", "coupon_refund_fee"])
+RefundItem = collections.namedtuple("RefundItem", [
+    "out_refund_no", "refund_id", "refund_channel", "refund_fee", "settlement_refund_fee", "refund_status",
+    "refund_account", "refund_recv_accout", "refund_success_time", "coupons"])
+
+_COUPON = re.compile(r"^(coupon_type|coupon_id|coupon_fee)_(\d+)$")
+_REFUND = re.compile(r"^(out_refund_no|refund_id|refund_channel|refund_fee|settlement_refund_fee|refund_status|"
+                     r"refund_account|refund_recv_accout|refund_success_time|coupon_refund_count)_(\d+)$")
+_REFUND_COUPON = re.compile(r"^(coupon_type|coupon_refund_id|coupon_refund_fee)_(\d+)_(\d+)$")
+
+
+def _int_or_none(text):
+    return int(text) if text else None
+
+
+def _coupons(groups):
+    return [Coupon(g.get("coupon_type"), g.get("coupon_id"), _int_or_none(g.get("coupon_fee")))
+            for _, g in sorted(groups.items())]
+
+
+BaseResponse = response_type("BaseResponse", _fields(
+    "return_code return_msg appid mch_id device_info nonce_str sign result_code err_code err_code_des"))
+
+
+class _PaymentMixin(object):
+    __slots__ = ()
+
+    @property
+    def coupons(self):
+        """
+        代金券列表 [Coupon(coupon_type, coupon_id, coupon_fee)]
+        """
+        return self._indexed("coupons", _COUPON, _coupons)
+
+
+_PAYMENT_FIELDS = _fields(
+    "openid is_subscribe trade_type bank_type fee_type cash_fee_type transaction_id out_trade_no attach",
+    ints="total_fee settlement_total_fee cash_fee coupon_fee coupon_count", times="time_end")
+
+OrderQueryResponse = response_type("OrderQueryResponse", _fields("trade_state trade_state_desc") + _PAYMENT_FIELDS,
+                                   type("_OrderQueryBase", (_PaymentMixin, BaseResponse), {"__slots__": ()}),
+                                   u"订单查询结果")
+PayNotify = response_type("PayNotify", _fields("sign_type") + _PAYMENT_FIELDS,
+                          type("_PayNotifyBase", (_PaymentMixin, BaseResponse), {"__slots__": ()}),
+                          u"支付结果通知")
+MicropayResponse = response_type("MicropayResponse", _PAYMENT_FIELDS,
+                                 type("_MicropayBase", (_PaymentMixin, BaseResponse), {"__slots__": ()}),
+                                 u"刷卡支付结果")
+UnifiedOrderResponse = response_type("UnifiedOrderResponse", _fields("trade_type prepay_id code_url mweb_url"),
+                                     BaseResponse, u"统一下单结果")
+RefundResponse = response_type("RefundResponse", _fields(
+    "transaction_id out_trade_no out_refund_no refund_id fee_type cash_fee_type",
+    ints="refund_fee settlement_refund_fee total_fee settlement_total_fee cash_fee cash_refund_fee "
+         "coupon_refund_fee coupon_refund_count"), BaseResponse, u"申请退款结果")
+
+
+def _refunds(response):
+    def build(groups):
+        coupons = collections.defaultdict(list)
+        for (n, _), g in sorted(response._indexed("refund_coupons", _REFUND_COUPON, lambda x: x).items()):
+            coupons[n].append(RefundCoupon(g.get("coupon_type"), g.get("coupon_refund_id"),
+                                           _int_or_none(g.get("coupon_refund_fee"))))
+        result = []
+        for (n,), g in sorted(groups.items()):
+            success_time = g.get("refund_success_time")
+            result.append(RefundItem(
+                g.get("out_refund_no"), g.get("refund_id"), g.get("refund_channel"),
+                _int_or_none(g.get("refund_fee")), _int_or_none(g.get("settlement_refund_fee")),
+                g.get("refund_status"), g.get("refund_account"), g.get("refund_recv_accout"),
+                DATETIME.decode(success_time) if success_time else None, coupons.get(n, [])))
+        return result
+    return build
+
+
+class _RefundQueryBase(BaseResponse):
+    __slots__ = ()
+
+    @property
+    def refunds(self):
+        """
+        退款列表 [RefundItem(...)]，每笔退款的代金券在 RefundItem.coupons 中
+        """
+        return self._indexed("refunds", _REFUND, _refunds(self))
+
+
+RefundQueryResponse = response_type("RefundQueryResponse", _fields(
+    "transaction_id out_trade_no fee_type",
+    ints="total_refund_count total_fee settlement_total_fee cash_fee refund_count"), _RefundQueryBase, u"退款查询结果")
+RefundNotify = response_type("RefundNotify", _fields(
+    "transaction_id out_trade_no refund_id out_refund_no refund_status refund_recv_accout refund_account "
+    "refund_request_source", ints="total_fee settlement_total_fee refund_fee settlement_refund_fee",
+    datetimes="success_time"), BaseResponse, u"退款结果通知，包含解密后的 req_info 字段")
+
+# 接口名(见 wx_pay_resilience.endpoint_of): 响应类型
+RESPONSE_TYPES = {
+    "orderquery": OrderQueryResponse,
+    "micropay": MicropayResponse,
+    "unifiedorder": UnifiedOrderResponse,
+    "refund": RefundResponse,
+    "refundquery": RefundQueryResponse,
+}
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付签名
+参考微信签名生成算法 https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=4_3
+"""
+import hashlib
+import hmac
+
+from wx_pay_xml import text_type
+
+SIGN_TYPE_MD5 = "MD5"
+SIGN_TYPE_HMAC_SHA256 = "HMAC-SHA256"
+SIGN_TYPES = (SIGN_TYPE_MD5, SIGN_TYPE_HMAC_SHA256)
+
+
+def _to_bytes(raw):
+    return raw.encode("utf-8") if isinstance(raw, text_type) else raw
+
+
+class Signer(object):
+    """
+    签名引擎，支持 MD5 与 HMAC-SHA256
+    商户密钥的编码结果与HMAC的密钥状态在构造时计算一次，之后每次签名只需处理参数部分
+    """
+
+    def __init__(self, key, sign_type=SIGN_TYPE_MD5):
+        """
+        :param key: 商户API密钥
+        :param sign_type: 默认签名类型，MD5 或 HMAC-SHA256
+        """
+        if sign_type not in SIGN_TYPES:
+            raise ValueError("unsupported sign_type: {0}".format(sign_type))
+        self.sign_type = sign_type
+        key = _to_bytes(key)
+        self._key_suffix = b"&key=" + key
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+
+    @staticmethod
+    def parts(raw):
+        """
+        按参数名排序的 [(参数名, "key=value")]，空值与sign不参与签名
+        """
+        parts = []
+        for k in sorted(raw):
+            v = raw[k]
+            if v is None or k == "sign":
+                continue
+            if isinstance(v, bytes):
+                v = v.decode("utf-8")
+            elif not isinstance(v, text_type):
+                v = text_type(v)
+            if v:
+                parts.append((k, u"{0}={1}".format(k, v)))
+        return parts
+
+    @classmethod
+    def string_to_sign(cls, raw, prepared=()):
+        """
+        按参数名ASCII码从小到大排序，空值与sign不参与签名，返回UTF-8编码的 key1=value1&key2=value2
+
+        :param prepared: 预先由 parts 生成的固定参数部分，参数名不能与raw重复
+        """
+        parts = cls.parts(raw)
+        if prepared:
+            parts.extend(prepared)
+            parts.sort()
+        return u"&".join([part for _, part in parts]).encode("utf-8")
+
+    def sign_type_of(self, raw, sign_type=None):
+        return sign_type or raw.get("sign_type") or self.sign_type
+
+    def sign(self, raw, sign_type=None, prepared=()):
+        """
+        :param sign_type: 签名类型，默认取参数中的 sign_type，否则为构造时指定的类型
+        :param prepared: 见 string_to_sign
+        """
+        message = self.string_to_sign(raw, prepared) + self._key_suffix
+        sign_type = self.sign_type_of(raw, sign_type)
+        if sign_type == SIGN_TYPE_HMAC_SHA256:
+            digest = self._hmac.copy()
+            digest.update(message)
+        elif sign_type == SIGN_TYPE_MD5:
+            digest = hashlib.md5(message)
+        else:
+            raise ValueError("unsupported sign_type: {0}".format(sign_type))
+        return digest.hexdigest().upper()
+
+    def check(self, raw, sign_type=None):
+        """
+        验证签名，不修改传入的字典，使用常量时间比较
+        """
+        sign = raw.get("sign")
+        if not sign:
+            return False
+        return hmac.compare_digest(_to_bytes(sign), _to_bytes(self.sign(raw, sign_type)))
+
+    def sign_many(self, payloads, sign_type=None):
+        return [self.sign(raw, sign_type) for raw in payloads]
+
+    def check_many(self, payloads, sign_type=None):
+        return [self.check(raw, sign_type) for raw in payloads]
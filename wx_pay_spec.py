@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+接口定义表
+
+各接口的地址、必填参数、关联参数、默认参数以及是否需要商户证书集中定义在 SPECS 中。
+接口地址只记录路径，WxPay 构造时按 base_url 补全并将接口定义编译为 RequestTemplate，appid、mch_id、notify_url 等固定参数的签名片段与XML片段只生成一次，
+每次调用只校验、签名并编码本次传入的参数
+"""
+import collections
+
+import wx_pay_xml
+from wx_pay_sign import SIGN_TYPE_MD5, Signer
+
+EndpointSpec = collections.namedtuple("EndpointSpec", [
+    "url", "required", "any_of", "rules", "client_fields", "constants", "generated", "client_ip", "ssl",
+    "sign_type", "check", "missing"])
+
+
+API_BASE_URL = "https://api.mch.weixin.qq.com"
+
+
+def endpoint(url, missing, required="", any_of=None, rules=(), client_fields=None, constants=(), generated=(),
+             client_ip=False, ssl=False, sign_type=None, check="return"):
+    """
+    定义接口
+
+    :param url: 接口路径
+    :param missing: 缺少必填参数时的错误信息，{0}为参数名
+    :param required: 空格分隔的必填参数
+    :param any_of: (空格分隔的参数, 错误信息)，这些参数至少填一个
+    :param rules: [(参数, 取值元组, 此时必填的参数, 错误信息或None)]
+    :param client_fields: [(参数, WxPay属性名)]，未传入时取WxPay实例的属性，默认为appid与mch_id
+    :param constants: [(参数, 值)]，未传入时的固定值
+    :param generated: [(参数, "trade_no"或"bill_no")]，未传入时由 id_generator 生成
+    :param client_ip: 未传入spbill_create_ip时取flask请求的来源地址
+    :param ssl: 是否需要商户证书
+    :param sign_type: 接口只支持的签名类型，None为不限
+    :param check: "return" 只检查 return_code，"result" 同时检查 err_code_des，None为不检查
+    """
+    if client_fields is None:
+        client_fields = (("appid", "WX_APP_ID"), ("mch_id", "WX_MCH_ID"))
+    if any_of is not None:
+        any_of = (tuple(any_of[0].split()), any_of[1])
+    return EndpointSpec(url, tuple(required.split()), any_of, tuple(rules), tuple(client_fields), tuple(constants),
+                        tuple(generated), client_ip, ssl, sign_type, check, missing)
+
+
+_ORDER_KEYS = u"out_trade_no、transaction_id至少填一个"
+
+SPECS = {
+    "unified_order": endpoint(
+        "/pay/unifiedorder", u"缺少统一支付接口必填参数{0}",
+        required="out_trade_no body total_fee trade_type",
+        rules=[("trade_type", ("JSAPI",), "openid", u"trade_type为JSAPI时，openid为必填参数"),
+               ("trade_type", ("NATIVE",), "product_id", u"trade_type为NATIVE时，product_id为必填参数")],
+        client_fields=[("appid", "WX_APP_ID"), ("mch_id", "WX_MCH_ID"), ("notify_url", "WX_NOTIFY_URL")],
+        client_ip=True, check="result"),
+    "order_query": endpoint(
+        "/pay/orderquery", u"订单查询接口中，缺少必填参数{0}",
+        any_of=("out_trade_no transaction_id", u"订单查询接口中，" + _ORDER_KEYS)),
+    "close_order": endpoint(
+        "/pay/closeorder", u"关闭订单接口中，缺少必填参数{0}", required="out_trade_no"),
+    "refund": endpoint(
+        "/secapi/pay/refund", u"退款申请接口中，缺少必填参数{0}", required="total_fee refund_fee",
+        any_of=("out_trade_no transaction_id", u"退款申请接口中，" + _ORDER_KEYS),
+        client_fields=[("appid", "WX_APP_ID"), ("mch_id", "WX_MCH_ID"), ("op_user_id", "WX_MCH_ID")],
+        generated=[("out_refund_no", "trade_no")], ssl=True),
+    "refund_query": endpoint(
+        "/pay/refundquery", u"退款查询接口中，缺少必填参数{0}",
+        any_of=("out_refund_no out_trade_no transaction_id refund_id",
+                u"退款查询接口中，out_refund_no、out_trade_no、transaction_id、refund_id四个参数必填一个")),
+    "download_bill": endpoint(
+        "/pay/downloadbill", u"下载对账单接口中，缺少必填参数{0}", required="bill_date", check=None),
+    # 红包与企业付款接口只支持MD5签名
+    "send_red_pack": endpoint(
+        "/mmpaymkttransfers/sendredpack", u"向用户发送红包接口中，缺少必填参数{0}",
+        required="send_name re_openid total_amount wishing client_ip act_name remark",
+        client_fields=[("wxappid", "WX_APP_ID"), ("mch_id", "WX_MCH_ID")],
+        constants=[("total_num", 1), ("scene_id", "PRODUCT_4")],
+        generated=[("mch_billno", "bill_no")], ssl=True, sign_type=SIGN_TYPE_MD5),
+    "enterprise_payment": endpoint(
+        "/mmpaymkttransfers/promotion/transfers", u"企业付款申请接口中，缺少必填参数{0}",
+        required="openid check_name amount desc spbill_create_ip",
+        rules=[("check_name", ("FORCE_CHECK",), "re_user_name", None)],
+        client_fields=[("mch_appid", "WX_APP_ID"), ("mchid", "WX_MCH_ID")],
+        generated=[("partner_trade_no", "bill_no")], ssl=True, sign_type=SIGN_TYPE_MD5),
+    "swiping_card_payment": endpoint(
+        "/pay/micropay", u"缺少刷卡支付接口必填参数{0}", required="body total_fee",
+        generated=[("out_trade_no", "trade_no")], client_ip=True, check="result"),
+    "reverse": endpoint(
+        "/secapi/pay/reverse", u"撤销订单接口中，缺少必填参数{0}",
+        any_of=("out_trade_no transaction_id", u"撤销订单接口中，" + _ORDER_KEYS), ssl=True),
+}
+
+
+class SignedRequest(dict):
+    """
+    已签名的请求参数，body 为编码好的XML，WxPay.to_xml 直接返回 body
+    """
+    __slots__ = ("body",)
+
+
+class RequestTemplate(object):
+    """
+    编译后的接口模板，保存固定参数以及其签名片段与XML片段
+    调用时传入了同名参数的，以传入的为准，去掉这些参数后的片段按参数名组合缓存
+    """
+    __slots__ = ("spec", "url", "fields", "names", "_parts")
+
+    def __init__(self, spec, fields, base_url=API_BASE_URL):
+        """
+        :param fields: 固定参数 {参数: 值}
+        """
+        self.spec = spec
+        self.url = base_url + spec.url
+        self.fields = fields
+        self.names = frozenset(fields)
+        self._parts = {frozenset(): self._compile(fields)}
+
+    @classmethod
+    def compile(cls, spec, client):
+        fields = dict(spec.constants)
+        for field, attr in spec.client_fields:
+            fields[field] = getattr(client, attr)
+        return cls(spec, fields, client.base_url)
+
+    @staticmethod
+    def _compile(fields):
+        return fields, Signer.parts(fields), wx_pay_xml.to_fragment(fields)
+
+    def validate(self, data):
+        """
+        一次检查必填参数、至少填一个的参数与关联参数
+
+        :return: 错误信息，通过时返回None
+        """
+        spec = self.spec
+        for field in spec.required:
+            if field not in data:
+                return spec.missing.format(field)
+        if spec.any_of is not None:
+            fields, message = spec.any_of
+            if not any(field in data for field in fields):
+                return message
+        for field, values, required, message in spec.rules:
+            if data.get(field) in values and required not in data:
+                return message or spec.missing.format(required)
+        return None
+
+    def _static(self, data):
+        if self.names.isdisjoint(data):
+            return self._parts[frozenset()]
+        overridden = self.names.intersection(data)
+        parts = self._parts.get(overridden)
+        if parts is None:
+            parts = self._parts[overridden] = self._compile(
+                dict((k, v) for k, v in self.fields.items() if k not in overridden))
+        return parts
+
+    def sign(self, data, signer, sign_type):
+        """
+        签名并编码，data 中已有 sign 时不再重新签名
+
+        :param data: 本次调用的参数，会写入 sign
+        :return: 含固定参数的 SignedRequest
+        """
+        fields, prepared, fragment = self._static(data)
+        if "sign" not in data:
+            data["sign"] = signer.sign(data, sign_type, prepared)
+        request = SignedRequest(fields)
+        request.update(data)
+        request.body = wx_pay_xml.to_xml(data, fragment)
+        return request
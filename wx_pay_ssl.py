@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+商户证书SSL上下文缓存
+
+每个(cert, key)只读取、解析一次PEM文件，之后的请求直接复用同一个 SSLContext；
+证书文件被替换(修改时间或大小变化)时自动重新加载，检查间隔为 check_interval 秒
+"""
+import os
+import threading
+
+from wx_pay_resilience import clock
+
+
+class SSLContextCache(object):
+    def __init__(self, check_interval=60.0, cafile=None):
+        """
+        :param check_interval: 检查证书文件是否变化的间隔(秒)，0为每次都检查
+        :param cafile: 校验服务端证书使用的CA文件，默认为系统CA
+        """
+        self.check_interval = check_interval
+        self.cafile = cafile
+        self._lock = threading.Lock()
+        # {cert: [SSLContext, 文件签名, 下次检查时间]}
+        self._contexts = {}
+
+    @staticmethod
+    def _signature(cert):
+        result = []
+        for path in cert:
+            st = os.stat(path)
+            result.append((st.st_mtime, st.st_size, st.st_ino))
+        return tuple(result)
+
+    def _load(self, cert):
+        import ssl
+        context = ssl.create_default_context(cafile=self.cafile)
+        context.load_cert_chain(*cert)
+        return context
+
+    def get(self, cert):
+        """
+        :param cert: (证书路径, 私钥路径)
+        :return: 加载了该商户证书的 SSLContext
+        """
+        entry = self._contexts.get(cert)
+        if entry is not None and clock() < entry[2]:
+            return entry[0]
+        with self._lock:
+            entry = self._contexts.get(cert)
+            now = clock()
+            if entry is not None and now < entry[2]:
+                return entry[0]
+            signature = self._signature(cert)
+            if entry is None or entry[1] != signature:
+                entry = [self._load(cert), signature, 0]
+                self._contexts[cert] = entry
+            entry[2] = now + self.check_interval
+            return entry[0]
+
+    def discard(self, cert):
+        with self._lock:
+            self._contexts.pop(cert, None)
+
+    def __len__(self):
+        return len(self._contexts)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付XML编解码
+
+微信支付的请求与响应均为只有一层子节点的XML，例如:
+    <xml><return_code><![CDATA[SUCCESS]]></return_code><total_fee>1</total_fee></xml>
+"""
+try:
+    from xml.etree import cElementTree as ETree
+except ImportError:
+    from xml.etree import ElementTree as ETree
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+ParseError = ETree.ParseError
+
+_NUMBER_TYPES = (int, float)
+try:
+    _NUMBER_TYPES += (long,)
+except NameError:
+    pass
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value if isinstance(value, text_type) else text_type(value)
+
+
+def to_fragment(raw):
+    """
+    将参数字典编码为不含根节点的XML字符串，数值原样输出，其余值用CDATA包裹，值中的 ]]> 会被拆分到两个CDATA段中
+    """
+    parts = []
+    append = parts.append
+    for k, v in raw.items():
+        if isinstance(v, _NUMBER_TYPES) and not isinstance(v, bool):
+            append(u"<{0}>{1}</{0}>".format(k, v))
+        else:
+            v = _text(v)
+            if u"]]>" in v:
+                v = v.replace(u"]]>", u"]]]]><![CDATA[>")
+            append(u"<{0}><![CDATA[{1}]]></{0}>".format(k, v))
+    return u"".join(parts)
+
+
+def to_xml(raw, fragment=u""):
+    """
+    将参数字典编码为UTF-8的XML字节串
+
+    :param fragment: 预先由 to_fragment 编码的其他参数，放在raw的参数之前
+    """
+    return (u"<xml>" + fragment + to_fragment(raw) + u"</xml>").encode("utf-8")
+
+
+def _root(content):
+    if isinstance(content, text_type):
+        content = content.encode("utf-8")
+    if b"<!DOCTYPE" in content or b"<!ENTITY" in content:
+        # 微信支付的报文不含DTD，拒绝处理以防止实体扩展攻击
+        raise ParseError("DTD is not allowed")
+    return ETree.fromstring(content)
+
+
+def to_dict(content, keys=None):
+    """
+    将XML解码为 {子节点名: 文本} 字典，只读取根节点下的一层子节点
+
+    :param content: XML字节串或字符串
+    :param keys: 只返回这些子节点，默认全部返回
+    :return: dict，空节点的值为None
+    """
+    root = _root(content)
+    if keys is None:
+        return dict((child.tag, child.text) for child in root)
+    return dict((child.tag, child.text) for child in root if child.tag in keys)
+
+
+def to_pairs(content):
+    """
+    将XML解码为 [(子节点名, 文本)] 列表，保留节点顺序
+    """
+    return [(child.tag, child.text) for child in _root(content)]